@@ -12,14 +12,54 @@
 import datasets as ds
 import numpy as np
 import polars as pl
+import pyarrow as pa
 import torch as t
 
+from fms_ehrs.framework.compact import (
+    CompactTimelines,
+    compact_dir,
+    load_padded,
+    padded_file,
+)
 from fms_ehrs.framework.vocabulary import Vocabulary
 
 Frame: typing.TypeAlias = pl.DataFrame | pl.LazyFrame
 Pathlike: typing.TypeAlias = pathlib.PurePath | str | os.PathLike
 
 
+def load_input_ids(
+    data_files: dict[str, Pathlike], column: str = "padded"
+) -> ds.DatasetDict:
+    """
+    load `column` of each split's tokens_timelines parquet file as `input_ids`;
+    `padded` is memory-mapped from the split's padded matrix if one was written
+    alongside it, and splits written only in the compact format are
+    memory-mapped as well, with `padded` computed on read
+    """
+    dataset = dict()
+    for s, f in data_files.items():
+        f = pathlib.Path(f).expanduser().resolve()
+        if column == "padded" and padded_file(f).exists():
+            padded = load_padded(f)
+            dataset[s] = ds.Dataset(
+                pa.table(
+                    {
+                        column: pa.FixedSizeListArray.from_arrays(
+                            pa.array(padded.ravel()), padded.shape[1]
+                        )
+                    }
+                )
+            )
+        elif f.exists():
+            dataset[s] = ds.load_dataset(
+                "parquet", data_files=str(f), split="train", columns=[column]
+            )
+        else:
+            dataset[s] = ds.Dataset(CompactTimelines(compact_dir(f)).to_arrow([column]))
+        dataset[s] = dataset[s].rename_column(column, "input_ids")
+    return ds.DatasetDict(dataset)
+
+
 class Datasets:
     def __init__(
         self,
@@ -51,34 +91,21 @@ def __init__(
         self.i_part = i_part
         self.n_parts = n_parts
         self.dataset = (
-            ds.load_dataset(
-                "parquet",
-                data_files={
-                    s: str(self.data_dirs[s].joinpath("tokens_timelines.parquet"))
+            load_input_ids(
+                {
+                    s: self.data_dirs[s].joinpath("tokens_timelines.parquet")
                     for s in self.splits
                 },
+                column="padded" if (self.collation == "padded") else "tokens",
             )
-            .map(
-                lambda batch: {
-                    "input_ids": batch[
-                        "padded" if (self.collation == "padded") else "tokens"
-                    ]
-                },
-                batched=True,
-                remove_columns=[
-                    "hospitalization_id",
-                    "tokens",
-                    "times",
-                    "seq_len",
-                    "padded",
-                ],
-                features=ds.Features(
+            .cast(
+                ds.Features(
                     {
                         "input_ids": ds.Sequence(
                             ds.Value(str(self.uint_dtype).split(".")[-1])
                         )
                     }
-                ),
+                )
             )
             .with_format("torch")
         )
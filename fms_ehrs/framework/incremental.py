@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+"""
+appends newly received hospitalizations to an already tokenized version with
+its frozen vocabulary: each hospitalization of a raw CLIF delta directory is
+fingerprinted by a hash of all of its source rows, and only hospitalizations
+that are new, or whose fingerprint changed, are tokenized and merged into the
+existing `tokens_timelines.parquet`; fingerprints are kept alongside as
+`{stem}-hashes.parquet`
+
+a delta directory should contain all rows of each hospitalization it includes
+(e.g. a monthly extract of admissions, with any corrected hospitalizations
+re-extracted in full); fingerprints rely on polars' hashing and are therefore
+only comparable when computed with the same polars version
+"""
+
+import logging
+import os
+import pathlib
+import shutil
+import typing
+
+import polars as pl
+
+from fms_ehrs.framework.compact import compact_dir, padded_file, scan_tokens_timelines
+from fms_ehrs.framework.logger import get_logger
+from fms_ehrs.framework.storage import fix_perms
+from fms_ehrs.framework.tokenizer import ClifTokenizer
+
+Pathlike: typing.TypeAlias = pathlib.PurePath | str | os.PathLike
+
+
+def hashes_file(parquet_file: Pathlike) -> pathlib.Path:
+    """location of the fingerprints for the timelines in `parquet_file`"""
+    f = pathlib.Path(parquet_file).expanduser().resolve()
+    return f.with_name(f"{f.stem}-hashes.parquet")
+
+
+def content_hashes(data_dir: Pathlike) -> pl.DataFrame:
+    """
+    one fingerprint per hospitalization of the CLIF tables in `data_dir`: the
+    (wrapping) sum of the hashes of its rows across all tables, so that it does
+    not depend on the order of rows or files; rows of the patient table count
+    towards each of the patient's hospitalizations
+    """
+    data_dir = pathlib.Path(data_dir).expanduser().resolve()
+    hosp = pl.scan_parquet(next(data_dir.glob("*_hospitalization.parquet")))
+    parts = list()
+    for p in sorted(data_dir.glob("*.parquet")):
+        x = pl.scan_parquet(p)
+        names = x.collect_schema().names()
+        if "hospitalization_id" not in names:
+            if "patient_id" not in names:
+                continue
+            x = x.join(
+                hosp.select("patient_id", "hospitalization_id").unique(),
+                on="patient_id",
+            )
+        parts.append(
+            x.with_columns(pl.col(pl.Categorical, pl.Enum).cast(pl.String)).select(
+                "hospitalization_id",
+                row_hash=pl.struct(pl.lit(p.stem).alias("table"), *names).hash(seed=42),
+            )
+        )
+    return (
+        pl.concat(parts)
+        .group_by("hospitalization_id")
+        .agg(content_hash=pl.col("row_hash").sum())
+        .sort("hospitalization_id")
+        .collect()
+    )
+
+
+def append_tokens_timelines(
+    delta_dir: Pathlike,
+    parquet_file: Pathlike,
+    *,
+    vocab_path: Pathlike,
+    logger: logging.Logger = None,
+    **kwargs,
+) -> dict:
+    """
+    tokenize the new or changed hospitalizations of `delta_dir` with the
+    frozen vocabulary at `vocab_path` and merge them into `parquet_file` (or
+    its compact version, if only that was kept), replacing earlier versions
+    of changed hospitalizations; `kwargs` are passed to `ClifTokenizer` and
+    should match those the existing timelines were created with; the
+    timelines already present are carried over without being re-tokenized,
+    in the order of `ClifTokenizer.sort_tokens_timelines`, and any padded
+    matrix or compact version of the file is brought up to date; without
+    fingerprints from an earlier append, hospitalizations that are already
+    present are tokenized once and count as changed only if their timelines
+    differ from the existing ones; returns a report of what was done,
+    including words that were not in the vocabulary (and were therefore
+    mapped to the null token)
+    """
+    log = logger if logger is not None else get_logger()
+    parquet_file = pathlib.Path(parquet_file).expanduser().resolve()
+    hf = hashes_file(parquet_file)
+
+    hashes = content_hashes(delta_dir)
+    present = (
+        scan_tokens_timelines(parquet_file)
+        .select("hospitalization_id")
+        .collect()
+        .get_column("hospitalization_id")
+    )
+    known = (
+        pl.read_parquet(hf)
+        if hf.exists()
+        else pl.DataFrame(
+            schema={"hospitalization_id": pl.String, "content_hash": pl.UInt64}
+        )
+    )
+    todo = hashes.join(known, on=("hospitalization_id", "content_hash"), how="anti")
+    if todo.height == 0:
+        log.info(f"all {hashes.height} hospitalizations in the delta are unchanged")
+        return {
+            "delta": hashes.height,
+            "new": 0,
+            "changed": 0,
+            "unchanged": hashes.height,
+            "tokenized": 0,
+            "timelines": present.len(),
+            "oov": {},
+        }
+
+    ids = todo.get_column("hospitalization_id")
+    tkzr = ClifTokenizer(
+        data_dir=delta_dir, vocab_path=vocab_path, hospitalization_ids=ids, **kwargs
+    )
+    tt = tkzr.pad_and_truncate(tkzr.get_tokens_timelines())
+    schema = scan_tokens_timelines(parquet_file).collect_schema()
+    if set(tt.columns) != set(schema.keys()):
+        raise ValueError(
+            "Tokenizer options do not match the existing timelines: "
+            f"{sorted(tt.columns)} vs. {sorted(schema.keys())}"
+        )
+    if not hf.exists():
+        # seed the fingerprints from the existing output: hospitalizations whose
+        # timelines come out the same as before are left as they are
+        same = (
+            tt.join(
+                scan_tokens_timelines(parquet_file)
+                .filter(pl.col("hospitalization_id").is_in(ids))
+                .select("hospitalization_id", "tokens", "times")
+                .collect(),
+                on="hospitalization_id",
+                suffix="_existing",
+            )
+            .filter(
+                (pl.col("tokens") == pl.col("tokens_existing"))
+                & (pl.col("times") == pl.col("times_existing"))
+            )
+            .get_column("hospitalization_id")
+        )
+    else:
+        same = pl.Series(dtype=pl.String)
+    replaced = todo.filter(~pl.col("hospitalization_id").is_in(same))
+    is_new = ~pl.col("hospitalization_id").is_in(present)
+    report = {
+        "delta": hashes.height,
+        "new": replaced.filter(is_new).height,
+        "changed": replaced.filter(~is_new).height,
+        "unchanged": hashes.height - replaced.height,
+    }
+    log.info(
+        "{new} new, {changed} changed, and {unchanged} unchanged "
+        "hospitalizations in the delta".format(**report)
+    )
+
+    if replaced.height > 0:
+        merged = tkzr.sort_tokens_timelines(
+            pl.concat(
+                (
+                    scan_tokens_timelines(parquet_file).filter(
+                        ~pl.col("hospitalization_id").is_in(
+                            replaced.get_column("hospitalization_id")
+                        )
+                    ),
+                    tt.lazy()
+                    .filter(~pl.col("hospitalization_id").is_in(same))
+                    .select(schema.keys())
+                    .cast(schema),
+                )
+            )
+        )
+        if parquet_file.exists():
+            tmp = parquet_file.with_name(f"{parquet_file.stem}-appending.parquet")
+            merged.sink_parquet(tmp)
+            os.replace(tmp, parquet_file)
+            fix_perms(parquet_file)
+            if padded_file(parquet_file).exists():
+                tkzr.write_padded(pl.scan_parquet(parquet_file), parquet_file)
+            if compact_dir(parquet_file).exists():
+                tkzr.write_compact(
+                    pl.scan_parquet(parquet_file), compact_dir(parquet_file)
+                )
+        else:  # only the compact version was kept, and is memory-mapped
+            cd = compact_dir(parquet_file)
+            tmp = tkzr.write_compact(
+                merged.collect(), cd.with_name(cd.name + "-appending")
+            )
+            shutil.rmtree(cd)
+            os.replace(tmp, cd)
+
+    pl.concat((known.filter(~pl.col("hospitalization_id").is_in(ids)), todo)).sort(
+        "hospitalization_id"
+    ).write_parquet(hf)
+    fix_perms(hf)
+
+    report |= {
+        "tokenized": tt.height,
+        "timelines": scan_tokens_timelines(parquet_file)
+        .select(pl.len())
+        .collect()
+        .item(),
+        "oov": {str(w): n for w, n in tkzr.vocab.unseen.most_common()},
+    }
+    if report["oov"]:
+        log.warning(
+            "{} words were not in the vocabulary and were mapped to the null "
+            "token: {}".format(len(report["oov"]), report["oov"])
+        )
+    return report
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    from fms_ehrs.framework.synthetic import generate_clif
+
+    def subset(src: pathlib.Path, dst: pathlib.Path, ids: list[str]) -> None:
+        dst.mkdir()
+        hosp = pl.read_parquet(next(src.glob("*_hospitalization.parquet")))
+        for p in src.glob("*.parquet"):
+            x = pl.read_parquet(p)
+            if "hospitalization_id" in x.columns:
+                x = x.filter(pl.col("hospitalization_id").is_in(ids))
+            else:
+                x = x.join(
+                    hosp.filter(pl.col("hospitalization_id").is_in(ids)),
+                    on="patient_id",
+                    how="semi",
+                )
+            x.write_parquet(dst.joinpath(p.name))
+
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        generate_clif(d.joinpath("all"), n_hospitalizations=100, seed=0)
+        ids = [f"H{i}" for i in range(100)]
+        subset(d.joinpath("all"), d.joinpath("old"), ids[:60])
+        subset(d.joinpath("all"), d.joinpath("delta"), ids[50:])
+
+        tkzr = ClifTokenizer(data_dir=d.joinpath("old"), max_padded_len=256)
+        tkzr.pad_and_truncate(tkzr.get_tokens_timelines()).write_parquet(
+            f := d.joinpath("tokens_timelines.parquet")
+        )
+        tkzr.vocab.save(v := d.joinpath("vocab.gzip"))
+
+        rep = append_tokens_timelines(
+            d.joinpath("delta"), f, vocab_path=v, max_padded_len=256
+        )
+        assert (rep["new"], rep["changed"], rep["unchanged"]) == (40, 0, 10)
+        full = ClifTokenizer(
+            data_dir=d.joinpath("all"), vocab_path=v, max_padded_len=256
+        )
+        assert full.pad_and_truncate(full.get_tokens_timelines()).equals(
+            pl.read_parquet(f)
+        )
+
+        rep = append_tokens_timelines(
+            d.joinpath("delta"), f, vocab_path=v, max_padded_len=256
+        )
+        assert rep["unchanged"] == rep["delta"] == 50 and rep["tokenized"] == 0
+
+        x = pl.read_parquet(p := next(d.joinpath("delta").glob("*_vitals.parquet")))
+        x.with_columns(
+            vital_value=pl.when(pl.col("hospitalization_id") == "H99")
+            .then(pl.col("vital_value") + 1)
+            .otherwise(pl.col("vital_value"))
+        ).write_parquet(p)
+        rep = append_tokens_timelines(
+            d.joinpath("delta"), f, vocab_path=v, max_padded_len=256
+        )
+        assert (rep["new"], rep["changed"], rep["unchanged"]) == (0, 1, 49)
+
+        # the same append, when only the compact version of the file was kept
+        d.joinpath("compact").mkdir()
+        g = d.joinpath("compact", f.name)
+        tkzr.write_compact(pl.read_parquet(f), compact_dir(g))
+        shutil.copy(hashes_file(f), hashes_file(g))
+        x = pl.read_parquet(p)
+        x.with_columns(
+            vital_value=pl.when(pl.col("hospitalization_id") == "H98")
+            .then(pl.col("vital_value") + 1)
+            .otherwise(pl.col("vital_value"))
+        ).write_parquet(p)
+        for x in (f, g):
+            rep = append_tokens_timelines(
+                d.joinpath("delta"), x, vocab_path=v, max_padded_len=256
+            )
+            assert (rep["new"], rep["changed"], rep["unchanged"]) == (0, 1, 49)
+        assert not g.exists()
+        assert scan_tokens_timelines(g).collect().equals(pl.read_parquet(f))
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+"""
+tokenizes a stream of CLIF rows for a single hospitalization as they arrive,
+e.g. for scoring at the bedside, using a frozen vocabulary and the cut points
+stored with it; rows are handled one at a time in plain python (dictionary
+lookups and a fixed number of comparisons per row), and the resulting
+timeline matches what `ClifTokenizer` would produce for the same rows
+"""
+
+import datetime
+import os
+import pathlib
+import typing
+
+import numpy as np
+
+from fms_ehrs.framework.tables import TABLE_PROCESSORS
+from fms_ehrs.framework.vocabulary import Vocabulary
+
+Pathlike: typing.TypeAlias = pathlib.PurePath | str | os.PathLike
+Row: typing.TypeAlias = typing.Mapping[str, typing.Any]
+
+
+def _word(x: str | None, *, replace_spaces: bool = True) -> str:
+    """lowercase categorical value as it appears in a vocabulary word"""
+    if x is None:
+        return "None"
+    x = str(x).lower()
+    return x.replace(" ", "_") if replace_spaces else x
+
+
+def _ms(t: datetime.datetime) -> datetime.datetime:
+    """truncate to milliseconds, the resolution of the batch tokenizer"""
+    return t.replace(microsecond=t.microsecond // 1000 * 1000)
+
+
+class OnlineClifTokenizer:
+    """
+    usage:
+    ```
+    otk = OnlineClifTokenizer(vocab_path)
+    otk.admit(patient_row, hospitalization_row)
+    for table, row in stream:
+        new_tokens = otk.push(table, row)
+    otk.discharge()
+    ```
+    `table` is the name of a CLIF table as in `fms_ehrs.framework.tables`
+    ("adt", "labs", "vitals", "medication", "assessments", "respiratory",
+    "position", "measurements") and `row` maps its column names to values;
+    concurrent events are ordered as in `ClifTokenizer.get_events_frame` (by
+    first token, then table, then arrival), so the tokens of an event are only
+    returned once a row with a later time arrives (or at discharge); `tokens`
+    and `times` always hold the timeline so far, including such pending
+    events; rows arriving later than events already returned are appended as
+    they come; as in `ClifTokenizer.run_times_qc`, the timeline starts at the
+    earlier of admission and the first vital sign and ends at the later of
+    discharge and the last vital sign (so the times of the admission tokens
+    move back if a vital sign predates admission), but hospitalizations are
+    not filtered on their length; `lab_time` and `fused_quantiles` should
+    match the options the vocabulary was learned with
+    """
+
+    def __init__(
+        self,
+        vocab: Vocabulary | Pathlike,
+        *,
+        lab_time: typing.Literal["collect", "result"] = "result",
+        fused_quantiles: bool = False,
+    ):
+        self.vocab = (
+            vocab if isinstance(vocab, Vocabulary) else Vocabulary().load(vocab)
+        )
+        self.vocab.is_training = False
+        self.lab_time = lab_time
+        self.fused_quantiles = bool(fused_quantiles)
+        self.lookup = self.vocab.lookup
+        self.null = self.lookup[None]
+        self.nan = self.lookup["nan"]
+        self.q_words = {
+            self.lookup[q]: q
+            for q in (
+                *(f"Q{i}" for i in range(10)),
+                "Q3-",
+                "Q2-",
+                "Q1-",
+                "Q0-",
+                "Q0+",
+                "Q1+",
+                "Q2+",
+                "Q3+",
+            )
+            if q in self.lookup
+        }
+        self.table_rank = {t: i for i, t in enumerate(TABLE_PROCESSORS.keys())}
+        self.reports = (
+            set(self.vocab.get_aux("ECG_machine_measurements"))
+            if self.vocab.has_aux("ECG_machine_measurements")
+            else set()
+        )
+        self._cuts: dict[str, tuple[int, list[float]] | None] = dict()
+        self.reset()
+
+    def reset(self) -> None:
+        self.hospitalization = dict()
+        self._tokens: list[int] = list()
+        self._times: list[datetime.datetime] = list()
+        self._pending: list[tuple] = list()
+        self._pending_time = None
+        self._n_admission = 0
+        self._vitals_end = None
+        self._seq = 0
+
+    @property
+    def tokens(self) -> list[int]:
+        """the timeline so far, including pending events"""
+        return self._tokens + [tk for e in self._sorted_pending() for tk in e[4]]
+
+    @property
+    def times(self) -> list[datetime.datetime]:
+        """the times of `tokens`"""
+        return self._times + [e[3] for e in self._sorted_pending() for _ in e[4]]
+
+    def token(self, word: str) -> int:
+        """token for `word`, or the null token if it is not in the vocabulary"""
+        return self.lookup.get(word, self.null)
+
+    def cuts(self, designator: str) -> tuple[int, list[float]] | None:
+        """the token of `designator` and its cut points, computed on first use"""
+        if designator not in self._cuts:
+            self._cuts[designator] = (
+                (
+                    self.lookup[designator],
+                    [float(c) for c in self.vocab.get_aux(designator)],
+                )
+                if self.vocab.has_aux(designator) and designator in self.lookup
+                else None
+            )
+        return self._cuts[designator]
+
+    def category_value(self, label: str, category: str, value) -> list[int]:
+        """tokens for a measurement, as in `ClifTokenizer.process_cat_val_frame`"""
+        designator = f"{label}_{category}"
+        if (c := self.cuts(designator)) is None:
+            return []
+        if value is None or not np.isfinite(value):
+            return []
+        q = sum(cut <= value for cut in c[1])
+        if q in (self.null, self.nan):
+            return []
+        if self.fused_quantiles:
+            return [self.token(f"{designator}_{self.q_words[q]}")]
+        return [c[0], q]
+
+    def event_tokens(self, table: str, row: Row) -> tuple[datetime.datetime, list]:
+        """the time and tokens of the event recorded in `row` of `table`"""
+        if table == "adt":
+            return row["in_dttm"], [
+                self.token(
+                    "ADT_" + _word(row["location_category"], replace_spaces=False)
+                )
+            ]
+        elif table == "labs":
+            if row["lab_category"] is None:
+                return None, []
+            return row[f"lab_{self.lab_time}_dttm"], self.category_value(
+                "LAB",
+                _word(row["lab_category"], replace_spaces=False),
+                row["lab_value_numeric"],
+            )
+        elif table == "vitals":
+            return row["recorded_dttm"], self.category_value(
+                "VTL",
+                _word(row["vital_category"], replace_spaces=False),
+                row["vital_value"],
+            )
+        elif table == "medication":
+            return row["admin_dttm"], self.category_value(
+                "MED", _word(row["med_category"], replace_spaces=False), row["med_dose"]
+            )
+        elif table == "assessments":
+            if row["numerical_value"] is not None:
+                return row["recorded_dttm"], self.category_value(
+                    "ASMT",
+                    _word(row["assessment_category"], replace_spaces=False),
+                    row["numerical_value"],
+                )
+            if row["categorical_value"] is None:
+                return None, []
+            return row["recorded_dttm"], [
+                self.token("ASMT_cat_" + _word(row["assessment_category"])),
+                self.token("ASMT_val_" + _word(row["categorical_value"])),
+            ]
+        elif table == "respiratory":
+            return row["recorded_dttm"], [
+                self.token("RESP_mode_" + _word(row["mode_category"])),
+                self.token("RESP_devc_" + _word(row["device_category"])),
+            ]
+        elif table == "position":
+            if row["position_category"] != "prone":
+                return None, []
+            return row["recorded_dttm"], [self.token("POSN_prone")]
+        elif table == "measurements":
+            reports = (
+                str(r).strip(" .").upper()
+                for r in (row.get(f"report_{i}") for i in range(18))
+                if r is not None
+            )
+            return row["event_dttm"], [
+                self.token("ECG_" + r.replace(" ", "_"))
+                for r in reports
+                if r in self.reports
+            ]
+        raise ValueError(f"Unsupported table {table=}")
+
+    def admit(self, patient: Row, hospitalization: Row) -> list[int]:
+        """start the timeline of `hospitalization` and return its admission
+        tokens (patient demographics, age, and admission type)"""
+        self.reset()
+        self.hospitalization = dict(hospitalization)
+        age = hospitalization["age_at_admission"]
+        if not self.vocab.has_aux("age_at_admission"):
+            age_token = self.null
+        elif age is None or not np.isfinite(age):
+            age_token = self.nan
+        else:
+            age_token = int(
+                np.digitize(age, bins=self.vocab.get_aux("age_at_admission"))
+            )
+        tokens = [
+            self.lookup["TL_START"],
+            self.token("RACE_" + _word(patient["race_category"])),
+            self.token("ETHN_" + _word(patient["ethnicity_category"])),
+            self.token("SEX_" + _word(patient["sex_category"])),
+            age_token,
+            self.token("ADMN_" + _word(hospitalization["admission_type_name"])),
+        ]
+        self._tokens += tokens
+        self._times += [_ms(hospitalization["admission_dttm"])] * len(tokens)
+        self._n_admission = len(tokens)
+        return tokens
+
+    def push(self, table: str, row: Row) -> list[int]:
+        """add the event recorded in `row` of `table`; returns the tokens that
+        became final, in timeline order"""
+        t, tokens = self.event_tokens(table, row)
+        if not tokens:
+            return []
+        t = _ms(t)
+        if table == "vitals":
+            self._track_vitals(t)
+        event = (
+            tokens[0],
+            self.table_rank.get(table, len(self.table_rank)),
+            self._seq,
+            t,
+            tokens,
+        )
+        self._seq += 1
+        if self._pending_time is not None and t < self._pending_time:
+            self._insert_final([event])
+            return tokens
+        out = list()
+        if self._pending_time is not None and t > self._pending_time:
+            out = self._flush()
+        self._pending.append(event)
+        self._pending_time = t
+        return out
+
+    def discharge(self, discharge_category: str = None) -> list[int]:
+        """close the timeline, returning the remaining event tokens followed by
+        the discharge tokens"""
+        out = self._flush()
+        h = self.hospitalization
+        tokens = [
+            self.token(
+                "DSCG_"
+                + _word(
+                    discharge_category
+                    if discharge_category is not None
+                    else h.get("discharge_category")
+                )
+            ),
+            self.lookup["TL_END"],
+        ]
+        end = _ms(h["discharge_dttm"])
+        if self._vitals_end is not None:
+            end = max(end, self._vitals_end)
+        self._tokens += tokens
+        self._times += [end] * len(tokens)
+        return out + tokens
+
+    def _track_vitals(self, t: datetime.datetime) -> None:
+        """widen the timeline to include a vital sign at time `t`"""
+        if self._n_admission and t < self._times[0]:
+            # the admission tokens are the first ones of the timeline
+            self._times[: self._n_admission] = [t] * self._n_admission
+        if self._vitals_end is None or t > self._vitals_end:
+            self._vitals_end = t
+
+    def _insert_final(self, events: list[tuple]) -> None:
+        """append `events` to the final part of the timeline, ahead of any
+        pending events"""
+        for e in events:
+            self._tokens += e[4]
+            self._times += [e[3]] * len(e[4])
+
+    def _sorted_pending(self) -> list[tuple]:
+        """the pending events in timeline order; they are kept in order of
+        arrival so that adding one takes constant time"""
+        return sorted(self._pending, key=lambda x: x[:3])
+
+    def _flush(self) -> list[int]:
+        events = self._sorted_pending()
+        self._pending, self._pending_time = list(), None
+        self._insert_final(events)
+        return [tk for e in events for tk in e[4]]
+
+
+if __name__ == "__main__":
+    import collections
+    import tempfile
+
+    import polars as pl
+
+    from fms_ehrs.framework.synthetic import generate_clif
+    from fms_ehrs.framework.tokenizer import ClifTokenizer
+
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        generate_clif(d, n_hospitalizations=200, seed=0)
+        # move some vital signs outside of their stays, so that timelines widen
+        vitals = pl.read_parquet(f := d.joinpath("clif_vitals.parquet"))
+        i = pl.int_range(pl.len())
+        vitals.with_columns(
+            recorded_dttm=pl.when(i % 97 == 0)
+            .then(pl.col("recorded_dttm") - pl.duration(days=30))
+            .when(i % 97 == 1)
+            .then(pl.col("recorded_dttm") + pl.duration(days=30))
+            .otherwise(pl.col("recorded_dttm"))
+        ).write_parquet(f)
+        tkzr = ClifTokenizer(data_dir=d)
+        tt = tkzr.get_tokens_timelines()
+        tkzr.vocab.save(v := d.joinpath("vocab.gzip"))
+
+        files = {
+            "adt": "clif_adt",
+            "labs": "clif_labs",
+            "vitals": "clif_vitals",
+            "medication": "clif_medication_admin_continuous",
+            "assessments": "clif_patient_assessments",
+            "respiratory": "clif_respiratory_support",
+            "position": "clif_position",
+        }
+        times = {
+            "adt": "in_dttm",
+            "labs": "lab_result_dttm",
+            "medication": "admin_dttm",
+        }
+        events = collections.defaultdict(list)
+        for t, f in files.items():
+            for r in pl.read_parquet(d.joinpath(f"{f}.parquet")).iter_rows(named=True):
+                events[r["hospitalization_id"]].append(
+                    (_ms(r[times.get(t, "recorded_dttm")]), t, r)
+                )
+        patients = {
+            r["patient_id"]: r
+            for r in pl.read_parquet(d.joinpath("clif_patient.parquet")).iter_rows(
+                named=True
+            )
+        }
+        hosps = {
+            r["hospitalization_id"]: r
+            for r in pl.read_parquet(
+                d.joinpath("clif_hospitalization.parquet")
+            ).iter_rows(named=True)
+        }
+
+        otk = OnlineClifTokenizer(v)
+        for h, tokens, times in tt.select(
+            "hospitalization_id", "tokens", "times"
+        ).iter_rows():
+            out = otk.admit(patients[hosps[h]["patient_id"]], hosps[h])
+            for _, table, row in sorted(events[h], key=lambda e: e[0]):
+                out += otk.push(table, row)
+            out += otk.discharge()
+            assert out == otk.tokens == tokens, h
+            assert otk.times == times, h
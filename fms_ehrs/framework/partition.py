@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+"""
+partitions a directory of CLIF tables into one sub-directory per split (or
+fold) in a single pass over each table: every patient is given a split label
+once, and each table is then streamed in record batches, with the rows of each
+batch routed to an open parquet writer per split, so that no table is read
+more than once or held in memory in full
+"""
+
+import os
+import pathlib
+import typing
+
+import polars as pl
+import pyarrow.parquet as pq
+
+Pathlike: typing.TypeAlias = pathlib.PurePath | str | os.PathLike
+
+
+def split_names(
+    scheme: typing.Literal["ordered", "kfold", "time"] = "ordered", n_folds: int = 5
+) -> tuple[str, ...]:
+    """names of the splits produced by `patient_splits` for `scheme`"""
+    if scheme == "kfold":
+        return tuple(f"fold_{i}" for i in range(n_folds))
+    return ("train", "val", "test")
+
+
+def patient_splits(
+    hospitalizations: pl.LazyFrame,
+    *,
+    scheme: typing.Literal["ordered", "kfold", "time"] = "ordered",
+    train_frac: float = 0.7,
+    val_frac: float = 0.1,
+    n_folds: int = 5,
+    split_dates: tuple[str, str] = None,
+) -> pl.DataFrame:
+    """
+    assign each patient of `hospitalizations` (with columns `patient_id` and
+    `admission_dttm`) to a split, in order of first admission: with "ordered",
+    the first `train_frac` of patients go to train, the next `val_frac` to val,
+    and the rest to test; with "kfold", patients are dealt round-robin into
+    `n_folds` folds; with "time", patients first admitted before
+    `split_dates[0]` go to train, before `split_dates[1]` to val, and the rest
+    to test
+    """
+    p = (
+        hospitalizations.group_by("patient_id")
+        .agg(first_admission=pl.col("admission_dttm").min())
+        .sort("first_admission", "patient_id")
+        .collect()
+        .with_row_index("i")
+    )
+    n_total = p.height
+    if scheme == "ordered":
+        n_train = int(train_frac * n_total)
+        n_val = int(val_frac * n_total)
+        if n_train + n_val > n_total:
+            raise ValueError(f"check {train_frac=} and {val_frac=}")
+        split = (
+            pl.when(pl.col("i") < n_train)
+            .then(pl.lit("train"))
+            .when(pl.col("i") < n_train + n_val)
+            .then(pl.lit("val"))
+            .otherwise(pl.lit("test"))
+        )
+    elif scheme == "kfold":
+        split = pl.format("fold_{}", pl.col("i") % n_folds)
+    elif scheme == "time":
+        if split_dates is None:
+            raise ValueError("A time-based split requires split_dates")
+        split = (
+            pl.when(pl.col("first_admission") < pl.lit(split_dates[0]).cast(pl.Date))
+            .then(pl.lit("train"))
+            .when(pl.col("first_admission") < pl.lit(split_dates[1]).cast(pl.Date))
+            .then(pl.lit("val"))
+            .otherwise(pl.lit("test"))
+        )
+    else:
+        raise ValueError(f"Unsupported {scheme=}")
+    return p.select("patient_id", split=split)
+
+
+def write_split_table(
+    in_file: Pathlike,
+    labels: pl.DataFrame,
+    out_files: dict[str, Pathlike],
+    *,
+    batch_size: int = 1 << 20,
+) -> dict[str, int]:
+    """
+    write the rows of `in_file` to `out_files[split]` according to `labels`, a
+    frame of one key column (`hospitalization_id` or `patient_id`) and
+    `split`; rows without a label are dropped, and every split gets a file
+    (possibly empty); returns the number of rows written to each split
+    """
+    key = labels.drop("split").columns[0]
+    empty = pl.scan_parquet(in_file).clear().collect()
+    labels = labels.cast({key: empty.schema[key]})
+    schema = empty.to_arrow().schema
+    writers = dict()
+    n_rows = dict.fromkeys(out_files.keys(), 0)
+    try:
+        for batch in pq.ParquetFile(in_file).iter_batches(batch_size=batch_size):
+            x = pl.from_arrow(batch).join(
+                labels, on=key, how="inner", maintain_order="left"
+            )
+            for (s,), part in x.partition_by(
+                "split", as_dict=True, include_key=False
+            ).items():
+                if s not in writers:
+                    writers[s] = pq.ParquetWriter(out_files[s], schema)
+                writers[s].write_table(part.to_arrow().cast(schema))
+                n_rows[s] += part.height
+    finally:
+        for w in writers.values():
+            w.close()
+    for s, f in out_files.items():
+        if s not in writers:
+            empty.write_parquet(f)
+    return n_rows
+
+
+def write_splits(
+    data_dir_in: Pathlike,
+    dirs_out: dict[str, Pathlike],
+    splits: pl.DataFrame,
+    *,
+    batch_size: int = 1 << 20,
+) -> dict[str, dict[str, int]]:
+    """
+    partition every table of `data_dir_in` into `dirs_out[split]` (under the
+    same file name), reading each table once; `splits` holds the split of each
+    retained hospitalization (columns `patient_id`, `hospitalization_id`, and
+    `split`); tables with a `hospitalization_id` are partitioned by
+    hospitalization, and the patient table by patient; returns the number of
+    rows written per table and split
+    """
+    data_dir_in = pathlib.Path(data_dir_in).expanduser().resolve()
+    labels = {
+        k: splits.select(k, "split").unique(maintain_order=True)
+        for k in ("hospitalization_id", "patient_id")
+    }
+    counts = dict()
+    for t in sorted(data_dir_in.glob("*.parquet")):
+        names = pl.read_parquet_schema(t).keys()
+        key = next((k for k in labels if k in names), None)
+        if key is None:
+            continue
+        counts[t.stem] = write_split_table(
+            t,
+            labels[key],
+            {
+                s: pathlib.Path(d).expanduser().resolve().joinpath(t.name)
+                for s, d in dirs_out.items()
+            },
+            batch_size=batch_size,
+        )
+    return counts
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    from fms_ehrs.framework.synthetic import generate_clif
+
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        generate_clif(d.joinpath("in"), n_hospitalizations=100, seed=0)
+        hosp = pl.scan_parquet(d.joinpath("in", "clif_hospitalization.parquet"))
+
+        for scheme in ("ordered", "kfold", "time"):
+            p = patient_splits(
+                hosp, scheme=scheme, n_folds=3, split_dates=("2110-09-01", "2111-03-01")
+            )
+            splits = (
+                hosp.select("patient_id", "hospitalization_id")
+                .unique()
+                .collect()
+                .join(p, on="patient_id")
+            )
+            dirs_out = {s: d.joinpath(scheme, s) for s in split_names(scheme, 3)}
+            for x in dirs_out.values():
+                x.mkdir(parents=True)
+            counts = write_splits(d.joinpath("in"), dirs_out, splits, batch_size=64)
+
+            for t in d.joinpath("in").glob("*.parquet"):
+                x = pl.read_parquet(t)
+                key = (
+                    "hospitalization_id"
+                    if "hospitalization_id" in x.columns
+                    else "patient_id"
+                )
+                for s, o in dirs_out.items():
+                    ids = splits.filter(pl.col("split") == s).get_column(key)
+                    y = pl.read_parquet(o.joinpath(t.name))
+                    assert y.equals(x.filter(pl.col(key).is_in(ids))), (scheme, t, s)
+                    assert counts[t.stem][s] == y.height
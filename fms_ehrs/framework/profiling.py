@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""
+records wall time, cpu time, peak resident memory, and row / token counts for
+the stages of a pipeline, logs them as they finish, and writes them to a json
+report; lazy query plans can optionally be dumped alongside
+"""
+
+import contextlib
+import datetime
+import json
+import logging
+import os
+import pathlib
+import resource
+import time
+import typing
+
+import polars as pl
+
+from fms_ehrs.framework.logger import get_logger
+from fms_ehrs.framework.storage import fix_perms
+
+Frame: typing.TypeAlias = pl.DataFrame | pl.LazyFrame
+Pathlike: typing.TypeAlias = pathlib.PurePath | str | os.PathLike
+
+
+def peak_rss_mib() -> float:
+    """high-water mark of resident memory for this process, in MiB"""
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss() -> bool:
+    """reset the high-water mark (linux only); returns whether this worked"""
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def frame_counts(x: Frame) -> dict[str, int]:
+    """number of rows (and of tokens, if present) of a materialized frame;
+    lazy frames are not collected for this purpose"""
+    if not isinstance(x, pl.DataFrame):
+        return dict()
+    counts = {"rows": x.height}
+    if isinstance(x.schema.get("tokens"), pl.List):
+        counts["tokens"] = int(x.get_column("tokens").list.len().sum())
+    return counts
+
+
+class StageProfiler:
+    """
+    usage:
+    ```
+    prof = StageProfiler()
+    with prof.stage("load_tables") as rec:
+        ...
+        rec.update(frame_counts(df))
+    prof.write_report("report.json")
+    ```
+    stages may be nested, in which case their names are joined with a "/";
+    peak memory is tracked per stage where the kernel allows the high-water
+    mark to be reset, and is otherwise the peak of the process so far; if not
+    `enabled`, stages are not timed, logged, or recorded
+    """
+
+    def __init__(
+        self,
+        *,
+        enabled: bool = True,
+        plans_dir: Pathlike = None,
+        logger: logging.Logger = None,
+    ):
+        self.enabled = enabled
+        self.plans_dir = (
+            pathlib.Path(plans_dir).expanduser().resolve()
+            if plans_dir is not None
+            else None
+        )
+        self.logger = logger if logger is not None else get_logger()
+        self.records: list[dict] = list()
+        self._open: list[dict] = list()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **info) -> typing.Iterator[dict]:
+        """time the enclosed block; the yielded record may be updated with
+        counts or other information to be reported"""
+        rec = dict(
+            stage="/".join([r["stage"] for r in self._open[-1:]] + [name]), **info
+        )
+        if not self.enabled:
+            yield rec
+            return
+        self._track_peak()
+        rec["peak_rss_mib"] = 0.0
+        self._open.append(rec)
+        rec["per_stage_rss"] = reset_peak_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield rec
+        finally:
+            rec["wall_s"] = time.perf_counter() - wall
+            rec["cpu_s"] = time.process_time() - cpu
+            self._track_peak()
+            self._open.pop()
+            self.records.append(rec)
+            self.logger.info(
+                "{stage}: {wall_s:.2f}s wall, {cpu_s:.2f}s cpu, "
+                "{peak_rss_mib:.0f} MiB peak rss".format(**rec)
+                + "".join(f", {k}={rec[k]:,}" for k in ("rows", "tokens") if k in rec)
+            )
+
+    def _track_peak(self) -> None:
+        peak = peak_rss_mib()
+        for r in self._open:
+            r["peak_rss_mib"] = max(r["peak_rss_mib"], peak)
+
+    def explain(self, name: str, x: Frame) -> None:
+        """write the optimized query plan of lazy frame `x` to `plans_dir`"""
+        if self.enabled and self.plans_dir is not None and isinstance(x, pl.LazyFrame):
+            self.plans_dir.mkdir(exist_ok=True, parents=True)
+            f = self.plans_dir.joinpath(name.replace("/", "-") + ".txt")
+            f.write_text(x.explain())
+            fix_perms(f)
+
+    def collect(self, x: Frame, rec: dict) -> Frame:
+        """
+        when enabled, dump the plan of `x` and materialize it, so that its cost
+        is attributed to the stage of `rec` rather than to whichever later
+        stage would otherwise collect it; when disabled, `x` is returned as is
+        """
+        if not self.enabled:
+            return x
+        self.explain(rec["stage"], x)
+        x = x.lazy().collect()
+        rec.update(frame_counts(x))
+        return x
+
+    def report(self) -> dict:
+        return {
+            "created": datetime.datetime.now().astimezone().isoformat(),
+            "host": os.uname().nodename,
+            "polars_version": pl.__version__,
+            "polars_threads": pl.thread_pool_size(),
+            "stages": self.records,
+        }
+
+    def write_report(self, path: Pathlike) -> pathlib.Path:
+        path = pathlib.Path(path).expanduser().resolve()
+        with open(path, "w") as fp:
+            json.dump(self.report(), fp, indent=2)
+        fix_perms(path)
+        return path
+
+    def reset(self) -> None:
+        self.records = list()
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    import numpy as np
+
+    prof = StageProfiler()
+    with prof.stage("outer") as rec:
+        with prof.stage("alloc") as r:
+            x = np.ones(2**27, dtype=np.uint8)
+            r.update(rows=x.size)
+        del x
+        df = pl.DataFrame({"tokens": [[1, 2, 3], [4]]})
+        rec.update(frame_counts(df))
+    assert [r["stage"] for r in prof.records] == ["outer/alloc", "outer"]
+    assert prof.records[1]["peak_rss_mib"] >= prof.records[0]["peak_rss_mib"] >= 128
+    assert prof.records[1]["tokens"] == 4
+    with tempfile.TemporaryDirectory() as d:
+        prof.write_report(pathlib.Path(d).joinpath("report.json"))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""
+provides mergeable summaries of streams of values, so that quantiles and
+moments can be learned one shard at a time
+"""
+
+import typing
+
+import numpy as np
+
+
+class QuantileSketch:
+    """
+    KLL-style quantile sketch: values are kept in a hierarchy of buffers,
+    where an item at level `h` stands for 2**h values of the stream; when a
+    buffer outgrows its capacity, it is sorted and every other item (starting
+    at a random offset) is promoted to the next level; with `k = 2 / eps`, the
+    rank error of a quantile query is on the order of `eps`, and as long as no
+    compaction has occurred the sketch is exact and agrees with `np.quantile`
+    """
+
+    def __init__(self, eps: float = 0.01, *, seed: int = 42, c: float = 2 / 3):
+        assert 0 < eps < 1
+        self.eps = eps
+        self.k = max(8, int(np.ceil(2 / eps)))
+        self.c = c
+        self.n = 0
+        self.levels: list[np.ndarray] = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def capacity(self, h: int) -> int:
+        return max(2, int(np.ceil(self.k * self.c ** (len(self.levels) - 1 - h))))
+
+    def update(self, values: typing.Iterable[float]) -> typing.Self:
+        """add a batch of `values` to the sketch; nan's are ignored"""
+        v = np.asarray(values, dtype=np.float64).ravel()
+        v = v[~np.isnan(v)]
+        self.n += v.size
+        self.levels[0] = np.concatenate((self.levels[0], v))
+        return self.compress()
+
+    def merge(self, other: "QuantileSketch") -> typing.Self:
+        """absorb `other` into this sketch"""
+        for h, lvl in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[h] = np.concatenate((self.levels[h], lvl))
+        self.n += other.n
+        return self.compress()
+
+    def compress(self) -> typing.Self:
+        h = 0
+        while h < len(self.levels):
+            if self.levels[h].size > self.capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                buf = np.sort(self.levels[h])
+                # an odd item out stays behind so that total weight is preserved
+                keep, buf = buf[: buf.size % 2], buf[buf.size % 2 :]
+                promoted = buf[self.rng.integers(2) :: 2]
+                self.levels[h] = keep
+                self.levels[h + 1] = np.concatenate((self.levels[h + 1], promoted))
+            h += 1
+        return self
+
+    def quantiles(self, q: np.ndarray) -> np.ndarray:
+        """
+        approximate quantiles `q` of the values seen so far, interpolating
+        linearly between ranks as `np.nanquantile` does
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if self.n == 0:
+            return np.full(q.shape, np.nan)
+        if len(self.levels) == 1:
+            return np.quantile(self.levels[0], q)
+        v = np.concatenate(self.levels)
+        w = np.concatenate(
+            [np.full(lvl.size, 2.0**h) for h, lvl in enumerate(self.levels)]
+        )
+        srt = np.argsort(v, kind="stable")
+        v, w = v[srt], w[srt]
+        # each item covers a run of `w` consecutive ranks; place it at the centre
+        centres = np.cumsum(w) - (w + 1) / 2
+        return np.interp(q * (w.sum() - 1), centres, v)
+
+    def __len__(self) -> int:
+        return self.n
+
+
+class Moments:
+    """
+    mergeable count, mean, and sum of squared deviations of a stream of
+    values (Chan et al.'s parallel update), giving the mean and population
+    standard deviation without storing the values
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values: typing.Iterable[float]) -> typing.Self:
+        """add a batch of `values`; nan's are ignored"""
+        v = np.asarray(values, dtype=np.float64).ravel()
+        v = v[~np.isnan(v)]
+        other = Moments()
+        if v.size:
+            other.n, other.mean = v.size, v.mean()
+            other.m2 = np.sum((v - other.mean) ** 2)
+        return self.merge(other)
+
+    def merge(self, other: "Moments") -> typing.Self:
+        n = self.n + other.n
+        if n > 0:
+            δ = other.mean - self.mean
+            self.mean += δ * other.n / n
+            self.m2 += other.m2 + δ**2 * self.n * other.n / n
+            self.n = n
+        return self
+
+    @property
+    def std(self) -> float:
+        return np.sqrt(self.m2 / self.n) if self.n > 0 else np.nan
+
+    def __len__(self) -> int:
+        return self.n
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(42)
+    q = np.arange(0.1, 1.0, 0.1)
+
+    x = rng.lognormal(size=10**6)
+    eps = 0.01
+    sk = QuantileSketch(eps=eps)
+    for chunk in np.array_split(x, 37):
+        sk.merge(QuantileSketch(eps=eps).update(chunk))
+    ranks = np.searchsorted(np.sort(x), sk.quantiles(q)) / x.size
+    print(f"{len(sk.levels)=}, max rank error = {np.abs(ranks - q).max():.5f}")
+    assert np.abs(ranks - q).max() < eps
+
+    y = rng.normal(size=50)
+    assert np.allclose(QuantileSketch().update(y).quantiles(q), np.nanquantile(y, q))
+
+    m = Moments()
+    for chunk in np.array_split(x, 10):
+        m.merge(Moments().update(chunk))
+    assert np.isclose(m.mean, x.mean()) and np.isclose(m.std, x.std())
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+
+"""
+generates seeded, synthetic data in the shape of the CLIF-2.0 standard, for
+exercising and benchmarking the tokenizer without access to real extracts;
+event tables are built from "sessions" (a lab draw, a round of vitals, ...)
+that occur at a per-day rate over each stay and record several categories at
+once, so that timelines contain runs of concurrent events as real data do
+"""
+
+import os
+import pathlib
+import typing
+
+import numpy as np
+import polars as pl
+
+Generator: typing.TypeAlias = np.random._generator.Generator
+Pathlike: typing.TypeAlias = pathlib.PurePath | str | os.PathLike
+
+# category: (probability of being recorded in a session, mean, sd, log-scale)
+LABS = {
+    "albumin": (0.3, 3.2, 0.6, False),
+    "alkaline_phosphatase": (0.3, 4.6, 0.5, True),
+    "alt": (0.3, 3.4, 0.8, True),
+    "ast": (0.3, 3.5, 0.8, True),
+    "basophils_percent": (0.4, 0.4, 0.3, False),
+    "bicarbonate": (0.9, 24.0, 4.0, False),
+    "bilirubin_total": (0.3, -0.2, 0.8, True),
+    "bun": (0.9, 2.9, 0.6, True),
+    "calcium_total": (0.8, 8.6, 0.7, False),
+    "chloride": (0.9, 103.0, 5.0, False),
+    "creatinine": (0.9, 0.1, 0.6, True),
+    "eosinophils_percent": (0.4, 1.5, 1.4, False),
+    "glucose_serum": (0.9, 4.8, 0.3, True),
+    "hemoglobin": (0.8, 10.5, 2.0, False),
+    "inr": (0.3, 0.3, 0.3, True),
+    "lactate": (0.2, 0.6, 0.6, True),
+    "lymphocytes_percent": (0.4, 16.0, 9.0, False),
+    "magnesium": (0.7, 2.0, 0.3, False),
+    "monocytes_percent": (0.4, 7.5, 3.0, False),
+    "neutrophils_percent": (0.4, 74.0, 11.0, False),
+    "pco2_arterial": (0.15, 40.0, 8.0, False),
+    "ph_arterial": (0.15, 7.38, 0.07, False),
+    "phosphate": (0.6, 3.5, 1.1, False),
+    "platelet_count": (0.8, 5.3, 0.5, True),
+    "po2_arterial": (0.15, 4.5, 0.4, True),
+    "potassium": (0.9, 4.1, 0.5, False),
+    "pt": (0.3, 2.6, 0.2, True),
+    "ptt": (0.3, 3.5, 0.3, True),
+    "sodium": (0.9, 138.0, 4.5, False),
+    "troponin_t": (0.1, -3.5, 1.5, True),
+    "wbc": (0.8, 2.2, 0.5, True),
+}
+VITALS = {
+    "dbp": (0.95, 65.0, 13.0, False),
+    "heart_rate": (0.98, 87.0, 18.0, False),
+    "height_cm": (0.02, 170.0, 10.0, False),
+    "map": (0.9, 80.0, 14.0, False),
+    "respiratory_rate": (0.95, 19.0, 5.0, False),
+    "sbp": (0.95, 121.0, 21.0, False),
+    "spo2": (0.97, 96.5, 2.5, False),
+    "temp_c": (0.5, 36.9, 0.6, False),
+    "weight_kg": (0.05, 4.4, 0.25, True),
+}
+MEDS = {
+    "dexmedetomidine": (0.2, 0.5, 0.4, True),
+    "dobutamine": (0.03, 1.5, 0.5, True),
+    "epinephrine": (0.05, -3.0, 0.8, True),
+    "fentanyl": (0.3, 4.0, 0.7, True),
+    "heparin": (0.4, 6.9, 0.5, True),
+    "insulin": (0.4, 1.0, 0.9, True),
+    "midazolam": (0.1, 1.0, 0.8, True),
+    "milrinone": (0.03, -1.0, 0.4, True),
+    "norepinephrine": (0.3, -2.5, 0.9, True),
+    "phenylephrine": (0.1, 0.0, 0.8, True),
+    "propofol": (0.3, 3.3, 0.6, True),
+    "vasopressin": (0.1, -3.5, 0.3, True),
+}
+ASSESSMENTS_NUMERICAL = {
+    "braden_total": (0.4, 15.0, 3.0, False),
+    "gcs_total": (0.7, 12.5, 3.0, False),
+    "pain_score": (0.5, 3.0, 3.0, False),
+    "rass": (0.5, -0.8, 1.6, False),
+}
+# category: (probability of being recorded in a session, possible values)
+ASSESSMENTS_CATEGORICAL = {
+    "cam_total": (0.4, ["Negative", "Positive", "Unable to Assess"]),
+    "pupil_reaction": (0.3, ["Brisk", "Sluggish", "Nonreactive"]),
+}
+LOCATIONS = ["ED", "Ward", "ICU", "Stepdown", "Procedural", "L&D", "Other"]
+MODES = [
+    "Assist Control-Volume Control",
+    "Pressure Control",
+    "Pressure Support/CPAP",
+    "SIMV",
+    "Other",
+    None,
+]
+DEVICES = [
+    "IMV",
+    "NIPPV",
+    "CPAP",
+    "High Flow NC",
+    "Face Mask",
+    "Trach Collar",
+    "Nasal Cannula",
+    "Room Air",
+]
+
+# table: (share of hospitalizations with any records, sessions per day)
+SESSIONS = {
+    "adt": (1.0, 0.6),
+    "labs": (1.0, 2.5),
+    "vitals": (1.0, 14.0),
+    "medication_admin_continuous": (0.35, 8.0),
+    "patient_assessments": (0.9, 5.0),
+    "respiratory_support": (0.3, 4.0),
+    "position": (0.05, 2.0),
+}
+
+
+def default_events_per_day() -> float:
+    """expected number of records per hospitalization-day with default rates"""
+    per_session = {
+        "labs": sum(v[0] for v in LABS.values()),
+        "vitals": sum(v[0] for v in VITALS.values()),
+        "medication_admin_continuous": sum(v[0] for v in MEDS.values()),
+        "patient_assessments": sum(
+            v[0] for v in (ASSESSMENTS_NUMERICAL | ASSESSMENTS_CATEGORICAL).values()
+        ),
+    }
+    return sum(
+        share * rate * per_session.get(t, 1.0) for t, (share, rate) in SESSIONS.items()
+    )
+
+
+def sample_sessions(
+    rng: Generator,
+    start: np.ndarray,
+    los: np.ndarray,
+    *,
+    share: float,
+    rate: float,
+    resolution: np.timedelta64 = np.timedelta64(1, "m"),
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    for a `share` of stays (starting at `start` and lasting `los` days), draw a
+    Poisson(`rate` * `los`) number of sessions at uniformly random times
+    during the stay; returns the index of the stay and the time of each session
+    """
+    n = rng.poisson(rate * los) * (rng.random(los.size) < share)
+    idx = np.repeat(np.arange(los.size), n)
+    offset = (rng.random(idx.size) * los[idx] * 86_400e6).astype("timedelta64[us]")
+    t = start[idx] + offset
+    return idx, t - (t - np.datetime64(0, "us")) % resolution
+
+
+def sample_panel(
+    rng: Generator,
+    idx: np.ndarray,
+    t: np.ndarray,
+    spec: dict[str, tuple[float, float, float, bool]],
+    *,
+    p_null: float = 0.01,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    for each session (`idx`, `t`), record each category of `spec` with its
+    given probability and draw its value from a (log-)normal distribution;
+    returns stay index, time, category, and value for each record
+    """
+    cats = np.array(list(spec.keys()), dtype=object)
+    p, mu, sd, is_log = map(np.array, zip(*spec.values()))
+    sess, cat = np.nonzero(rng.random((idx.size, cats.size)) < p)
+    v = rng.normal(mu[cat], sd[cat])
+    v = np.round(np.where(is_log[cat], np.exp(v), v), 2)
+    v[rng.random(v.size) < p_null] = np.nan
+    return idx[sess], t[sess], cats[cat], v
+
+
+def generate_clif(
+    out_dir: Pathlike,
+    *,
+    n_hospitalizations: int = 1_000,
+    events_per_day: float = None,
+    seed: int = 42,
+) -> pathlib.Path:
+    """
+    write a synthetic CLIF-2.0 directory with `n_hospitalizations` stays to
+    `out_dir`; patients have 1.5 stays on average, stays last a log-normally
+    distributed number of days (median ~4), and event tables are scaled so
+    that there are `events_per_day` records per hospitalization-day in
+    expectation (by default, about 150)
+    """
+    out_dir = pathlib.Path(out_dir).expanduser().resolve()
+    out_dir.mkdir(exist_ok=True, parents=True)
+    rng = np.random.default_rng(seed)
+    scale = (
+        events_per_day / default_events_per_day() if events_per_day is not None else 1.0
+    )
+
+    n_h = n_hospitalizations
+    n_p = max(1, int(np.ceil(n_h / 1.5)))
+    patient_ids = np.char.add("P", np.arange(n_p).astype(str)).astype(object)
+    hosp_ids = np.char.add("H", np.arange(n_h).astype(str)).astype(object)
+
+    pl.DataFrame(
+        {
+            "patient_id": patient_ids,
+            "race_category": rng.choice(
+                [
+                    "White",
+                    "Black or African American",
+                    "Asian",
+                    "American Indian or Alaska Native",
+                    "Native Hawaiian or Other Pacific Islander",
+                    "Other",
+                    "Unknown",
+                ],
+                p=[0.62, 0.2, 0.05, 0.01, 0.01, 0.06, 0.05],
+                size=n_p,
+            ),
+            "ethnicity_category": rng.choice(
+                ["Non-Hispanic", "Hispanic", "Unknown"], p=[0.85, 0.1, 0.05], size=n_p
+            ),
+            "sex_category": rng.choice(["Female", "Male"], size=n_p),
+        }
+    ).write_parquet(out_dir.joinpath("clif_patient.parquet"))
+
+    patient_idx = rng.permutation(
+        np.concatenate(
+            (np.arange(min(n_p, n_h)), rng.integers(n_p, size=max(0, n_h - n_p)))
+        )
+    )
+    start = np.datetime64("2110-01-01T00:00", "us") + (
+        rng.random(n_h) * 3 * 365 * 86_400e6
+    ).astype("timedelta64[us]")
+    start -= (start - np.datetime64(0, "us")) % np.timedelta64(1, "m")
+    los = np.clip(rng.lognormal(mean=np.log(4), sigma=0.8, size=n_h), 0.25, 90)
+    end = start + (los * 86_400e6).astype("timedelta64[us]")
+    pl.DataFrame(
+        {
+            "patient_id": patient_ids[patient_idx],
+            "hospitalization_id": hosp_ids,
+            "admission_dttm": start,
+            "discharge_dttm": end,
+            "age_at_admission": np.clip(
+                np.round(rng.normal(62, 17, size=n_h)), 18, 100
+            ),
+            "admission_type_name": rng.choice(
+                ["Emergency", "Urgent", "Elective", "Observation"],
+                p=[0.6, 0.2, 0.15, 0.05],
+                size=n_h,
+            ),
+            "discharge_category": rng.choice(
+                [
+                    "Home",
+                    "Skilled Nursing Facility (SNF)",
+                    "Acute Inpatient Rehab Facility",
+                    "Hospice",
+                    "Expired",
+                    "Long Term Care Hospital (LTACH)",
+                    "Other",
+                ],
+                p=[0.62, 0.15, 0.05, 0.03, 0.06, 0.02, 0.07],
+                size=n_h,
+            ),
+        }
+    ).write_parquet(out_dir.joinpath("clif_hospitalization.parquet"))
+
+    def sessions(table: str) -> tuple[np.ndarray, np.ndarray]:
+        share, rate = SESSIONS[table]
+        return sample_sessions(rng, start, los, share=share, rate=rate * scale)
+
+    # every stay begins with a transfer, typically into the ED
+    idx, t = sessions("adt")
+    idx, t = np.concatenate((np.arange(n_h), idx)), np.concatenate((start, t))
+    loc = rng.choice(
+        LOCATIONS, p=[0.3, 0.4, 0.15, 0.07, 0.05, 0.02, 0.01], size=idx.size
+    )
+    loc[:n_h] = rng.choice(["ED", "Ward", "L&D"], p=[0.7, 0.25, 0.05], size=n_h)
+    pl.DataFrame(
+        {"hospitalization_id": hosp_ids[idx], "in_dttm": t, "location_category": loc}
+    ).write_parquet(out_dir.joinpath("clif_adt.parquet"))
+
+    idx, t, cat, v = sample_panel(rng, *sessions("labs"), LABS)
+    pl.DataFrame(
+        {
+            "hospitalization_id": hosp_ids[idx],
+            "lab_collect_dttm": t,
+            "lab_result_dttm": t
+            + (rng.lognormal(np.log(90), 0.6, size=idx.size) * 60e6).astype(
+                "timedelta64[us]"
+            ),
+            "lab_category": cat,
+            "lab_value_numeric": v,
+        }
+    ).write_parquet(out_dir.joinpath("clif_labs.parquet"))
+
+    idx, t, cat, v = sample_panel(rng, *sessions("vitals"), VITALS)
+    pl.DataFrame(
+        {
+            "hospitalization_id": hosp_ids[idx],
+            "recorded_dttm": t,
+            "vital_category": cat,
+            "vital_value": v,
+        }
+    ).write_parquet(out_dir.joinpath("clif_vitals.parquet"))
+
+    idx, t, cat, v = sample_panel(rng, *sessions("medication_admin_continuous"), MEDS)
+    pl.DataFrame(
+        {
+            "hospitalization_id": hosp_ids[idx],
+            "admin_dttm": t,
+            "med_category": cat,
+            "med_dose": v,
+        }
+    ).write_parquet(out_dir.joinpath("clif_medication_admin_continuous.parquet"))
+
+    s_idx, s_t = sessions("patient_assessments")
+    idx, t, cat, v = sample_panel(rng, s_idx, s_t, ASSESSMENTS_NUMERICAL)
+    num = pl.DataFrame(
+        {
+            "hospitalization_id": hosp_ids[idx],
+            "recorded_dttm": t,
+            "assessment_category": cat,
+            "numerical_value": np.round(v),
+            "categorical_value": None,
+        },
+        schema_overrides={"categorical_value": pl.String},
+    )
+    cats = list(ASSESSMENTS_CATEGORICAL.keys())
+    p = np.array([ASSESSMENTS_CATEGORICAL[c][0] for c in cats])
+    sess, c = np.nonzero(rng.random((s_idx.size, len(cats))) < p)
+    vals = np.array(
+        [
+            rng.choice(ASSESSMENTS_CATEGORICAL[cats[ci]][1], size=n)
+            for ci, n in enumerate(np.bincount(c, minlength=len(cats)))
+        ],
+        dtype=object,
+    )
+    order = np.argsort(c, kind="stable")
+    cv = np.empty(c.size, dtype=object)
+    cv[order] = np.concatenate(vals) if c.size else []
+    cat = pl.DataFrame(
+        {
+            "hospitalization_id": hosp_ids[s_idx[sess]],
+            "recorded_dttm": s_t[sess],
+            "assessment_category": np.array(cats, dtype=object)[c],
+            "numerical_value": None,
+            "categorical_value": cv,
+        },
+        schema_overrides={
+            "numerical_value": pl.Float64,
+            "categorical_value": pl.String,
+        },
+    )
+    pl.concat((num, cat)).sort("hospitalization_id", "recorded_dttm").write_parquet(
+        out_dir.joinpath("clif_patient_assessments.parquet")
+    )
+
+    idx, t = sessions("respiratory_support")
+    pl.DataFrame(
+        {
+            "hospitalization_id": hosp_ids[idx],
+            "recorded_dttm": t,
+            "mode_category": rng.choice(
+                np.array(MODES, dtype=object),
+                p=[0.25, 0.05, 0.15, 0.02, 0.03, 0.5],
+                size=idx.size,
+            ).tolist(),
+            "device_category": rng.choice(
+                DEVICES, p=[0.45, 0.08, 0.04, 0.1, 0.05, 0.03, 0.2, 0.05], size=idx.size
+            ),
+        },
+        schema_overrides={"mode_category": pl.String},
+    ).write_parquet(out_dir.joinpath("clif_respiratory_support.parquet"))
+
+    idx, t = sessions("position")
+    pl.DataFrame(
+        {
+            "hospitalization_id": hosp_ids[idx],
+            "recorded_dttm": t,
+            "position_category": rng.choice(
+                ["prone", "not_prone"], p=[0.4, 0.6], size=idx.size
+            ),
+        }
+    ).write_parquet(out_dir.joinpath("clif_position.parquet"))
+
+    return out_dir
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as d:
+        generate_clif(d, n_hospitalizations=200)
+        generate_clif(d + "-again", n_hospitalizations=200)
+        for f in sorted(pathlib.Path(d).glob("*.parquet")):
+            x = pl.read_parquet(f)
+            assert x.equals(pl.read_parquet(pathlib.Path(d + "-again", f.name)))
+            print(f"{f.stem}: {x.height} rows")
+        for f in pathlib.Path(d + "-again").glob("*.parquet"):
+            f.unlink()
+        pathlib.Path(d + "-again").rmdir()
+
+        # sharded training learns the same fused timelines as training in memory
+        from fms_ehrs.framework.tokenizer import ClifTokenizer
+
+        def words(tkzr, tt):
+            rev = tkzr.vocab.reverse
+            return [sorted(str(rev[t]) for t in x) for x in tt.get_column("tokens")]
+
+        kw = dict(data_dir=d, fused_quantiles=True, quantile_sketch_eps=1e-9)
+        tk_mem = ClifTokenizer(**kw)
+        tt_mem = tk_mem.pad_and_truncate(tk_mem.get_tokens_timelines())
+        tk_shd = ClifTokenizer(**kw)
+        tt_shd = pl.read_parquet(
+            tk_shd.write_tokens_timelines_sharded(
+                pathlib.Path(d, "sharded", "tokens_timelines.parquet"), n_parts=3
+            )
+        )
+        assert words(tk_shd, tt_shd) == words(tk_mem, tt_mem)
+        assert tk_shd.vocab(None) not in tt_shd.get_column("tokens").explode()
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+
+"""
+provides a registry of processors for the tables of the CLIF-2.0 standard;
+each processor splits the handling of its table into a vocabulary-independent
+lazy plan (`prepare`), which the tokenizer collects concurrently for all tables,
+and a step that turns the collected frame into tokens (`tokenize`), which the
+tokenizer runs one table at a time in order of registration so that token ids
+do not depend on scheduling; new tables are supported by registering a
+subclass of `TableProcessor`, e.g.
+
+@register_table_processor
+class Microbiology(TableProcessor):
+    table = "microbiology"
+    ...
+"""
+
+import abc
+import typing
+
+import polars as pl
+
+if typing.TYPE_CHECKING:
+    from fms_ehrs.framework.tokenizer import ClifTokenizer
+
+
+class TableProcessor(abc.ABC):
+    """
+    handles the table named `table` (the file `clif_{table}.parquet`);
+    `tokenize`, which subclasses must implement, should return the columns
+    `hospitalization_id`, `event_time`, `tokens`, and `times` for event tables;
+    tables marked `optional` are skipped if absent; with a frozen vocabulary,
+    `tokenize` may also be handed the lazy plan itself (see
+    `ClifTokenizer.tokens_timelines_plan`) and should then keep it lazy
+    """
+
+    table: str = None
+    optional: bool = False
+
+    def prepare(self, tkzr: "ClifTokenizer", x: pl.LazyFrame) -> pl.LazyFrame:
+        return x
+
+    @abc.abstractmethod
+    def tokenize(self, tkzr: "ClifTokenizer", x: pl.DataFrame) -> pl.DataFrame:
+        raise NotImplementedError
+
+    def finalize_training(self, tkzr: "ClifTokenizer") -> None:
+        """called once training has seen every shard (see
+        `ClifTokenizer.write_tokens_timelines_sharded`), to learn what depends
+        on statistics accumulated across shards"""
+
+
+TABLE_PROCESSORS: dict[str, TableProcessor] = dict()
+
+
+def register_table_processor(cls: type[TableProcessor]) -> type[TableProcessor]:
+    """add (or replace) the processor for `cls.table`; registration order
+    determines the order in which vocabulary is assigned"""
+    TABLE_PROCESSORS[cls.table] = cls()
+    return cls
+
+
+class CategoryValueProcessor(TableProcessor):
+    """tables that can be described in terms of categories and values, which
+    are then tokenized together under the prefix `label`"""
+
+    label: str = None
+
+    def tokenize(self, tkzr: "ClifTokenizer", x: pl.DataFrame) -> pl.DataFrame:
+        return tkzr.process_cat_val_frame(x, label=self.label).select(
+            "hospitalization_id", "event_time", "tokens", "times"
+        )
+
+
+@register_table_processor
+class Patient(TableProcessor):
+    table = "patient"
+
+    def prepare(self, tkzr, x):
+        return x.group_by("patient_id", maintain_order=True).agg(
+            pl.col(c).str.to_lowercase().str.replace_all(" ", "_").first()
+            for c in ("race_category", "ethnicity_category", "sex_category")
+        )
+
+    def tokenize(self, tkzr, x):
+        for col, prefix in (
+            ("race_category", "RACE"),
+            ("ethnicity_category", "ETHN"),
+            ("sex_category", "SEX"),
+        ):
+            x = tkzr.get_tokens(x, col, prefix)
+        return x.select(
+            "patient_id",
+            tokens=pl.concat_list(
+                "race_category", "ethnicity_category", "sex_category"
+            ),
+        )
+
+
+@register_table_processor
+class Hospitalization(TableProcessor):
+    table = "hospitalization"
+
+    def prepare(self, tkzr, x):
+        return (
+            x.group_by("hospitalization_id")
+            .agg(
+                pl.col("patient_id").first(),
+                pl.col("admission_dttm")
+                .first()
+                .cast(pl.Datetime(time_unit="ms"))
+                .alias("event_start"),
+                pl.col("discharge_dttm")
+                .first()
+                .cast(pl.Datetime(time_unit="ms"))
+                .alias("event_end"),
+                pl.col("age_at_admission").first(),
+                pl.col("admission_type_name")
+                .str.to_lowercase()
+                .str.replace_all(" ", "_")
+                .first(),
+                pl.col("discharge_category")
+                .str.to_lowercase()
+                .str.replace_all(" ", "_")
+                .first(),
+            )
+            .filter(tkzr.in_admission_window())
+            .select(
+                "patient_id",
+                "hospitalization_id",
+                "event_start",
+                "event_end",
+                "age_at_admission",
+                "admission_type_name",
+                "discharge_category",
+            )
+            .sort(by="hospitalization_id")
+        )
+
+    def tokenize(self, tkzr, x):
+        for col, prefix in (
+            ("admission_type_name", "ADMN"),
+            ("discharge_category", "DSCG"),
+        ):
+            x = tkzr.get_tokens(x, col, prefix)
+
+        # tokenize age_at_admission here
+        c = "age_at_admission"
+        if isinstance(x, pl.LazyFrame):
+            # within a lazy plan, the vocabulary is frozen
+            age = tkzr.get_quants_expr(c=c)
+        else:
+            v = x.select(c).to_numpy().ravel()
+            tkzr.set_quants(v=v, c=c)
+            age = tkzr.get_quants(v=v, c=c)
+        return (
+            x.with_columns(age_at_admission=age)
+            .with_columns(admission_tokens=pl.concat_list(c, "admission_type_name"))
+            .drop(c, "admission_type_name")
+        )
+
+
+@register_table_processor
+class Adt(TableProcessor):
+    table = "adt"
+
+    def prepare(self, tkzr, x):
+        return x.select(
+            "hospitalization_id",
+            event_time=pl.col("in_dttm").cast(pl.Datetime(time_unit="ms")),
+            category=pl.col("location_category").str.to_lowercase(),
+        )
+
+    def tokenize(self, tkzr, x):
+        return (
+            tkzr.get_tokens(x, "category", "ADT")
+            .with_columns(
+                tokens=pl.concat_list("category"), times=pl.concat_list("event_time")
+            )
+            .select("hospitalization_id", "event_time", "tokens", "times")
+        )
+
+
+@register_table_processor
+class Labs(CategoryValueProcessor):
+    table = "labs"
+    label = "LAB"
+
+    def prepare(self, tkzr, x):
+        return x.filter(~pl.col("lab_category").is_null()).select(
+            "hospitalization_id",
+            pl.col(f"lab_{tkzr.lab_time}_dttm")
+            .cast(pl.Datetime(time_unit="ms"))
+            .alias("event_time"),
+            pl.col("lab_category").str.to_lowercase().alias("category"),
+            pl.col("lab_value_numeric").alias("value"),
+        )
+
+
+@register_table_processor
+class Vitals(CategoryValueProcessor):
+    table = "vitals"
+    label = "VTL"
+
+    def prepare(self, tkzr, x):
+        return x.select(
+            "hospitalization_id",
+            pl.col("recorded_dttm")
+            .cast(pl.Datetime(time_unit="ms"))
+            .alias("event_time"),
+            pl.col("vital_category")
+            .cast(pl.String)
+            .str.to_lowercase()
+            .alias("category"),
+            pl.col("vital_value").alias("value"),
+        )
+
+
+@register_table_processor
+class Medication(CategoryValueProcessor):
+    table = "medication"
+    label = "MED"
+
+    def prepare(self, tkzr, x):
+        return x.select(
+            "hospitalization_id",
+            pl.col("admin_dttm").cast(pl.Datetime(time_unit="ms")).alias("event_time"),
+            pl.col("med_category").str.to_lowercase().alias("category"),
+            pl.col("med_dose").alias("value"),
+        )
+
+
+@register_table_processor
+class Assessments(TableProcessor):
+    table = "assessments"
+
+    # seems like there's a column for assessment, and then either a
+    # numerical_value OR a categorical_value, depending on the assessment
+    def prepare(self, tkzr, x):
+        return x.select(
+            "hospitalization_id",
+            "categorical_value",
+            event_time=pl.col("recorded_dttm").cast(pl.Datetime(time_unit="ms")),
+            category=pl.col("assessment_category").str.to_lowercase(),
+            value=pl.col("numerical_value"),
+        )
+
+    def tokenize(self, tkzr, x):
+        # handle categorical assessments separately from numerical assessments
+        asmt_num = x.filter(~pl.col("value").is_null())
+        asmt_num = tkzr.process_cat_val_frame(asmt_num, label="ASMT").select(
+            "hospitalization_id", "event_time", "tokens", "times"
+        )
+
+        asmt_cat = (
+            x.filter(pl.col("value").is_null())
+            .filter(~pl.col("categorical_value").is_null())
+            .with_columns(
+                pl.col("category").str.to_lowercase().str.replace_all(" ", "_"),
+                pl.col("categorical_value")
+                .str.to_lowercase()
+                .str.replace_all(" ", "_"),
+            )
+        )
+        asmt_cat = tkzr.get_tokens(asmt_cat, "category", "ASMT_cat")
+        asmt_cat = (
+            tkzr.get_tokens(asmt_cat, "categorical_value", "ASMT_val")
+            .with_columns(
+                tokens=pl.concat_list("category", "categorical_value"),
+                times=pl.concat_list("event_time", "event_time"),
+            )
+            .select("hospitalization_id", "event_time", "tokens", "times")
+        )
+
+        return pl.concat((asmt_num, asmt_cat))
+
+
+@register_table_processor
+class Respiratory(TableProcessor):
+    table = "respiratory"
+
+    def prepare(self, tkzr, x):
+        return x.select(
+            "hospitalization_id",
+            pl.col("mode_category").str.to_lowercase().str.replace_all(" ", "_"),
+            pl.col("device_category").str.to_lowercase().str.replace_all(" ", "_"),
+            event_time=pl.col("recorded_dttm").cast(pl.Datetime(time_unit="ms")),
+        )
+
+    def tokenize(self, tkzr, x):
+        x = tkzr.get_tokens(x, "mode_category", "RESP_mode")
+        return (
+            tkzr.get_tokens(x, "device_category", "RESP_devc")
+            .with_columns(
+                tokens=pl.concat_list("mode_category", "device_category"),
+                times=pl.concat_list("event_time", "event_time"),
+            )
+            .select("hospitalization_id", "event_time", "tokens", "times")
+        )
+
+
+@register_table_processor
+class Position(TableProcessor):
+    table = "position"
+
+    # include a token for prone position; this is relatively rare
+    def prepare(self, tkzr, x):
+        return x.filter(pl.col("position_category") == "prone").select(
+            "hospitalization_id",
+            "position_category",
+            event_time=pl.col("recorded_dttm").cast(pl.Datetime(time_unit="ms")),
+        )
+
+    def tokenize(self, tkzr, x):
+        return (
+            tkzr.get_tokens(x, "position_category", "POSN")
+            .with_columns(
+                tokens=pl.concat_list("position_category"),
+                times=pl.concat_list("event_time"),
+            )
+            .select("hospitalization_id", "event_time", "tokens", "times")
+        )
+
+
+@register_table_processor
+class Measurements(TableProcessor):
+    """machine measurements from ECG's, if available"""
+
+    table = "measurements"
+    optional = True
+
+    def prepare(self, tkzr, x):
+        return x.with_columns(
+            reports=pl.concat_list(
+                *[
+                    pl.col(f"report_{i}").str.strip_chars(" .").str.to_uppercase()
+                    for i in range(18)
+                ]
+            ).list.eval(pl.element().drop_nulls()),
+            event_time=pl.col("event_dttm").cast(pl.Datetime(time_unit="ms")),
+        )
+
+    def tokenize(self, tkzr, x):
+        # the reports are exploded to one row per (ecg, report), restricted to
+        # the `n_top_reports` most frequent reports in training, tokenized in
+        # bulk, and then gathered back into one list per ecg; ecg's without any
+        # of these reports are dropped; when training over several shards, the
+        # counts are accumulated and the top reports are only chosen once all
+        # shards have been seen (see `finalize_training`)
+        x = x.with_row_index("ecg")
+        reports = x.select("ecg", "reports").explode("reports")
+        if (
+            not tkzr.vocab.has_aux("ECG_machine_measurements")
+            and tkzr.vocab.is_training
+        ):
+            counts = reports.drop_nulls().group_by("reports").len()
+            if tkzr.accumulate_sketches:
+                tkzr.report_counts.update(dict(counts.iter_rows()))
+            else:
+                tkzr.vocab.set_aux(
+                    "ECG_machine_measurements", set(self.top_reports(tkzr, counts))
+                )
+        top = (
+            list(tkzr.vocab.get_aux("ECG_machine_measurements"))
+            if tkzr.vocab.has_aux("ECG_machine_measurements")
+            else list()
+        )
+        reports = tkzr.get_tokens(
+            reports.filter(pl.col("reports").is_in(top)).with_columns(
+                pl.col("reports").str.replace_all(" ", "_")
+            ),
+            "reports",
+            "ECG",
+        )
+        return (
+            x.join(
+                reports.group_by("ecg", maintain_order=True).agg(tokens="reports"),
+                on="ecg",
+                how="left",
+                maintain_order="left",
+            )
+            .filter(pl.col("tokens").is_not_null())
+            .with_columns(
+                times=pl.col("event_time").repeat_by(pl.col("tokens").list.len())
+            )
+            .select("hospitalization_id", "event_time", "tokens", "times")
+        )
+
+    def top_reports(self, tkzr, counts: pl.DataFrame) -> list[str]:
+        """the `n_top_reports` most frequent reports, from least to most frequent"""
+        return (
+            counts.sort("len", "reports")
+            .tail(tkzr.n_top_reports)
+            .get_column("reports")
+            .to_list()
+        )
+
+    def finalize_training(self, tkzr):
+        if tkzr.vocab.has_aux("ECG_machine_measurements") or not tkzr.report_counts:
+            return
+        top = self.top_reports(
+            tkzr,
+            pl.DataFrame(
+                {
+                    "reports": list(tkzr.report_counts.keys()),
+                    "len": list(tkzr.report_counts.values()),
+                }
+            ),
+        )
+        tkzr.vocab.set_aux("ECG_machine_measurements", set(top))
+        tkzr.get_tokens(
+            pl.DataFrame({"reports": top}).with_columns(
+                pl.col("reports").str.replace_all(" ", "_")
+            ),
+            "reports",
+            "ECG",
+        )
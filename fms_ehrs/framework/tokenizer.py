@@ -6,27 +6,62 @@
 """
 
 import collections
+import datetime
+import fnmatch
 import functools
+import hashlib
 import logging
 import os
 import pathlib
 import re
+import shutil
 import typing
 
 import numpy as np
 import polars as pl
-
+import pyarrow.parquet as pq
+
+from fms_ehrs.framework.compact import (
+    flat_tokens,
+    padded_matrix,
+    scan_tokens_timelines,
+    write_compact,
+    write_padded,
+)
+from fms_ehrs.framework.profiling import StageProfiler, frame_counts
+from fms_ehrs.framework.sketch import Moments, QuantileSketch
+from fms_ehrs.framework.storage import fix_perms
+from fms_ehrs.framework.tables import TABLE_PROCESSORS
 from fms_ehrs.framework.vocabulary import Vocabulary
 
 Frame: typing.TypeAlias = pl.DataFrame | pl.LazyFrame
 Pathlike: typing.TypeAlias = pathlib.PurePath | str | os.PathLike
 
+# bump whenever `process_tables` (or a table processor) changes what it produces
+CACHE_VERSION = 3
+
 
 class ClifTokenizer:
     """
     tokenizes a directory containing a set of parquet files corresponding to
     the CLIF-2.0 standard; note that the `cut_at_24h` flag implements a very
-    conservative cut and typically removes some timelines
+    conservative cut and typically removes some timelines; setting `i_part` and
+    `n_parts` restricts tokenization to the `i_part`-th of `n_parts` hash
+    buckets of hospitalizations; if `quantile_sketch_eps` is provided, quantiles
+    are learned from mergeable sketches with a rank error of roughly that size
+    (means and standard deviations for the sigmas quantizer) instead of exactly;
+    if a `cache_dir` is provided, the processed tables are cached there (see
+    `cache_key`) so that reruns differing only in downstream options skip
+    straight to assembling the timelines; with `profile`, every stage (and
+    every table) is timed and measured by `self.profiler`, which can write a
+    json report, and the query plans of lazy stages are dumped to `plans_dir`;
+    tokens can be dropped from the final timelines by type (see `denied_tokens`);
+    with `fused_quantiles`, each measurement of a category / value table is
+    tokenized as a single word `{label}_{category}_{Qk}` instead of the pair
+    `{label}_{category}`, `Qk` (see `fused_tokens` to decompose these);
+    repeated measurements can be thinned out per token type or category with
+    `collapse_repeats` (see `collapse_repeated_events`); passing
+    `hospitalization_ids` restricts tokenization to those hospitalizations
     """
 
     def __init__(
@@ -42,7 +77,17 @@ def __init__(
         quantizer: typing.Literal["deciles", "sigmas"] = "deciles",
         drop_deciles: bool = False,
         drop_nulls_nans: bool = False,
+        drop_words: tuple[str, ...] = None,
+        fused_quantiles: bool = False,
+        collapse_repeats: dict[str, str] = None,
         n_top_reports: int = 100,
+        i_part: int = None,
+        n_parts: int = None,
+        hospitalization_ids: typing.Iterable[str] = None,
+        quantile_sketch_eps: float = None,
+        cache_dir: Pathlike = None,
+        profile: bool = False,
+        plans_dir: Pathlike = None,
     ):
         """
         if no vocabulary is provided, we are in training mode; otherwise, the
@@ -72,22 +117,109 @@ def __init__(
         self.lab_time = lab_time
         self.drop_deciles = bool(drop_deciles)
         self.drop_nulls_nans = bool(drop_nulls_nans)
+        self.drop_words = (
+            (drop_words,) if isinstance(drop_words, str) else tuple(drop_words or ())
+        )
+        self.fused_quantiles = bool(fused_quantiles)
+        if self.fused_quantiles and self.drop_deciles:
+            # fused words carry their quantile and would have to be dropped
+            # altogether; use e.g. `drop_words=("LAB_*",)` for that instead
+            raise ValueError("drop_deciles has no separate tokens to drop when fused")
+        self.collapse_repeats = dict(collapse_repeats or {})
+        self.collapse_stats = dict()
         self.n_top_reports = n_top_reports
+        self.i_part = i_part
+        self.n_parts = n_parts
+        self.hospitalization_ids = (
+            sorted(set(hospitalization_ids))
+            if hospitalization_ids is not None
+            else None
+        )
+        self.quantile_sketch_eps = quantile_sketch_eps
+        self.sketches = dict()
+        self.accumulate_sketches = False
+        self.report_counts = collections.Counter()
+        self.cache_dir = (
+            pathlib.Path(cache_dir).expanduser().resolve()
+            if cache_dir is not None
+            else None
+        )
+        self.profiler = StageProfiler(enabled=profile, plans_dir=plans_dir)
 
     def load_tables(self) -> None:
         """lazy-load all parquet tables from the directory `self.data_dir`"""
-        self.tbl = {
-            (
-                p.stem.split("_")[1] if "assessments" not in p.stem else "assessments"
-            ): pl.scan_parquet(p)
-            for p in self.data_dir.glob("*.parquet")
-        }
+        with self.profiler.stage("load_tables"):
+            self.tbl = {
+                (
+                    p.stem.split("_")[1]
+                    if "assessments" not in p.stem
+                    else "assessments"
+                ): pl.scan_parquet(p)
+                for p in self.data_dir.glob("*.parquet")
+            }
+            predicates = list()
+            if self.i_part is not None or self.n_parts is not None:
+                if (
+                    self.i_part is None
+                    or self.n_parts is None
+                    or not 0 <= self.i_part < self.n_parts
+                ):
+                    raise ValueError(
+                        "i_part and n_parts must be given together, with "
+                        f"0 <= i_part < n_parts; got {self.i_part=}, {self.n_parts=}"
+                    )
+                predicates.append(
+                    pl.col("hospitalization_id").hash(seed=42) % self.n_parts
+                    == self.i_part
+                )
+            if self.hospitalization_ids is not None:
+                predicates.append(
+                    pl.col("hospitalization_id").is_in(self.hospitalization_ids)
+                )
+            if self.valid_admission_window is not None:
+                # determine the surviving hospitalizations up front so that every
+                # scan is restricted to them before anything is collected
+                predicates.append(
+                    pl.col("hospitalization_id").is_in(
+                        self.tbl["hospitalization"]
+                        .group_by("hospitalization_id")
+                        .agg(
+                            event_start=pl.col("admission_dttm")
+                            .first()
+                            .cast(pl.Datetime(time_unit="ms"))
+                        )
+                        .filter(self.in_admission_window())
+                        .select("hospitalization_id")
+                        .collect()
+                        .to_series()
+                    )
+                )
+            if predicates:
+                for k in self.tbl.keys():
+                    if "hospitalization_id" in self.tbl[k].collect_schema().names():
+                        self.tbl[k] = self.tbl[k].filter(*predicates)
+                self.tbl["patient"] = self.tbl["patient"].join(
+                    self.tbl["hospitalization"].select("patient_id"),
+                    on="patient_id",
+                    how="semi",
+                )
+
+    def in_admission_window(self, col: str = "event_start") -> pl.Expr:
+        """predicate for admissions that fall within `valid_admission_window`"""
+        if self.valid_admission_window is None:
+            return pl.lit(True)
+        return pl.col(col).is_between(
+            pl.lit(self.valid_admission_window[0]).cast(pl.Date),
+            pl.lit(self.valid_admission_window[1]).cast(pl.Date),
+        )
 
     def set_quants(self, v: np.array, c: str, label: str = None) -> None:
         """store training quantile information in the self.vocab object"""
         designator = f"{label}_{c}" if label is not None else c
         if not self.vocab.has_aux(designator) and self.vocab.is_training:
-            if self.quantizer == "deciles":
+            if self.quantile_sketch_eps is not None:
+                self.update_sketches({designator: v})
+            elif self.quantizer == "deciles":
                 self.vocab.set_aux(
                     designator, np.nanquantile(v, np.arange(0.1, 1.0, 0.1))
                 )
@@ -113,417 +245,353 @@ def get_quants(self, v: np.array, c: str, label: str = None) -> pl.Expr:
             )
         ).cast(pl.Int64)
 
-    def process_single_category(self, x: Frame, label: str) -> Frame:
+    def get_quants_expr(self, c: str, label: str = None) -> pl.Expr:
         """
-        Quantize a sub-table consisting of a single category
-
-        The way our quantization works, if a category takes on only a single
-        value, then this value is sent to the Q9 token, because, e.g.
-        `np.digitize(1, bins=[1] * 9) == 9`
-        and:
-        `np.digitize(
-        [1, 2],
-        bins=np.nanquantile([1, 1, 1, 2, 2, 2, 2], np.arange(0.1, 1.0, 0.1)),
-        ) == [3, 9]`
-        This is why the Q9 token appears quite a bit more often in our dataset than
-        certain other quantile tokens.
+        expression counterpart of `get_quants` for use within a lazy plan: the
+        stored cut points are compared against column `c` directly
         """
-        v = x.select("value").to_numpy().ravel()
-        c = x.select("category").row(0)[0]
-        self.set_quants(v=v, c=c, label=label)
+        designator = f"{label}_{c}" if label is not None else c
+        if not self.vocab.has_aux(designator):
+            return pl.lit(self.vocab(None), dtype=pl.Int64)
         return (
-            x.with_columns(
-                token=pl.lit(self.vocab(f"{label}_{c}")).cast(pl.Int64),
-                token_quantile=self.get_quants(v=v, c=c, label=label),
-            )
-            .filter(~pl.col("token").is_in([self.vocab(None), self.vocab("nan")]))
-            .filter(
-                ~pl.col("token_quantile").is_in([self.vocab(None), self.vocab("nan")])
-            )
-            .with_columns(
-                tokens=pl.concat_list("token", "token_quantile").cast(
-                    pl.List(pl.Int64)
-                ),
-                times=pl.concat_list("event_time", "event_time"),
+            pl.when(pl.col(c).is_finite())
+            .then(
+                pl.sum_horizontal(
+                    pl.lit(float(b)) <= pl.col(c)
+                    for b in self.vocab.get_aux(designator)
+                )
             )
+            .otherwise(self.vocab("nan"))
+            .cast(pl.Int64)
         )
 
-    def process_cat_val_frame(self, df: Frame, label: str) -> Frame:
-        """handle tables that can mostly be described in terms of categories and
-        values"""
-        return pl.concat(
-            self.process_single_category(x, label) for x in df.partition_by("category")
-        )
-
-    def process_tables(self) -> None:
-        self.tbl["patient"] = (
-            self.tbl["patient"]
-            .group_by("patient_id")
-            .agg(
-                pl.col("race_category")
-                .str.to_lowercase()
-                .str.replace_all(" ", "_")
-                .first(),
-                pl.col("ethnicity_category")
-                .str.to_lowercase()
-                .str.replace_all(" ", "_")
-                .first(),
-                pl.col("sex_category")
-                .str.to_lowercase()
-                .str.replace_all(" ", "_")
-                .first(),
-            )
-            .with_columns(
-                pl.col("race_category").map_elements(
-                    lambda x: self.vocab("RACE_{}".format(x)),
-                    return_dtype=pl.Int64,
-                    skip_nulls=False,
-                ),
-                pl.col("ethnicity_category").map_elements(
-                    lambda x: self.vocab("ETHN_{}".format(x)),
-                    return_dtype=pl.Int64,
-                    skip_nulls=False,
-                ),
-                pl.col("sex_category").map_elements(
-                    lambda x: self.vocab("SEX_{}".format(x)),
-                    return_dtype=pl.Int64,
-                    skip_nulls=False,
-                ),
+    def get_tokens(self, x: Frame, col: str, prefix: str) -> Frame:
+        """
+        replace the categorical column `col` of `x` with the tokens for the
+        words `{prefix}_{value}` (where null values become `{prefix}_None`);
+        the distinct words are registered with the vocabulary in a single batch,
+        in order of first appearance, and then mapped in bulk; a lazy `x` is
+        left lazy once the vocabulary is frozen (unseen words are then mapped
+        to the null token without being tallied)
+        """
+        word = (pl.lit(f"{prefix}_") + pl.col(col).fill_null("None")).alias(col)
+        if self.vocab.is_training or not isinstance(x, pl.LazyFrame):
+            self.vocab.update(
+                x.lazy().select(word.unique(maintain_order=True)).collect().to_series()
             )
-            .with_columns(
-                tokens=pl.concat_list(
-                    "race_category", "ethnicity_category", "sex_category"
-                )
+        vf = self.vocab.get_frame().filter(pl.col("word").is_not_null())
+        return x.with_columns(
+            word.replace_strict(
+                vf.get_column("word"),
+                vf.get_column("token"),
+                default=self.vocab.lookup.get(None),
+                return_dtype=pl.Int64,
             )
-            .select("patient_id", "tokens")
-            .collect()
         )
 
-        self.tbl["hospitalization"] = (
-            self.tbl["hospitalization"]
-            .group_by("hospitalization_id")
-            .agg(
-                pl.col("patient_id").first(),
-                pl.col("admission_dttm")
-                .first()
-                .cast(pl.Datetime(time_unit="ms"))
-                .alias("event_start"),
-                pl.col("discharge_dttm")
-                .first()
-                .cast(pl.Datetime(time_unit="ms"))
-                .alias("event_end"),
-                pl.col("age_at_admission").first(),
-                pl.col("admission_type_name")
-                .str.to_lowercase()
-                .str.replace_all(" ", "_")
-                .first(),
-                pl.col("discharge_category")
-                .str.to_lowercase()
-                .str.replace_all(" ", "_")
-                .first(),
+    def set_quants_frame(self, x: Frame, label: str) -> None:
+        """
+        store training quantile information in the self.vocab object for every
+        category of `x` at once; cut points are computed from a single sort of
+        the frame by category and value and reproduce `np.nanquantile` exactly
+        """
+        if not self.vocab.is_training:
+            return
+        x = (
+            x.lazy()
+            .select(
+                designator=pl.lit(f"{label}_") + pl.col("category").fill_null("None"),
+                value=pl.col("value").fill_nan(None),
             )
             .filter(
-                pl.col("event_start").is_between(
-                    pl.lit(self.valid_admission_window[0]).cast(pl.Date),
-                    pl.lit(self.valid_admission_window[1]).cast(pl.Date),
+                ~pl.col("designator").is_in(
+                    [k for k in self.vocab.aux if isinstance(k, str)]
                 )
-                if self.valid_admission_window is not None
-                else True
             )
-            .with_columns(
-                pl.col("admission_type_name").map_elements(
-                    lambda x: self.vocab("ADMN_{}".format(x)),
-                    return_dtype=pl.Int64,
-                    skip_nulls=False,
-                ),
-                pl.col("discharge_category").map_elements(
-                    lambda x: self.vocab("DSCG_{}".format(x)),
-                    return_dtype=pl.Int64,
-                    skip_nulls=False,
-                ),
-            )
-            .select(
-                "patient_id",
-                "hospitalization_id",
-                "event_start",
-                "event_end",
-                "age_at_admission",
-                "admission_type_name",
-                "discharge_category",
-            )
-            .sort(by="hospitalization_id")
-            .collect()
         )
-
-        # tokenize age_at_admission here
-        c = "age_at_admission"
-        v = self.tbl["hospitalization"].select(c).to_numpy().ravel()
-        self.set_quants(v=v, c=c)
-        self.tbl["hospitalization"] = (
-            self.tbl["hospitalization"]
-            .with_columns(age_at_admission=self.get_quants(v=v, c=c))
-            .with_columns(admission_tokens=pl.concat_list(c, "admission_type_name"))
-            .drop(c, "admission_type_name")
+        designators = (
+            x.select(pl.col("designator").unique(maintain_order=True))
+            .collect()
+            .to_series()
+            .to_list()
         )
-
-        self.tbl["adt"] = (
-            self.tbl["adt"]
-            .with_columns(
-                event_time=pl.col("in_dttm").cast(pl.Datetime(time_unit="ms")),
-                category=pl.col("location_category").str.to_lowercase(),
+        if not designators:
+            return
+        if self.quantile_sketch_eps is not None:
+            # each category's values are a contiguous slice of a single sort
+            srt = (
+                x.drop_nulls("value")
+                .sort("designator", maintain_order=True)
+                .select("designator", pl.col("value").cast(pl.Float64))
+                .collect()
             )
-            .with_columns(
-                tokens=pl.col("category")
-                .str.to_lowercase()
-                .map_elements(
-                    lambda x: [self.vocab("ADT_{}".format(x))],
-                    return_dtype=pl.List(pl.Int64),
-                    skip_nulls=False,
-                ),
-                times=pl.col("event_time").map_elements(
-                    lambda x: [x], return_dtype=pl.List(pl.Datetime), skip_nulls=False
-                ),
+            grps = srt.group_by("designator", maintain_order=True).len()
+            n = grps.get_column("len").to_numpy().astype(np.intp)
+            vals = dict(
+                zip(
+                    grps.get_column("designator").to_list(),
+                    np.split(srt.get_column("value").to_numpy(), np.cumsum(n)[:-1]),
+                )
             )
-            .select("hospitalization_id", "event_time", "tokens", "times")
-            .cast({"times": pl.List(pl.Datetime(time_unit="ms"))})
-            .collect()
-        )
-
-        self.tbl["labs"] = (
-            self.tbl["labs"]
-            .filter(~pl.col("lab_category").is_null())
-            .select(
-                "hospitalization_id",
-                pl.col(f"lab_{self.lab_time}_dttm")
-                .cast(pl.Datetime(time_unit="ms"))
-                .alias("event_time"),
-                pl.col("lab_category").str.to_lowercase().alias("category"),
-                pl.col("lab_value_numeric").alias("value"),
+            self.update_sketches({d: vals.get(d, np.empty(0)) for d in designators})
+            return
+        if self.quantizer == "deciles":
+            srt = x.drop_nulls("value").sort("designator", "value").collect()
+            grps = srt.group_by("designator", maintain_order=True).len()
+            v = srt.get_column("value").to_numpy()
+            n = grps.get_column("len").to_numpy().astype(np.intp)
+            q = np.arange(0.1, 1.0, 0.1)
+            # replicate numpy's "linear" interpolation on each sorted segment
+            virt = (n[:, None] - 1) * q
+            prev = np.floor(virt)
+            above = virt >= n[:, None] - 1
+            fst, lst = (np.cumsum(n) - n)[:, None], (np.cumsum(n) - 1)[:, None]
+            a = v[np.where(above, lst, fst + prev.astype(np.intp))]
+            b = v[np.where(above, lst, fst + prev.astype(np.intp) + 1)]
+            γ = virt - np.where(above, -1, prev)
+            cuts = np.where(γ >= 0.5, b - (b - a) * (1 - γ), a + (b - a) * γ)
+        elif self.quantizer == "sigmas":
+            grps = (
+                x.group_by("designator")
+                .agg(
+                    μ=pl.col("value").cast(pl.Float64).mean(),
+                    σ=pl.col("value").cast(pl.Float64).std(ddof=0),
+                )
+                .collect()
             )
-            .collect()
-        )
-        self.tbl["labs"] = self.process_cat_val_frame(self.tbl["labs"], label="LAB")
+            μ = grps.get_column("μ").fill_null(np.nan).to_numpy()
+            σ = grps.get_column("σ").fill_null(np.nan).to_numpy()
+            cuts = μ[:, None] + (σ[:, None] + np.finfo(float).eps) * np.arange(-3, 4)
+        cuts = dict(zip(grps.get_column("designator").to_list(), cuts))
+        for d in designators:
+            self.vocab.set_aux(d, cuts.get(d, np.full(len(self.q_tokens) - 1, np.nan)))
+
+    def update_sketches(self, values: dict[str, typing.Iterable[float]]) -> None:
+        """
+        add `values` to the sketch kept for each designator; the cut points are
+        stored in the self.vocab object right away, unless sketches are being
+        accumulated over several shards (see `set_quants_from_sketches`)
+        """
+        for d, v in values.items():
+            if d not in self.sketches:
+                self.sketches[d] = (
+                    QuantileSketch(eps=self.quantile_sketch_eps)
+                    if self.quantizer == "deciles"
+                    else Moments()
+                )
+            self.sketches[d].update(v)
+        if not self.accumulate_sketches:
+            self.set_quants_from_sketches(values.keys())
 
-        self.tbl["vitals"] = (
-            self.tbl["vitals"]
-            .select(
-                "hospitalization_id",
-                pl.col("recorded_dttm")
-                .cast(pl.Datetime(time_unit="ms"))
-                .alias("event_time"),
-                pl.col("vital_category")
-                .cast(pl.String)
-                .str.to_lowercase()
-                .alias("category"),
-                pl.col("vital_value").alias("value"),
-            )
-            .collect()
-        )
-        self.tbl["vitals"] = self.process_cat_val_frame(self.tbl["vitals"], label="VTL")
+    def set_quants_from_sketches(self, designators: typing.Iterable[str] = None):
+        """store cut points derived from the (merged) sketches in self.vocab"""
+        for d in self.sketches.keys() if designators is None else designators:
+            if self.quantizer == "deciles":
+                cuts = self.sketches[d].quantiles(np.arange(0.1, 1.0, 0.1))
+            elif self.quantizer == "sigmas":
+                μ = self.sketches[d].mean if len(self.sketches[d]) else np.nan
+                σ = self.sketches[d].std + np.finfo(float).eps
+                cuts = μ + σ * np.arange(-3, 4)
+            self.vocab.set_aux(d, cuts)
 
-        self.tbl["medication"] = (
-            self.tbl["medication"]
-            .select(
-                "hospitalization_id",
-                pl.col("admin_dttm")
-                .cast(pl.Datetime(time_unit="ms"))
-                .alias("event_time"),
-                pl.col("med_category").str.to_lowercase().alias("category"),
-                pl.col("med_dose").alias("value"),
-            )
+    def get_quants_frame(self, x: Frame, label: str) -> Frame:
+        """
+        attach the quantile token `token_quantile` to each row of `x` using
+        self.vocab; cut points are laid out as a flat table with one row per
+        category token, joined onto `x`, and each value is binned by counting
+        the cut points at or below it (equivalent to `np.digitize`); for a lazy
+        `x` and a frozen vocabulary, the table holds every category of `label`
+        with cut points, so that `x` need not be scanned for its categories
+        """
+        designators = (
+            [
+                d
+                for d in self.vocab.aux
+                if isinstance(d, str) and d.startswith(f"{label}_")
+            ]
+            if isinstance(x, pl.LazyFrame) and not self.vocab.is_training
+            else x.lazy()
+            .select(pl.lit(f"{label}_") + pl.col("category").fill_null("None"))
+            .unique()
             .collect()
+            .to_series()
+            .to_list()
         )
-        self.tbl["medication"] = self.process_cat_val_frame(
-            self.tbl["medication"], label="MED"
+        aux = {
+            t: self.vocab.get_aux(d)
+            for d in designators
+            if self.vocab.has_aux(d) and (t := self.vocab.lookup.get(d)) is not None
+        }
+        m = max(map(len, aux.values()), default=len(self.q_tokens) - 1)
+        cuts = pl.DataFrame(
+            {"token": list(aux.keys())}
+            | {
+                f"cut_{i}": [
+                    float(v[i]) if i < len(v) else np.inf for v in aux.values()
+                ]
+                for i in range(m)
+            },
+            schema={"token": pl.Int64} | {f"cut_{i}": pl.Float64 for i in range(m)},
         )
-
-        # seems like there's a column for assessment, and then either a
-        # numerical_value OR a categorical_value, depending on the assessment
-        self.tbl["assessments"] = (
-            self.tbl["assessments"]
+        return (
+            x.join(
+                cuts.lazy() if isinstance(x, pl.LazyFrame) else cuts,
+                on="token",
+                how="left",
+                maintain_order="left",
+            )
             .with_columns(
-                event_time=pl.col("recorded_dttm").cast(pl.Datetime(time_unit="ms")),
-                category=pl.col("assessment_category").str.to_lowercase(),
-                value=pl.col("numerical_value"),
+                token_quantile=pl.when(pl.col("cut_0").is_null())
+                .then(self.vocab(None))
+                .when(pl.col("value").is_finite())
+                .then(
+                    pl.sum_horizontal(
+                        pl.col(f"cut_{i}") <= pl.col("value") for i in range(m)
+                    )
+                )
+                .otherwise(self.vocab("nan"))
+                .cast(pl.Int64)
             )
-            .collect()
+            .drop(f"cut_{i}" for i in range(m))
         )
 
-        # handle categorical assessments separately from numerical assessments
-        asmt_num = self.tbl["assessments"].filter(~pl.col("value").is_null())
-        asmt_num = self.process_cat_val_frame(asmt_num, label="ASMT").select(
-            "hospitalization_id", "event_time", "tokens", "times"
-        )
+    def process_cat_val_frame(self, df: Frame, label: str) -> Frame:
+        """
+        handle tables that can mostly be described in terms of categories and
+        values; all categories of `df` are quantized together
 
-        asmt_cat = (
-            self.tbl["assessments"]
-            .filter(pl.col("value").is_null())
-            .filter(~pl.col("categorical_value").is_null())
-            .with_columns(
-                pl.col("category")
-                .str.to_lowercase()
-                .str.replace_all(" ", "_")
-                .map_elements(
-                    lambda x: self.vocab("ASMT_cat_{}".format(x)),
-                    return_dtype=pl.Int64,
-                    skip_nulls=False,
-                ),
-                pl.col("categorical_value")
-                .str.to_lowercase()
-                .str.replace_all(" ", "_")
-                .map_elements(
-                    lambda x: self.vocab("ASMT_val_{}".format(x)),
-                    return_dtype=pl.Int64,
-                    skip_nulls=False,
+        The way our quantization works, if a category takes on only a single
+        value, then this value is sent to the Q9 token, because, e.g.
+        `np.digitize(1, bins=[1] * 9) == 9`
+        and:
+        `np.digitize(
+        [1, 2],
+        bins=np.nanquantile([1, 1, 1, 2, 2, 2, 2], np.arange(0.1, 1.0, 0.1)),
+        ) == [3, 9]`
+        This is why the Q9 token appears quite a bit more often in our dataset than
+        certain other quantile tokens.
+
+        With `fused_quantiles`, the category and quantile tokens are replaced by
+        the single token for `{label}_{category}_{Qk}`; the category tokens are
+        still registered, as they key the cut points in the vocabulary.
+        """
+        self.set_quants_frame(df, label=label)
+        df = (
+            self.get_quants_frame(
+                self.get_tokens(
+                    df.with_columns(token=pl.col("category")), "token", label
                 ),
+                label=label,
             )
-            .with_columns(
-                tokens=pl.concat_list("category", "categorical_value"),
-                times=pl.concat_list("event_time", "event_time"),
+            .filter(~pl.col("token").is_in([self.vocab(None), self.vocab("nan")]))
+            .filter(
+                ~pl.col("token_quantile").is_in([self.vocab(None), self.vocab("nan")])
             )
-            .select("hospitalization_id", "event_time", "tokens", "times")
         )
-
-        self.tbl["assessments"] = pl.concat((asmt_num, asmt_cat))
-
-        self.tbl["respiratory"] = (
-            self.tbl["respiratory"]
-            .with_columns(
-                pl.col("mode_category")
-                .str.to_lowercase()
-                .str.replace_all(" ", "_")
-                .map_elements(
-                    lambda x: self.vocab("RESP_mode_{}".format(x)),
-                    return_dtype=pl.Int64,
-                    skip_nulls=False,
-                ),
-                pl.col("device_category")
-                .str.to_lowercase()
-                .str.replace_all(" ", "_")
-                .map_elements(
-                    lambda x: self.vocab("RESP_devc_{}".format(x)),
-                    return_dtype=pl.Int64,
-                    skip_nulls=False,
+        if self.fused_quantiles:
+            # fused words are registered in order of category and quantile, so
+            # that the words of each category remain contiguous in the vocabulary
+            return self.get_tokens(
+                df.sort("token", "token_quantile", maintain_order=True).with_columns(
+                    token=pl.col("category").fill_null("None")
+                    + "_"
+                    + pl.col("token_quantile").replace_strict(
+                        [self.vocab(q) for q in self.q_tokens],
+                        list(self.q_tokens),
+                        return_dtype=pl.String,
+                    )
                 ),
-                event_time=pl.col("recorded_dttm").cast(pl.Datetime(time_unit="ms")),
-            )
-            .with_columns(
-                tokens=pl.concat_list("mode_category", "device_category"),
-                times=pl.concat_list("event_time", "event_time"),
+                "token",
+                label,
+            ).with_columns(
+                tokens=pl.concat_list("token").cast(pl.List(pl.Int64)),
+                times=pl.concat_list("event_time"),
             )
-            .select("hospitalization_id", "event_time", "tokens", "times")
-            .collect()
+        return df.with_columns(
+            tokens=pl.concat_list("token", "token_quantile").cast(pl.List(pl.Int64)),
+            times=pl.concat_list("event_time", "event_time"),
         )
 
-        # include a token for prone position; this is relatively rare
-        self.tbl["position"] = (
-            self.tbl["position"]
-            .filter(pl.col("position_category") == "prone")
-            .with_columns(
-                event_time=pl.col("recorded_dttm").cast(pl.Datetime(time_unit="ms"))
-            )
-            .with_columns(
-                tokens=pl.col("position_category").map_elements(
-                    lambda x: [self.vocab("POSN_{}".format(x))],
-                    return_dtype=pl.List(pl.Int64),
-                    skip_nulls=False,
-                ),
-                times=pl.col("event_time").map_elements(
-                    lambda x: [x], return_dtype=pl.List(pl.Datetime), skip_nulls=False
-                ),
-            )
-            .cast({"times": pl.List(pl.Datetime(time_unit="ms"))})
-            .collect()
+    def process_tables(self) -> None:
+        """
+        run the registered table processors: their vocabulary-independent
+        plans are collected concurrently, and then tokens are assigned one
+        table at a time in order of registration, so that the vocabulary does
+        not depend on which plan happens to finish first
+        """
+        procs = [
+            p
+            for p in TABLE_PROCESSORS.values()
+            if p.table in self.tbl or not p.optional
+        ]
+        with self.profiler.stage("process_tables"):
+            plans = [p.prepare(self, self.tbl[p.table].lazy()) for p in procs]
+            with self.profiler.stage("collect") as rec:
+                for p, x in zip(procs, plans):
+                    self.profiler.explain(f"{rec['stage']}/{p.table}", x)
+                frames = pl.collect_all(plans)
+                rec.update(rows=sum(x.height for x in frames))
+            self.tbl = dict()
+            for p, x in zip(procs, frames):
+                with self.profiler.stage(p.table) as rec:
+                    self.tbl[p.table] = p.tokenize(self, x)
+                    rec.update(frame_counts(self.tbl[p.table]))
+
+    def join_validation(self, validate: str) -> str:
+        """
+        the `validate` argument for joins of the processed tables: the check
+        is made when the tables are held in memory and skipped within a lazy
+        plan, as polars' streaming engine cannot run validated joins
+        """
+        return (
+            "m:m"
+            if isinstance(self.tbl.get("hospitalization"), pl.LazyFrame)
+            else validate
         )
 
-        # process machine measurements from ECG's if available
-        if "measurements" in self.tbl:
-            self.tbl["measurements"] = self.tbl["measurements"].with_columns(
-                reports=pl.concat_list(
-                    *[
-                        pl.col(f"report_{i}").str.strip_chars(" .").str.to_uppercase()
-                        for i in range(18)
-                    ]
-                ).list.eval(pl.element().drop_nulls()),
-                event_time=pl.col("event_dttm").cast(pl.Datetime(time_unit="ms")),
+    def run_times_qc(self) -> None:
+        with self.profiler.stage("run_times_qc") as rec:
+            alt_times = (
+                self.tbl["vitals"]
+                .group_by("hospitalization_id")
+                .agg(
+                    event_start_alt=pl.col("event_time").min(),
+                    event_end_alt=pl.col("event_time").max(),
+                )
             )
 
-            if (
-                not self.vocab.has_aux("ECG_machine_measurements")
-                and self.vocab.is_training
-            ):
-                self.vocab.set_aux(
-                    "ECG_machine_measurements",
-                    set(
-                        self.tbl["measurements"]
-                        .select(pl.col("reports").explode())
-                        .group_by("reports")
-                        .len()
-                        .sort("len")
-                        .tail(self.n_top_reports)
-                        .collect()
-                        .to_series()
-                        .to_list()
-                    ),
+            self.tbl["hospitalization"] = (
+                self.tbl["hospitalization"]
+                .join(
+                    alt_times,
+                    how="left",
+                    on="hospitalization_id",
+                    validate=self.join_validation("1:1"),
                 )
-
-            self.tbl["measurements"] = (
-                self.tbl["measurements"]
                 .with_columns(
-                    pl.col("reports")
-                    .list.eval(
-                        pl.element().filter(
-                            pl.element().is_in(
-                                self.vocab.get_aux("machine_measurements")
-                            )
-                        )
-                    )
-                    .list.eval(
-                        pl.element().map_elements(
-                            lambda x: self.vocab("ECG_{}".replace(" ", "_").format(x)),
-                            return_dtype=pl.Int64,
-                        )
-                    )
-                    .alias("tokens")
+                    event_start=pl.min_horizontal("event_start", "event_start_alt"),
+                    event_end=pl.max_horizontal("event_end", "event_end_alt"),
                 )
-                .with_columns(
-                    pl.struct(["event_time", pl.col("tokens").list.len()])
-                    .map_elements(
-                        lambda row: [row["event_time"]] * row["tokens"],
-                        return_dtype=pl.List(pl.Datetime),
-                    )
-                    .alias("times")
+                .drop("event_start_alt", "event_end_alt")
+                .filter(pl.col("event_start") < pl.col("event_end"))
+                .filter(
+                    # timelines run from `event_start` to `event_end`
+                    (pl.col("event_end") - pl.col("event_start")) >= pl.duration(days=1)
+                    if self.day_stay_filter
+                    else True
                 )
-                .cast({"times": pl.List(pl.Datetime(time_unit="ms"))})
-                .collect()
-            )
-
-    def run_times_qc(self) -> None:
-        alt_times = (
-            self.tbl["vitals"]
-            .group_by("hospitalization_id")
-            .agg(
-                event_start_alt=pl.col("event_time").min(),
-                event_end_alt=pl.col("event_time").max(),
             )
-        )
-
-        self.tbl["hospitalization"] = (
-            self.tbl["hospitalization"]
-            .join(alt_times, how="left", on="hospitalization_id", validate="1:1")
-            .with_columns(
-                event_start=pl.min_horizontal("event_start", "event_start_alt"),
-                event_end=pl.max_horizontal("event_end", "event_end_alt"),
-            )
-            .drop("event_start_alt", "event_end_alt")
-            .filter(pl.col("event_start") < pl.col("event_end"))
-        )
+            rec.update(frame_counts(self.tbl["hospitalization"]))
 
     def get_admission_frame(self) -> Frame:
         ## prepend patient-level tokens to each admission event
         admission_tokens = (
             self.tbl["patient"]
-            .join(self.tbl["hospitalization"], on="patient_id", validate="1:m")
+            .join(
+                self.tbl["hospitalization"],
+                on="patient_id",
+                validate=self.join_validation("1:m"),
+            )
             .cast({"event_start": pl.Datetime(time_unit="ms")})
             .with_columns(
                 adm_tokens=pl.concat_list(
@@ -561,81 +629,352 @@ def get_discharge_frame(self) -> Frame:
 
         return discharge_tokens
 
+    def collapse_repeated_events(self) -> pl.DataFrame:
+        """
+        thin out runs of repeated measurements in the processed event tables:
+        for events whose first token matches a key of `collapse_repeats` (a
+        token type like "VTL", or a category like "VTL_heart_rate"; the more
+        specific key wins), consecutive events of the same category within a
+        hospitalization that carry identical tokens (i.e. the same quantile
+        bin) form a run, of which only one event per window (e.g. "1h",
+        measured from the start of the run) is kept; fused tokens are grouped
+        by their category, so that a change of bin ends a run; returns the
+        tokens removed, one row per token with its hospitalization and time
+        """
+        windows = dict()
+        categories = dict(
+            fused_tokens(self.vocab).select("token", "category_token").iter_rows()
+        )
+        for w, t in self.vocab.lookup.items():
+            if not isinstance(w, str):
+                continue
+            c = self.vocab.reverse.get(categories.get(t))
+            for k in (w, c, token_type(w)):
+                if k in self.collapse_repeats:
+                    windows[t] = max(
+                        pl.select(parse_duration(self.collapse_repeats[k])).item()
+                        // datetime.timedelta(milliseconds=1),
+                        1,
+                    )
+                    break
+        removed = list()
+        for k in self.tbl.keys():
+            if k in ("patient", "hospitalization"):
+                continue
+            x = self.tbl[k].with_columns(
+                row=pl.int_range(pl.len()), first=pl.col("tokens").list.first()
+            )
+            runs = (
+                x.filter(pl.col("first").is_in(list(windows.keys())))
+                .with_columns(
+                    key=pl.col("first").replace(
+                        list(categories.keys()), list(categories.values())
+                    )
+                )
+                .sort("hospitalization_id", "key", "event_time", "row")
+                .with_columns(
+                    window=pl.col("first").replace_strict(
+                        list(windows.keys()), list(windows.values())
+                    ),
+                    run=(
+                        (
+                            pl.col("hospitalization_id")
+                            != pl.col("hospitalization_id").shift()
+                        )
+                        | (pl.col("key") != pl.col("key").shift())
+                        | (pl.col("tokens") != pl.col("tokens").shift())
+                    )
+                    .fill_null(True)
+                    .cum_sum(),
+                )
+                .with_columns(
+                    bucket=(
+                        pl.col("event_time") - pl.col("event_time").first().over("run")
+                    ).dt.total_milliseconds()
+                    // pl.col("window")
+                )
+                .filter(
+                    (pl.col("run") == pl.col("run").shift())
+                    & (pl.col("bucket") == pl.col("bucket").shift())
+                )
+                .select("row")
+            )
+            removed.append(
+                x.join(runs, on="row", how="semi")
+                .select("hospitalization_id", token="tokens", time="times")
+                .explode("token", "time")
+            )
+            self.tbl[k] = x.join(
+                runs, on="row", how="anti", maintain_order="left"
+            ).drop("row", "first")
+        return pl.concat(removed)
+
     def get_events_frame(self) -> Frame:
+        # only events of hospitalizations that passed quality control are sorted
         events = pl.concat(
             self.tbl[k].select("hospitalization_id", "event_time", "tokens", "times")
             for k in self.tbl.keys()
             if k not in ("patient", "hospitalization")
         )
+        if isinstance(self.tbl["hospitalization"], pl.LazyFrame):
+            events = events.lazy().join(
+                self.tbl["hospitalization"].select("hospitalization_id"),
+                on="hospitalization_id",
+                how="semi",
+            )
+        else:
+            events = events.filter(
+                pl.col("hospitalization_id").is_in(
+                    self.tbl["hospitalization"].get_column("hospitalization_id")
+                )
+            )
 
-        # doing both aggregations at once doesn't seem to work; so we do them
-        # separately, lazily, and then stitch them together
-
-        tokens_agg = (
-            events.lazy()
-            # order concurrent events by vocabulary, which itself was formed with
-            # contiguous categories
-            .sort("event_time", pl.col("tokens").list.first())
-            .group_by("hospitalization_id", maintain_order=True)
-            .agg([pl.col("tokens").explode()])
-        )
-
-        times_agg = (
+        # order concurrent events by vocabulary, which itself was formed with
+        # contiguous categories; tokens and times are aggregated together so
+        # that they remain paired
+        event_tokens = (
             events.lazy()
-            .sort("event_time")
+            .sort(
+                "hospitalization_id",
+                "event_time",
+                pl.col("tokens").list.first(),
+                maintain_order=True,
+            )
             .group_by("hospitalization_id", maintain_order=True)
-            .agg([pl.col("times").explode()])
+            .agg(pl.col("tokens").explode(), pl.col("times").explode())
         )
+        return event_tokens
 
-        event_tokens = tokens_agg.join(
-            times_agg, on="hospitalization_id", validate="1:1", maintain_order="left"
+    def cut_at_times(
+        self, tokens_timelines: Frame, durations: typing.Sequence[pl.Expr]
+    ) -> list[Frame]:
+        """
+        select the initial portion of each timeline for each of several
+        `durations`, measured from the earliest time in the timeline (or from
+        `window_start`, if present; see `get_tokens_timelines`); a timeline
+        is cut just before the first token that falls outside the window, and
+        timelines whose first token already falls outside of it (e.g. due to
+        events recorded before admission) are dropped
+
+        the search runs once over the flattened times of all timelines: per-
+        timeline offsets locate the first failing position with `np.searchsorted`
+        """
+        is_lazy = isinstance(tokens_timelines, pl.LazyFrame)
+        tt = tokens_timelines.lazy().filter(pl.col("times").list.len() > 0).collect()
+        if tt.height == 0:
+            return [tt.lazy() if is_lazy else tt for _ in durations]
+        n = tt.get_column("times").list.len().to_numpy().astype(np.int64)
+        t = tt.get_column("times").explode().to_numpy()
+        start = np.cumsum(n) - n
+        t0 = (
+            tt.get_column("window_start").to_numpy().astype(t.dtype)
+            if "window_start" in tt.columns
+            else np.minimum.reduceat(t, start)
         )
-        return event_tokens
+        rel = t - np.repeat(t0, n)
+        ret = list()
+        for d in durations:
+            δ = np.timedelta64(pl.select(d).item()).astype(rel.dtype)
+            fails = np.append(np.flatnonzero(rel > δ), t.size)
+            first_fail = np.minimum(fails[np.searchsorted(fails, start)], start + n)
+            ret.append(
+                tt.with_columns(valid_length=pl.Series(first_fail - start))
+                .filter(pl.Series(rel[start] <= δ))
+                .with_columns(
+                    pl.col(c).list.head(pl.col("valid_length"))
+                    for c in ("tokens", "times", "events")
+                    if c in tt.columns
+                )
+                .drop("valid_length")
+            )
+        return [x.lazy() for x in ret] if is_lazy else ret
 
     def cut_at_time(
         self, tokens_timelines: Frame, duration: pl.Duration = pl.duration(days=1)
     ) -> Frame:
         """allows us to select the first 24h of someone's timeline for predictive purposes"""
-        tt = (
-            tokens_timelines.with_columns(
-                first_fail_or_0=(
-                    pl.col("times").list.eval(
-                        pl.element() - pl.col("").min() <= duration
-                    )
-                ).list.arg_min()
-            )
-            .with_columns(
-                valid_length=pl.when(pl.col("first_fail_or_0") == 0)
-                .then(pl.col("times").list.len())
-                .otherwise(pl.col("first_fail_or_0"))
-            )
-            .with_columns(
-                pl.col("times").list.head(pl.col("valid_length")),
-                pl.col("tokens").list.head(pl.col("valid_length")),
+        return self.cut_at_times(tokens_timelines, [duration])[0]
+
+    def cache_key(self) -> str:
+        """
+        fingerprint of everything that `process_tables` depends on: the input
+        files (names, sizes and modification times), the vocabulary it starts
+        from, and the options that affect how the tables are processed
+        """
+        h = hashlib.sha256()
+        for p in sorted(self.data_dir.glob("*.parquet")):
+            st = p.stat()
+            h.update(f"{p.name}:{st.st_size}:{st.st_mtime_ns};".encode())
+        h.update(repr(list(self.vocab.lookup.items())).encode())
+        for k, v in self.vocab.aux.items():
+            h.update(
+                repr(
+                    (k, sorted(v) if isinstance(v, set) else list(map(float, v)))
+                ).encode()
             )
-            .filter(pl.col("times").list.max() - pl.col("times").list.min() <= duration)
+        h.update(
+            repr(
+                (
+                    CACHE_VERSION,
+                    tuple(TABLE_PROCESSORS.keys()),
+                    self.vocab.is_training,
+                    self.lab_time,
+                    self.quantizer,
+                    tuple(self.valid_admission_window or ()),
+                    self.n_top_reports,
+                    self.fused_quantiles,
+                    self.i_part,
+                    self.n_parts,
+                    self.hospitalization_ids,
+                    self.quantile_sketch_eps,
+                )
+            ).encode()
         )
-        return tt
+        return h.hexdigest()[:32]
+
+    def load_cache(self, key: str) -> bool:
+        """
+        restore the processed tables (memory-mapped from Arrow IPC files) and
+        the vocabulary they were processed with, if `key` is in the cache
+        """
+        if (
+            self.cache_dir is None
+            or not (d := self.cache_dir.joinpath(key)).joinpath("vocab.gzip").exists()
+        ):
+            return False
+        self.vocab.load(d.joinpath("vocab.gzip"))
+        self.tbl = {f.stem: pl.read_ipc(f, memory_map=True) for f in d.glob("*.arrow")}
+        return True
+
+    def save_cache(self, key: str) -> None:
+        """
+        write the processed tables to the cache under `key`; event tables are
+        reduced to the columns that `get_events_frame` aggregates
+        """
+        if self.cache_dir is None:
+            return
+        tmp = self.cache_dir.joinpath(f".{key}-{os.getpid()}")
+        tmp.mkdir(exist_ok=True, parents=True)
+        for k, x in self.tbl.items():
+            x = x.lazy()
+            if k not in ("patient", "hospitalization"):
+                x = x.select("hospitalization_id", "event_time", "tokens", "times")
+            x.collect().write_ipc(tmp.joinpath(f"{k}.arrow"))
+        self.vocab.save(tmp.joinpath("vocab.gzip"))
+        try:
+            tmp.rename(self.cache_dir.joinpath(key))
+        except OSError:  # another process got there first
+            shutil.rmtree(tmp)
+
+    def invalidate_cache(self) -> None:
+        """drop the cache entry that this tokenizer would currently use"""
+        if self.cache_dir is not None:
+            clean_cache(self.cache_dir, key=self.cache_key())
 
     def get_tokens_timelines(self) -> Frame:
-        self.load_tables()
-        self.process_tables()
+        key = self.cache_key() if self.cache_dir is not None else None
+        with self.profiler.stage("load_cache") as rec:
+            rec.update(hit=self.load_cache(key))
+        if not rec["hit"]:
+            self.load_tables()
+            self.process_tables()
+            with self.profiler.stage("save_cache"):
+                self.save_cache(key)
         self.run_times_qc()
 
+        if self.collapse_repeats:
+            with self.profiler.stage("collapse_repeats") as rec:
+                removed = self.collapse_repeated_events()
+                n_removed = removed.height
+                rec.update(tokens_removed=n_removed)
+
+        with self.profiler.stage("get_events_frame") as rec:
+            events = self.profiler.collect(self.get_events_frame(), rec)
+
         # combine the admission tokens, event tokens, and discharge tokens
-        tt = (
+        with self.profiler.stage("join_admission_discharge") as rec:
+            tt = self.profiler.collect(self.join_admission_discharge(events), rec)
+
+        if self.collapse_repeats:
+            # the removed tokens that would have survived the cut and drops
+            removed = (
+                removed.lazy()
+                .join(
+                    tt.lazy().select(
+                        "hospitalization_id", start=pl.col("times").list.min()
+                    ),
+                    on="hospitalization_id",
+                )
+                .filter(
+                    ~pl.col("token").is_in(self.denied_tokens())
+                    & (
+                        pl.col("time") - pl.col("start") <= pl.duration(days=1)
+                        if self.cut_at_24h
+                        else pl.lit(True)
+                    )
+                )
+                .group_by("hospitalization_id")
+                .agg(n_removed=pl.len().cast(pl.Int64))
+                .collect()
+            )
+
+        if self.cut_at_24h:
+            with self.profiler.stage("cut_at_time") as rec:
+                tt = self.profiler.collect(self.cut_at_time(tt), rec)
+
+        if denied := self.denied_tokens():
+            # windows are measured from the start of the timeline before any
+            # tokens were dropped (see `cut_at_times`)
+            with self.profiler.stage("drop_tokens") as rec:
+                tt = self.profiler.collect(
+                    drop_tokens(
+                        tt.with_columns(window_start=pl.col("times").list.min()), denied
+                    ),
+                    rec,
+                )
+
+        if self.collapse_repeats:
+            # timelines that now fit, but would not have without collapsing
+            n = (
+                tt.lazy()
+                .join(removed.lazy(), on="hospitalization_id", how="left")
+                .select(
+                    fit=(
+                        (pl.col("tokens").list.len() <= self.max_padded_length)
+                        & (
+                            pl.col("tokens").list.len()
+                            + pl.col("n_removed").fill_null(0)
+                            > self.max_padded_length
+                        )
+                    ).sum()
+                    if self.max_padded_length is not None
+                    else pl.lit(None)
+                )
+                .collect()
+                .row(0, named=True)
+            )
+            self.collapse_stats = {
+                "tokens_removed": n_removed,
+                "timelines_now_fit": n["fit"],
+            }
+
+        return tt.lazy().with_columns(events=event_runs()).collect()
+
+    def join_admission_discharge(self, events: Frame) -> pl.LazyFrame:
+        """place the event tokens between the admission and discharge tokens"""
+        return (
             self.get_admission_frame()
             .lazy()
             .join(
-                self.get_events_frame(),
+                events.lazy(),
                 on="hospitalization_id",
                 how="left",
-                validate="1:1",
+                validate=self.join_validation("1:1"),
             )
             .join(
                 self.get_discharge_frame().lazy(),
                 on="hospitalization_id",
-                validate="1:1",
+                validate=self.join_validation("1:1"),
             )
             .with_columns(
                 tokens=pl.concat_list("adm_tokens", "tokens", "dis_tokens"),
@@ -645,85 +984,340 @@ def get_tokens_timelines(self) -> Frame:
             .sort(by="hospitalization_id")
         )
 
-        if self.day_stay_filter:
-            tt = tt.filter(
-                (pl.col("times").list.get(-1) - pl.col("times").list.get(0))
-                >= pl.duration(days=1)
-            )
-
+    def tokens_timelines_plan(self) -> pl.LazyFrame:
+        """
+        the whole of `get_tokens_timelines` followed by `pad_and_truncate` as a
+        single lazy query over the raw tables, for use with a frozen vocabulary
+        (whose words and cut points are compiled into the plan as literals);
+        the tables are never collected in between, so that the plan can be
+        inspected with `explain` as a whole (see `write_tokens_timelines_sharded`
+        with `lazy=True`); words that are not in the vocabulary are
+        mapped to the null token without being tallied in `vocab.unseen`
+        """
+        if self.vocab.is_training:
+            raise ValueError("A lazy plan requires a frozen vocabulary")
+        if self.collapse_repeats:
+            raise ValueError("collapse_repeats is not supported in a lazy plan")
+        self.load_tables()
+        self.tbl = {
+            p.table: p.tokenize(self, p.prepare(self, self.tbl[p.table].lazy()))
+            for p in TABLE_PROCESSORS.values()
+            if p.table in self.tbl or not p.optional
+        }
+        self.run_times_qc()
+        tt = self.join_admission_discharge(self.get_events_frame())
         if self.cut_at_24h:
-            tt = self.cut_at_time(tt)
-
-        if self.drop_deciles or self.drop_nulls_nans:
-            filtered = (
-                tt.explode("tokens", "times")
-                .filter(pl.col("tokens") >= 10 if self.drop_deciles else pl.lit(True))
-                .filter(
-                    (~pl.col("tokens").is_in([self.vocab(None), self.vocab("nan")]))
-                    if self.drop_nulls_nans
-                    else pl.lit(True)
-                )
-            )
-            new_times = filtered.group_by(
-                "hospitalization_id", maintain_order=True
-            ).agg([pl.col("times")])
-            new_tokens = filtered.group_by(
-                "hospitalization_id", maintain_order=True
-            ).agg([pl.col("tokens")])
-            tt = new_tokens.join(
-                new_times,
-                on="hospitalization_id",
-                validate="1:1",
-                maintain_order="left",
+            tt = cut_within(tt, pl.duration(days=1))
+        if denied := self.denied_tokens():
+            tt = drop_tokens(
+                tt.with_columns(window_start=pl.col("times").list.min()), denied
+            )
+        tt = tt.with_columns(events=event_runs())
+        if self.max_padded_length is None:
+            return tt
+        return (
+            tt.with_columns(seq_len=pl.col("tokens").list.len())
+            .with_columns(
+                padded=padded_list(
+                    max_padded_length=self.max_padded_length,
+                    pad_token=self.vocab("PAD"),
+                    trunc_token=self.vocab("TRUNC"),
+                )
             )
+            .sort(pl.col("seq_len") > self.max_padded_length, maintain_order=True)
+        )
 
-        return tt.collect()
+    def denied_tokens(self) -> list[int]:
+        """
+        tokens to be dropped from the timelines: the quantile tokens if
+        `drop_deciles` (which is incompatible with `fused_quantiles`, where
+        there are none), the null / nan tokens if `drop_nulls_nans`, and every
+        word of the vocabulary matching one of the shell-style patterns in
+        `drop_words` (e.g. "Q*", "LAB_*", or "*_None")
+        """
+        denied = set()
+        if self.drop_deciles:
+            denied |= {self.vocab.lookup[q] for q in self.q_tokens}
+        if self.drop_nulls_nans:
+            denied |= {self.vocab.lookup[w] for w in (None, "nan")}
+        if self.drop_words:
+            denied |= {
+                t
+                for w, t in self.vocab.lookup.items()
+                if w is not None
+                and any(fnmatch.fnmatchcase(str(w), p) for p in self.drop_words)
+            }
+        return sorted(denied)
 
     def pad_and_truncate(self, tokens_timelines: Frame) -> Frame:
-        if self.max_padded_length is not None:
-            tt = tokens_timelines.lazy().with_columns(
-                seq_len=pl.col("tokens").list.len()
+        """
+        add `seq_len` and the fixed-width `padded` version of `tokens`, filled
+        in one vectorized pass over the flat token buffer; timelines that fit
+        within `max_padded_length` precede those that were truncated
+        """
+        with self.profiler.stage("pad_and_truncate"):
+            if self.max_padded_length is None:
+                return tokens_timelines
+            tt = (
+                tokens_timelines.lazy()
+                .with_columns(seq_len=pl.col("tokens").list.len())
+                .collect()
             )
-            tt_under = tt.filter(
-                pl.col("seq_len") <= self.max_padded_length
-            ).with_columns(
-                padded=pl.concat_list(
-                    "tokens",
-                    pl.lit(self.vocab("PAD")).repeat_by(
-                        self.max_padded_length - pl.col("seq_len")
-                    ),
-                )
+            tt = tt.sort(
+                pl.col("seq_len") > self.max_padded_length, maintain_order=True
             )
-            tt_over = tt.filter(
-                pl.col("seq_len") > self.max_padded_length
-            ).with_columns(
-                padded=pl.concat_list(
-                    pl.col("tokens").list.slice(
-                        offset=0, length=self.max_padded_length - 1
-                    ),
-                    pl.lit(self.vocab("TRUNC")),
+            tokens, offsets = flat_tokens(tt)
+            padded = padded_matrix(
+                tokens,
+                offsets,
+                max_padded_length=self.max_padded_length,
+                pad_token=self.vocab("PAD"),
+                trunc_token=self.vocab("TRUNC"),
+                dtype=np.int64,
+            )
+            return tt.with_columns(
+                padded=pl.Series(
+                    padded, dtype=pl.Array(pl.Int64, padded.shape[1])
+                ).cast(pl.List(pl.Int64))
+            )
+
+    def write_tokens_timelines_sharded(
+        self, out_file: Pathlike, n_parts: int, *, lazy: bool = False
+    ) -> pathlib.Path:
+        """
+        out-of-core version of `get_tokens_timelines` followed by
+        `pad_and_truncate`; in training mode, the vocabulary and quantiles are
+        first learned bucket by bucket from mergeable quantile sketches (so
+        `quantile_sketch_eps` is required), so that no table is held in memory
+        in full; hospitalizations are then tokenized with the frozen
+        vocabulary in `n_parts` hash buckets of `hospitalization_id`, so that
+        peak memory scales with the size of a bucket, and each bucket is
+        written as a separate part; finally, the parts are stitched together
+        in the order `pad_and_truncate` produces; with `lazy`, each bucket is
+        tokenized by the single query of `tokens_timelines_plan` instead (its
+        plan is recorded by the profiler), which is collected rather than sunk
+        to disk, as polars' streaming engine cannot run its list aggregations
+        and final sort (as of polars 1.20)
+        """
+        is_training = self.vocab.is_training
+        if is_training and self.quantile_sketch_eps is None:
+            raise ValueError(
+                "Out-of-core training learns quantiles bucket by bucket and "
+                "requires quantile_sketch_eps"
+            )
+        out_file = pathlib.Path(out_file).expanduser().resolve()
+        parts_dir = out_file.parent.joinpath(out_file.stem + "-parts")
+        parts_dir.mkdir(exist_ok=True, parents=True)
+
+        if is_training:
+            # learn words and quantile sketches one bucket at a time, then
+            # derive the cut points from the merged sketches
+            self.accumulate_sketches = True
+            for i in range(n_parts):
+                self.i_part, self.n_parts = i, n_parts
+                with self.profiler.stage(f"learn_part-{i:04d}"):
+                    self.load_tables()
+                    self.process_tables()
+                self.tbl = dict()
+            self.accumulate_sketches = False
+            self.set_quants_from_sketches()
+            if self.fused_quantiles:
+                # fused words need cut points, which only now exist; as it is
+                # not known which bins will be observed, every category gets a
+                # word for each quantile, in order of category and quantile
+                self.vocab.update(
+                    f"{d}_{q}"
+                    for d in sorted(
+                        (d for d in self.sketches if d in self.vocab.lookup),
+                        key=self.vocab.lookup.get,
+                    )
+                    for q in self.q_tokens
                 )
+            for p in TABLE_PROCESSORS.values():
+                p.finalize_training(self)
+            self.vocab.is_training = False
+
+        for i in range(n_parts):
+            self.i_part, self.n_parts = i, n_parts
+            with self.profiler.stage(f"part-{i:04d}") as rec:
+                if lazy:
+                    plan = self.tokens_timelines_plan()
+                    self.profiler.explain(rec["stage"], plan)
+                    tt = plan.collect()
+                else:
+                    tt = self.pad_and_truncate(self.get_tokens_timelines())
+                tt.write_parquet(parts_dir.joinpath(f"part-{i:04d}.parquet"))
+            self.tbl = dict()
+        self.i_part = self.n_parts = None
+        self.vocab.is_training = is_training
+
+        with self.profiler.stage("stitch_parts"):
+            self.stitch_parts(parts_dir, out_file)
+        return out_file
+
+    def sort_tokens_timelines(self, tokens_timelines: Frame) -> Frame:
+        """
+        sort `tokens_timelines` in the order `pad_and_truncate` produces for
+        timelines sorted by `hospitalization_id` (those that fit within
+        `max_padded_length` precede those that were truncated)
+        """
+        if self.max_padded_length is None:
+            return tokens_timelines.sort("hospitalization_id")
+        return (
+            tokens_timelines.with_columns(
+                is_truncated=pl.col("tokens").list.len() > self.max_padded_length
             )
-            return pl.concat([tt_under, tt_over]).collect()
+            .sort("is_truncated", "hospitalization_id")
+            .drop("is_truncated")
+        )
+
+    def stitch_parts(self, parts_dir: Pathlike, out_file: Pathlike) -> None:
+        """
+        combine the padded and truncated parts in `parts_dir` into `out_file`
+        in the order of `sort_tokens_timelines`, and remove the parts
+        """
+        parts_dir = pathlib.Path(parts_dir)
+        self.sort_tokens_timelines(
+            pl.scan_parquet(parts_dir.joinpath("*.parquet"))
+        ).sink_parquet(out_file)
+        for p in parts_dir.glob("*.parquet"):
+            p.unlink()
+        parts_dir.rmdir()
+
+    def window_tokens_timelines(
+        self,
+        in_file: Pathlike,
+        out_files: dict[str, Pathlike],
+        *,
+        batch_size: int = 100_000,
+    ) -> None:
+        """
+        derive cut versions of an existing (uncut) tokens_timelines parquet file
+        without re-tokenizing the raw tables; `out_files` maps durations such as
+        "24h" or "2d" to destinations, e.g. `{"24h": ".../tokens_timelines.parquet"}`;
+        the input is streamed once in batches of `batch_size` timelines, each of
+        which is cut at every duration and padded and truncated anew, and the
+        batches are then stitched together per destination
+        """
+        in_file = pathlib.Path(in_file).expanduser().resolve()
+        out_files = {
+            d: pathlib.Path(f).expanduser().resolve() for d, f in out_files.items()
+        }
+        durations = [parse_duration(d) for d in out_files.keys()]
+        parts_dirs = {
+            d: f.parent.joinpath(f.stem + "-parts") for d, f in out_files.items()
+        }
+        for p in parts_dirs.values():
+            p.mkdir(exist_ok=True, parents=True)
+        src = scan_tokens_timelines(in_file)
+        columns = [
+            c
+            for c in ("hospitalization_id", "tokens", "times", "window_start", "events")
+            if c in src.collect_schema().names()
+        ]
+        if not in_file.exists():  # only the compact version was kept
+            batches = src.select(columns).collect().to_arrow().to_batches(batch_size)
+        elif (pf := pq.ParquetFile(in_file)).metadata.num_rows > 0:
+            batches = pf.iter_batches(batch_size=batch_size, columns=columns)
         else:
-            return tokens_timelines
+            batches = []
+        batches = batches or [src.select(columns).clear().collect().to_arrow()]
+        for i, batch in enumerate(batches):
+            tt = pl.from_arrow(batch).sort("hospitalization_id")
+            for d, tt_cut in zip(out_files.keys(), self.cut_at_times(tt, durations)):
+                self.pad_and_truncate(tt_cut).write_parquet(
+                    parts_dirs[d].joinpath(f"part-{i:04d}.parquet")
+                )
+        for d, f in out_files.items():
+            self.stitch_parts(parts_dirs[d], f)
+
+    def write_compact(self, tokens_timelines: Frame, out_dir: Pathlike) -> pathlib.Path:
+        """
+        write `tokens_timelines` in the compact, memory-mappable format of
+        `fms_ehrs.framework.compact`; the padded matrix is not stored but
+        recomputed on read from this tokenizer's padding length and tokens
+        """
+        return write_compact(
+            tokens_timelines,
+            out_dir,
+            max_padded_length=self.max_padded_length,
+            pad_token=self.vocab("PAD"),
+            trunc_token=self.vocab("TRUNC"),
+        )
+
+    def write_padded(
+        self, tokens_timelines: Frame, parquet_file: Pathlike
+    ) -> pathlib.Path:
+        """
+        write the padded matrix of `tokens_timelines`, the contents of
+        `parquet_file`, as a memory-mappable uint16 `.npy` file alongside it
+        (see `fms_ehrs.framework.compact.load_padded`)
+        """
+        return write_padded(
+            tokens_timelines,
+            parquet_file,
+            max_padded_length=self.max_padded_length,
+            pad_token=self.vocab("PAD"),
+            trunc_token=self.vocab("TRUNC"),
+        )
 
     def print_aux(self) -> None:
         self.vocab.print_aux()
 
 
+def token_frequencies(
+    tokenizer: ClifTokenizer, tokens_timelines: Frame
+) -> pl.DataFrame:
+    """
+    the number of occurrences of each token of the vocabulary in
+    `tokens_timelines`, with its word and type; counts are taken with a single
+    `np.bincount` over the flat token buffer
+    """
+    values, offsets = flat_tokens(tokens_timelines)
+    words = [tokenizer.vocab.reverse.get(i) for i in range(len(tokenizer.vocab))]
+    return pl.DataFrame(
+        {
+            "token": np.arange(len(words), dtype=np.int64),
+            "word": [w if w is None else str(w) for w in words],
+            "type": [type_names.get(t := token_type(w), t) for w in words],
+            "count": np.bincount(
+                values[offsets[0] : offsets[-1]], minlength=len(words)
+            ).astype(np.int64),
+        }
+    )
+
+
 def summarize(
     tokenizer: ClifTokenizer,
     tokens_timelines: Frame,
     k: int = 20,
     logger: logging.Logger = None,
-) -> None:
-    """provide posthoc summary statistics"""
+    freq_file: Pathlike = None,
+) -> pl.DataFrame:
+    """
+    provide posthoc summary statistics; the per-token frequency table is
+    returned and, if `freq_file` is given, written to parquet there
+    """
 
     post = logger.info if logger is not None else print
+    tokens_timelines = tokens_timelines.lazy().select("tokens", "times").collect()
+    freq = token_frequencies(tokenizer, tokens_timelines)
 
-    post("Timelines generated: {}".format(tokens_timelines.shape[0]))
+    post("Timelines generated: {}".format(tokens_timelines.height))
     post("Vocabulary size: {}".format(len(tokenizer.vocab)))
+    if stats := tokenizer.collapse_stats:
+        post(
+            "Repeated measurements collapsed: {tokens_removed} tokens removed, "
+            "{timelines_now_fit} timelines moved under the padded length".format(
+                **stats
+            )
+        )
+    if n_fused := fused_tokens(tokenizer.vocab).height:
+        post(
+            "Fused category-quantile tokens: {} ({:.1%} of the vocabulary)".format(
+                n_fused, n_fused / len(tokenizer.vocab)
+            )
+        )
 
     post(
         "Summary stats of timeline lengths: \n {}".format(
@@ -731,43 +1325,159 @@ def summarize(
         )
     )
 
+    words = np.array(freq.get_column("word").to_list(), dtype=object)
     for s in range(3):
-        post(
-            "Example timeline: \n {}".format(
-                [
-                    tokenizer.vocab.reverse[t]
-                    for t in tokens_timelines.sample(1, seed=s).select("tokens").item()
-                ]
+        if tokens_timelines.height > 0:
+            post(
+                "Example timeline: \n {}".format(
+                    words[
+                        tokens_timelines.sample(1, seed=s)
+                        .get_column("tokens")
+                        .explode()
+                        .drop_nulls()
+                        .to_numpy()
+                    ].tolist()
+                )
             )
-        )
 
     post(
         "Summary stats of timeline duration: \n {}".format(
             tokens_timelines.select(
-                pl.col("times").list.min().alias("start_time"),
-                pl.col("times").list.max().alias("end_time"),
-            )
-            .select((pl.col("end_time") - pl.col("start_time")).alias("duration"))
-            .describe()
+                (pl.col("times").list.last() - pl.col("times").list.first()).alias(
+                    "duration"
+                )
+            ).describe()
         )
     )
 
-    with pl.Config(tbl_rows=len(tokenizer.vocab)):
+    with pl.Config(tbl_rows=len(type_names) + 1):
+        post(
+            "Tokens by type: \n {}".format(
+                freq.group_by("type")
+                .agg(pl.col("count").sum(), pl.len().alias("vocab_size"))
+                .with_columns(share=pl.col("count") / pl.col("count").sum())
+                .sort("count", descending=True)
+            )
+        )
+
+    with pl.Config(tbl_rows=k):
         post(
             "Top {k} tokens by usage: \n {out}".format(
                 k=k,
-                out=tokens_timelines.select("tokens")
-                .explode("tokens")
-                .rename({"tokens": "token"})
-                .join(tokenizer.vocab.get_frame(), on="token")
-                .select("word")
-                .to_series()
-                .value_counts()
-                .sort("count", descending=True)
+                out=freq.filter(pl.col("count") > 0)
+                .sort("count", descending=True, maintain_order=True)
+                .select("word", "count")
                 .head(k),
             )
         )
 
+    if freq_file is not None:
+        freq.write_parquet(freq_file := pathlib.Path(freq_file).expanduser().resolve())
+        fix_perms(freq_file)
+    return freq
+
+
+def drop_tokens(tokens_timelines: Frame, denied: typing.Iterable[int]) -> Frame:
+    """
+    remove the `denied` tokens (and their times) from each timeline; the mask
+    is computed once per timeline from `tokens` and applied to both lists, so
+    that the frame stays at one row per timeline instead of being exploded to
+    one row per token
+    """
+    denied = list(denied)
+    return (
+        tokens_timelines.with_columns(
+            keep=pl.col("tokens").list.eval(pl.arg_where(~pl.element().is_in(denied)))
+        )
+        .with_columns(pl.col("tokens", "times").list.gather(pl.col("keep")))
+        .drop("keep")
+    )
+
+
+def cut_within(tokens_timelines: pl.LazyFrame, duration: pl.Expr) -> pl.LazyFrame:
+    """
+    expression counterpart of `ClifTokenizer.cut_at_time` for use within a
+    lazy plan: each timeline is cut just before the first token more than
+    `duration` after its earliest time (or `window_start`, if present), and
+    timelines whose first token already is are dropped
+    """
+    names = tokens_timelines.collect_schema().names()
+    t0 = "window_start" if "window_start" in names else pl.col("times").list.min()
+    return (
+        tokens_timelines.filter(pl.col("times").list.len() > 0)
+        .with_columns(
+            # the start is prepended, so positions in `times` are shifted by one
+            valid_length=pl.concat_list(t0, "times")
+            .list.eval(pl.arg_where(pl.element() - pl.element().first() > duration))
+            .list.first()
+            .sub(1)
+            .fill_null(pl.col("times").list.len())
+        )
+        .filter(pl.col("valid_length") > 0)
+        .with_columns(
+            pl.col(c).list.head(pl.col("valid_length"))
+            for c in ("tokens", "times", "events")
+            if c in names
+        )
+        .drop("valid_length")
+    )
+
+
+def padded_list(
+    *, max_padded_length: int, pad_token: int, trunc_token: int, tokens: str = "tokens"
+) -> pl.Expr:
+    """
+    expression counterpart of `padded_matrix`: the list column `tokens` filled
+    with `pad_token` up to `max_padded_length`, or cut short to end with
+    `trunc_token`
+    """
+    n = max_padded_length
+    seq_len = pl.col(tokens).list.len().cast(pl.Int64)
+    return (
+        pl.when(seq_len > n)
+        .then(
+            pl.concat_list(
+                pl.col(tokens).list.head(n - 1), pl.lit(trunc_token, dtype=pl.Int64)
+            )
+        )
+        .otherwise(
+            pl.concat_list(
+                pl.col(tokens),
+                pl.lit(pad_token, dtype=pl.Int64).repeat_by((n - seq_len).clip(0)),
+            )
+        )
+    )
+
+
+def event_runs(times: str = "times") -> pl.Expr:
+    """
+    run-length event encoding of a list column of `times`: each token is
+    assigned the index of its event within the timeline, where an event is a
+    maximal run of consecutive tokens sharing a timestamp
+    """
+    return pl.col(times).list.eval(
+        (pl.element() != pl.element().shift()).fill_null(True).cum_sum() - 1
+    )
+
+
+def clean_cache(cache_dir: Pathlike, key: str = None) -> None:
+    """remove the entry `key` from the tokenizer cache, or all entries"""
+    cache_dir = pathlib.Path(cache_dir).expanduser().resolve()
+    if not cache_dir.exists():
+        return
+    for d in cache_dir.iterdir():
+        if d.is_dir() and (key is None or d.name == key):
+            shutil.rmtree(d)
+
+
+def parse_duration(d: str) -> pl.Expr:
+    """convert a string like "6h", "2d", or "90m" to a polars duration"""
+    if (m := re.fullmatch(r"(\d+)([dhm])", d.strip())) is None:
+        raise ValueError(f"Check duration {d=}")
+    return pl.duration(
+        **{{"d": "days", "h": "hours", "m": "minutes"}[m.group(2)]: int(m.group(1))}
+    )
+
 
 @functools.cache
 def token_type(word: str) -> str:
@@ -779,6 +1489,33 @@ def token_type(word: str) -> str:
         return word.split("_")[0]
 
 
+def fused_tokens(vocab: Vocabulary) -> pl.DataFrame:
+    """
+    decompose the fused words `{label}_{category}_{Qk}` of `vocab` into the
+    tokens of their category (`{label}_{category}`) and quantile (`Qk`); one
+    row per fused token, ordered by token
+    """
+    rows = [
+        (t, w, vocab.lookup[c], vocab.lookup[q])
+        for w, t in vocab.lookup.items()
+        if isinstance(w, str)
+        and (m := re.fullmatch(r"(.+)_(Q\d|Q[0-3][+-])", w)) is not None
+        and vocab.has_aux(c := m.group(1))
+        and c in vocab.lookup
+        and (q := m.group(2)) in vocab.lookup
+    ]
+    return pl.DataFrame(
+        sorted(rows),
+        schema={
+            "token": pl.Int64,
+            "word": pl.String,
+            "category_token": pl.Int64,
+            "quantile_token": pl.Int64,
+        },
+        orient="row",
+    )
+
+
 type_names = collections.OrderedDict(
     Q="Q",
     RACE="RACE",
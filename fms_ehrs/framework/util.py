@@ -124,27 +124,66 @@ def collate_events_info(
     times: np.array,
     info: np.array,
     aggregation: typing.Literal["max", "sum", "perplexity"] = "sum",
+    *,
+    events: np.array = None,
 ):
     """given an array of `tokens` that occur at `times` and have context-
     aware information `info`, groups these tokens into events and calculates
-    information for these events according to the given `aggregation`
+    information for these events according to the given `aggregation`;
+    if the run-length encoding `events` of event ids (as emitted by the
+    tokenizer) is provided, `times` are ignored and each run of equal ids is
+    aggregated in a single segmented reduction, so that `events` and `info`
+    may span many timelines at once (see `ravel_events`)
     """
-    assert times.size == info.size
-    times_uniq, times_idx = np.unique(times, return_inverse=True)
+    if events is None:
+        assert times.size == info.size
+        times_uniq, times_idx = np.unique(times, return_inverse=True)
+        n_events = times_uniq.shape[0]
+    else:
+        assert events.size == info.size
+        is_start = np.ones(events.shape, dtype=bool)
+        is_start[1:] = events[1:] != events[:-1]
+        starts = np.flatnonzero(is_start)
+        times_idx = np.cumsum(is_start) - 1
+        n_events = starts.shape[0]
+        if n_events == 0:
+            return np.zeros(shape=(0,)), times_idx
     if aggregation == "max":
-        info_agg = np.full(times_uniq.shape, -np.inf)
-        np.maximum.at(info_agg, times_idx, info)
+        if events is None:
+            info_agg = np.full((n_events,), -np.inf)
+            np.maximum.at(info_agg, times_idx, info)
+        else:
+            info_agg = np.maximum.reduceat(info.astype(np.float64), starts)
     elif aggregation in ("sum", "perplexity"):
-        info_agg = np.zeros(shape=times_uniq.shape)
-        np.add.at(info_agg, times_idx, info)
+        if events is None:
+            info_agg = np.zeros(shape=(n_events,))
+            np.add.at(info_agg, times_idx, info)
+        else:
+            info_agg = np.add.reduceat(info.astype(np.float64), starts)
         if aggregation == "perplexity":
-            info_agg /= np.bincount(times_idx, minlength=times_uniq.shape[0])
+            info_agg /= np.bincount(times_idx, minlength=n_events)
             np.exp2(info_agg, out=info_agg)  # exponentiates in-place
     else:
         raise Exception("Check aggregation.")
     return info_agg, times_idx
 
 
+def ravel_events(
+    evs_arr: typing.List[np.array], tlens: np.array = None
+) -> tuple[np.array, np.array]:
+    """given an array `evs_arr` of per-timeline event ids (each starting from
+    0), optionally truncated to lengths `tlens`, form one flat array of event
+    ids that are distinct across timelines, together with the number of
+    events in each timeline
+    """
+    if tlens is None:
+        tlens = np.array([len(e) for e in evs_arr])
+    evs = [np.asarray(e[:n], dtype=np.int64) for e, n in zip(evs_arr, tlens)]
+    n_evs = np.array([e[-1] + 1 if e.size else 0 for e in evs], dtype=np.int64)
+    flat = np.concatenate(evs) if evs else np.zeros(shape=(0,), dtype=np.int64)
+    return flat + np.repeat(np.cumsum(n_evs) - n_evs, tlens), n_evs
+
+
 def redact_tokens_times(
     tks_arr: typing.List[np.array],
     tms_arr: typing.List[np.array],
@@ -155,6 +194,7 @@ def redact_tokens_times(
     method: typing.Literal["top", "bottom", "random"] = "top",
     aggregation: typing.Literal["max", "sum", "perplexity"] = "max",
     rng: np.random._generator.Generator = np.random.default_rng(seed=42),
+    evs_arr: typing.List[np.array] = None,
 ) -> tuple[np.array, np.array]:
     """given an array `tks_arr` of arrays of tokens and an array `tms_arr` of
     arrays of times, and an array `inf_arr` containing the information content
@@ -164,10 +204,24 @@ def redact_tokens_times(
     chosen tokens (not including the prefix, which we always keep); we specify
     the number of events either as fixed `k` for all timelines or as a `pct` of
     the total number of events in each timeline; one and only one of these should
-    be specified
+    be specified; if the tokenizer's event encoding `evs_arr` is provided, all
+    timelines are processed at once instead of one at a time (ties are then
+    broken in favor of earlier events)
     """
     assert len(tks_arr) == len(tms_arr) == len(inf_arr)
     assert (k is not None) ^ (pct is not None)  # xor
+    if evs_arr is not None:
+        return _redact_tokens_times_by_events(
+            tks_arr,
+            tms_arr,
+            evs_arr,
+            inf_arr,
+            k=k,
+            pct=pct,
+            method=method,
+            aggregation=aggregation,
+            rng=rng,
+        )
     tks_new = copy.deepcopy(tks_arr)
     tms_new = copy.deepcopy(tms_arr)
     for i in range(len(tks_new)):
@@ -191,6 +245,50 @@ def redact_tokens_times(
     return tks_new, tms_new
 
 
+def _redact_tokens_times_by_events(
+    tks_arr, tms_arr, evs_arr, inf_arr, *, k, pct, method, aggregation, rng
+) -> tuple[np.array, np.array]:
+    """vectorized version of `redact_tokens_times` for run-length encoded
+    events; events are ranked within each timeline with a single lexsort"""
+    assert len(evs_arr) == len(tks_arr)
+    tlens = np.array(
+        [min(len(tk), len(ev)) for tk, ev in zip(tks_arr, evs_arr)], dtype=np.int64
+    )
+    evs, n_evs = ravel_events(evs_arr, tlens)
+    infm = inf_arr[np.arange(inf_arr.shape[1]) < tlens[:, np.newaxis]]
+    if method in ("top", "bottom"):
+        result, idx = collate_events_info(None, infm, aggregation, events=evs)
+        key = -result if method == "top" else result
+    elif method == "random":
+        idx = collate_events_info(None, infm, "sum", events=evs)[1]
+        key = rng.random(n_evs.sum())
+    else:
+        raise Exception(f"Check {method=}")
+    first = np.cumsum(n_evs) - n_evs
+    owner = np.repeat(np.arange(len(n_evs)), n_evs)
+    key[first[n_evs > 0]] = np.inf  # don't drop prefix
+    order = np.lexsort((key, owner))
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.size) - first[owner[order]]
+    n_drop = (
+        np.minimum(k, np.maximum(n_evs - 1, 0))
+        if k is not None
+        else ((np.maximum(n_evs - 1, 0)) * pct).astype(np.int64)
+    )
+    keep = rank[idx] >= n_drop[owner[idx]]
+    bounds = np.cumsum(
+        np.bincount(np.repeat(np.arange(len(tlens)), tlens)[keep], minlength=len(tlens))
+    )[:-1]
+    tks_flat = np.concatenate([tk[:n] for tk, n in zip(tks_arr, tlens)])[keep]
+    tms_flat = np.concatenate([tm[:n] for tm, n in zip(tms_arr, tlens)])[keep]
+    tks_new, tms_new = copy.copy(tks_arr), copy.copy(tms_arr)
+    for i, (tk, tm) in enumerate(
+        zip(np.split(tks_flat, bounds), np.split(tms_flat, bounds))
+    ):
+        tks_new[i], tms_new[i] = tk, tm
+    return tks_new, tms_new
+
+
 def count_top_q(values: list, q: float) -> typing.List[int]:
     """
     takes a ragged list of `values` and returns the number of values exceeding
@@ -218,6 +316,15 @@ def set_pd_options() -> None:
     print(redact_tokens_times(tks, tms, inf, k=1, aggregation="perplexity"))
     print(redact_tokens_times(tks, tms, inf, k=1, method="random"))
 
+    evs = [np.array([0] * 3 + [1] * 3 + [2] * 3 + [3])]
+    for agg in ("max", "sum", "perplexity"):
+        tks_e, tms_e = redact_tokens_times(
+            tks, tms, inf, k=1, aggregation=agg, evs_arr=evs
+        )
+        tks_t, tms_t = redact_tokens_times(tks, tms, inf, k=1, aggregation=agg)
+        assert np.array_equal(tks_e[0], tks_t[0])
+        assert np.array_equal(tms_e[0], tms_t[0])
+
     tms_unq, idx = np.unique(tms, return_inverse=True)
     result = np.zeros(shape=tms_unq.shape)
     np.add.at(result, idx, inf.ravel())
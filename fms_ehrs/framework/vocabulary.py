@@ -26,7 +26,8 @@ class Vocabulary:
     """
     maintains a dictionary `lookup` mapping words -> tokens,
     a dictionary `reverse` inverting the lookup, and a dictionary
-    `aux` mapping words -> auxiliary info
+    `aux` mapping words -> auxiliary info; once frozen, words that are not
+    in the vocabulary are counted in `unseen`
     """
 
     def __init__(self, words: tuple = (), *, is_training: bool = True):
@@ -34,6 +35,7 @@ def __init__(self, words: tuple = (), *, is_training: bool = True):
         self.lookup = {v: i for i, v in enumerate(words)}
         self.reverse = dict(enumerate(words))
         self.aux = dict()
+        self.unseen = collections.Counter()
         self._is_training = is_training
 
     def __call__(self, word: Hashable | None) -> int | None:
@@ -44,6 +46,7 @@ def __call__(self, word: Hashable | None) -> int | None:
                 self.lookup[word], self.reverse[n] = (n := len(self.lookup)), word
                 return n
             else:
+                self.unseen[word] += 1
                 warnings.warn(
                     "Encountered previously unseen token: {} {}".format(
                         word, type(word)
@@ -51,6 +54,15 @@ def __call__(self, word: Hashable | None) -> int | None:
                 )
                 return self.lookup[None] if None in self.lookup else None
 
+    def update(self, words: typing.Iterable[Hashable]) -> typing.Self:
+        """register a batch of `words` in their given order; words already in
+        the lookup keep their tokens, and unseen words are either added (when
+        training) or warned about (when frozen)"""
+        for word in words:
+            if word not in self.lookup:
+                self(word)
+        return self
+
     def set_aux(self, word: Hashable, aux_data):
         if self._is_training:
             self.aux[word] = aux_data
@@ -141,3 +153,7 @@ def print_aux(self):
     print(v2.aux)
 
     assert v2(42) == v2[42]
+
+    v3 = Vocabulary(("a", "b"))
+    v3.update(["b", "c", "a", "d", "c"])
+    assert v3.lookup == {"a": 0, "b": 1, "c": 2, "d": 3}
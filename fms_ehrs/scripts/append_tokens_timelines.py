@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""
+append newly received hospitalizations from a raw CLIF delta directory to a
+split of an existing tokenized version, with the vocabulary learned on its
+training set; only new hospitalizations, and those whose source rows changed,
+are tokenized (see `fms_ehrs.framework.incremental`)
+"""
+
+import json
+import os
+import pathlib
+
+import fire as fi
+import polars as pl
+
+from fms_ehrs.framework.incremental import append_tokens_timelines
+from fms_ehrs.framework.logger import get_logger
+from fms_ehrs.framework.storage import fix_perms
+from fms_ehrs.framework.tokenizer import ClifTokenizer
+
+logger = get_logger()
+logger.info("running {}".format(__file__))
+logger.log_env()
+
+
+@logger.log_calls
+def main(
+    *,
+    delta_dir: os.PathLike = None,
+    data_dir: os.PathLike = None,
+    data_version: str = "day_stays",
+    split: str = "test",
+    windows: tuple[str, ...] = (),
+    **kwargs,
+):
+    """
+    `kwargs` are passed to `ClifTokenizer` and should match the options the
+    version was tokenized with (e.g. `max_padded_len`, `day_stay_filter`);
+    cut versions `{data_version}_first_{d}` for durations `d` in `windows` are
+    re-derived from the updated timelines afterwards; a report of the append,
+    including any out-of-vocabulary words, is written next to the timelines as
+    `append_report.json`
+    """
+    data_dir = pathlib.Path(data_dir).expanduser().resolve()
+    windows = (windows,) if isinstance(windows, str) else tuple(windows)
+    vocab_path = data_dir.joinpath(f"{data_version}-tokenized", "train", "vocab.gzip")
+    f = data_dir.joinpath(
+        f"{data_version}-tokenized", split, "tokens_timelines.parquet"
+    )
+
+    report = append_tokens_timelines(
+        pathlib.Path(delta_dir).expanduser().resolve(),
+        f,
+        vocab_path=vocab_path,
+        logger=logger,
+        **kwargs,
+    )
+    with open(r := f.with_name("append_report.json"), "w") as fp:
+        json.dump(report, fp, indent=2)
+    fix_perms(r)
+
+    if windows and report["tokenized"]:
+        tkzr = ClifTokenizer(vocab_path=vocab_path, **kwargs)
+        dirs_out = {
+            d: data_dir.joinpath(f"{data_version}_first_{d}-tokenized", split)
+            for d in windows
+        }
+        for w in dirs_out.values():
+            w.mkdir(exist_ok=True, parents=True)
+        tkzr.window_tokens_timelines(
+            f, {d: dirs_out[d].joinpath("tokens_timelines.parquet") for d in windows}
+        )
+        if tkzr.max_padded_length is not None:
+            for d in windows:
+                w = dirs_out[d].joinpath("tokens_timelines.parquet")
+                tkzr.write_padded(pl.scan_parquet(w), w)
+
+
+if __name__ == "__main__":
+    fi.Fire(main)
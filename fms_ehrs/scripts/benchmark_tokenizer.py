@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+"""
+benchmark the tokenizer on synthetic CLIF data of increasing size: for each
+scale, a training set is tokenized to learn the vocabulary, and a held-out set
+(drawn with a different seed) is then tokenized with the frozen vocabulary;
+throughput and peak memory of each run are logged and collected in
+`benchmark.parquet`, and compared against a previous benchmark if provided
+"""
+
+import os
+import pathlib
+import shutil
+
+import fire as fi
+import polars as pl
+
+from fms_ehrs.framework.logger import get_logger
+from fms_ehrs.framework.profiling import frame_counts
+from fms_ehrs.framework.storage import fix_perms
+from fms_ehrs.framework.synthetic import generate_clif
+from fms_ehrs.framework.tokenizer import ClifTokenizer
+
+logger = get_logger()
+logger.info("running {}".format(__file__))
+logger.log_env()
+
+
+def count_records(data_dir: pathlib.Path) -> int:
+    return sum(
+        pl.scan_parquet(f).select(pl.len()).collect().item()
+        for f in data_dir.glob("*.parquet")
+    )
+
+
+@logger.log_calls
+def main(
+    *,
+    out_dir: os.PathLike = None,
+    scales: tuple[int, ...] = (1_000, 10_000, 100_000),
+    events_per_day: float = None,
+    seed: int = 42,
+    baseline: os.PathLike = None,
+    tolerance: float = 0.2,
+    keep_data: bool = False,
+    **kwargs,
+):
+    """
+    additional `kwargs` are passed to `ClifTokenizer` (e.g. `max_padded_len`,
+    `day_stay_filter`, or `fused_quantiles` to compare throughput and, when
+    padding, the share of truncated timelines against the two-token scheme);
+    if `baseline` points to an earlier `benchmark.parquet`, runs whose
+    throughput dropped or whose peak memory rose by more than `tolerance`
+    (relative) are flagged
+    """
+    out_dir = pathlib.Path(out_dir).expanduser().resolve()
+    out_dir.mkdir(exist_ok=True, parents=True)
+    scales = (scales,) if isinstance(scales, int) else tuple(scales)
+
+    results = list()
+    for n in scales:
+        dirs = {
+            "train": out_dir.joinpath(f"synthetic-{n}", "train"),
+            "frozen": out_dir.joinpath(f"synthetic-{n}", "test"),
+        }
+        for i, d in enumerate(dirs.values()):
+            generate_clif(
+                d, n_hospitalizations=n, events_per_day=events_per_day, seed=seed + i
+            )
+
+        vocab_path = None
+        for mode, d in dirs.items():
+            tkzr = ClifTokenizer(
+                data_dir=d, vocab_path=vocab_path, profile=True, **kwargs
+            )
+            with tkzr.profiler.stage(f"{mode}-{n}") as rec:
+                tt = tkzr.pad_and_truncate(tkzr.get_tokens_timelines())
+                rec.update(frame_counts(tt))
+            tkzr.profiler.write_report(out_dir.joinpath(f"report-{n}-{mode}.json"))
+            if mode == "train":
+                vocab_path = out_dir.joinpath(f"synthetic-{n}", "vocab.gzip")
+                tkzr.vocab.save(vocab_path)
+            n_records = count_records(d)
+            results.append(
+                {
+                    "scale": n,
+                    "mode": mode,
+                    "records": n_records,
+                    "timelines": rec["rows"],
+                    "tokens": rec["tokens"],
+                    "vocab_size": len(tkzr.vocab),
+                    "truncation_rate": (
+                        tt.select(
+                            (pl.col("seq_len") > tkzr.max_padded_length).mean()
+                        ).item()
+                        if tkzr.max_padded_length is not None
+                        else None
+                    ),
+                    "wall_s": rec["wall_s"],
+                    "cpu_s": rec["cpu_s"],
+                    "peak_rss_mib": rec["peak_rss_mib"],
+                    "records_per_s": n_records / rec["wall_s"],
+                    "tokens_per_s": rec["tokens"] / rec["wall_s"],
+                }
+            )
+            del tkzr, tt
+
+        if not keep_data:
+            shutil.rmtree(out_dir.joinpath(f"synthetic-{n}"))
+
+    res = pl.DataFrame(results)
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, tbl_width_chars=200):
+        logger.info(f"results:\n{res}")
+    res.write_parquet(f := out_dir.joinpath("benchmark.parquet"))
+    fix_perms(f)
+
+    if baseline is not None:
+        cmp = res.join(
+            pl.read_parquet(pathlib.Path(baseline).expanduser().resolve()),
+            on=("scale", "mode"),
+            suffix="_baseline",
+        ).with_columns(
+            throughput_ratio=pl.col("records_per_s") / pl.col("records_per_s_baseline"),
+            memory_ratio=pl.col("peak_rss_mib") / pl.col("peak_rss_mib_baseline"),
+        )
+        for row in cmp.iter_rows(named=True):
+            msg = "scale {scale} ({mode}): ".format(**row) + (
+                "throughput x{throughput_ratio:.2f}, "
+                "peak memory x{memory_ratio:.2f}".format(**row)
+            )
+            if (
+                row["throughput_ratio"] < 1 - tolerance
+                or row["memory_ratio"] > 1 + tolerance
+            ):
+                logger.warning(f"regression at {msg}")
+            else:
+                logger.info(msg)
+
+
+if __name__ == "__main__":
+    fi.Fire(main)
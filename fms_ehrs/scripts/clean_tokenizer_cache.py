@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+"""
+invalidate cached intermediates of the tokenizer, either a single entry (by its
+key, i.e. the name of its directory) or the whole cache
+"""
+
+import os
+import pathlib
+
+import fire as fi
+
+from fms_ehrs.framework.logger import get_logger
+from fms_ehrs.framework.tokenizer import clean_cache
+
+logger = get_logger()
+logger.info("running {}".format(__file__))
+logger.log_env()
+
+
+@logger.log_calls
+def main(*, cache_dir: os.PathLike = None, key: str = None):
+    cache_dir = pathlib.Path(cache_dir).expanduser().resolve()
+    for d in sorted(cache_dir.glob("*")) if cache_dir.exists() else ():
+        if d.is_dir() and (key is None or d.name == key):
+            logger.info(f"removing {d}")
+    clean_cache(cache_dir, key=key)
+
+
+if __name__ == "__main__":
+    fi.Fire(main)
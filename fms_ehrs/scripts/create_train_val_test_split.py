@@ -2,16 +2,19 @@
 
 """
 partition patients by order of appearance in the dataset into train-validation-test sets
+(or into folds, or by date of first admission)
 """
 
 import itertools
 import os
 import pathlib
+import typing
 
 import fire as fi
 import polars as pl
 
 from fms_ehrs.framework.logger import get_logger
+from fms_ehrs.framework.partition import patient_splits, split_names, write_splits
 
 logger = get_logger()
 logger.info("running {}".format(__file__))
@@ -27,13 +30,25 @@ def main(
     train_frac: float = 0.7,
     val_frac: float = 0.1,
     valid_admission_window: tuple[str, str] = None,
+    scheme: typing.Literal["ordered", "kfold", "time"] = "ordered",
+    n_folds: int = 5,
+    split_dates: tuple[str, str] = None,
+    batch_size: int = 1 << 20,
 ):
+    """
+    by default, patients are split by order of first admission according to
+    `train_frac` and `val_frac`; `scheme="kfold"` deals them into `n_folds`
+    folds `fold_{i}` instead, and `scheme="time"` splits them at the dates
+    `split_dates` (see `fms_ehrs.framework.partition.patient_splits`); each
+    table is read once, in batches of `batch_size` rows, and written to all
+    splits in the same pass
+    """
     data_dir_in, data_dir_out = map(
         lambda d: pathlib.Path(d).expanduser().resolve(), (data_dir_in, data_dir_out)
     )
 
     # make output sub-directories
-    splits = ("train", "val", "test")
+    splits = split_names(scheme, n_folds)
     dirs_out = dict()
     for s in splits:
         dirs_out[s] = data_dir_out.joinpath(data_version_out, s)
@@ -53,74 +68,45 @@ def main(
         )
     )
 
-    # partition patient ids
-    patient_ids = (
-        hosp_prepoc.group_by("patient_id")
-        .agg(pl.col("admission_dttm").min().alias("first_admission"))
-        .sort("first_admission")
-        .select("patient_id")
+    # label each patient, and each of their hospitalizations, with a split
+    p_splits = patient_splits(
+        hosp_prepoc,
+        scheme=scheme,
+        train_frac=train_frac,
+        val_frac=val_frac,
+        n_folds=n_folds,
+        split_dates=split_dates,
+    )
+    h_splits = (
+        hosp_prepoc.select("patient_id", "hospitalization_id")
+        .unique()
         .collect()
+        .join(p_splits, on="patient_id")
     )
 
-    n_total = patient_ids.n_unique()
-    n_train = int(train_frac * n_total)
-    n_val = int(val_frac * n_total)
-    n_test = n_total - (n_train + n_val)
-
-    logger.info(f"Patients {n_total=}")
-    logger.info(f"Partition: {n_train=}, {n_val=}, {n_test=}")
-
-    if n_test < 0:
-        raise f"check {train_frac=} and {val_frac=}"
-
-    p_ids = dict()
-    p_ids["train"] = patient_ids.head(n_train)
-    p_ids["val"] = patient_ids.slice(n_train, n_val)
-    p_ids["test"] = patient_ids.tail(n_test)
-
-    for s0, s1 in itertools.combinations(splits, 2):
-        assert p_ids[s0].join(p_ids[s1], on="patient_id").n_unique() == 0
-
-    assert sum(list(map(lambda x: x.n_unique(), p_ids.values()))) == n_total
-
-    # partition hospitalization ids according to the patient split
-    hospitalization_ids = (
-        hosp_prepoc.select("patient_id", "hospitalization_id").unique().collect()
+    n_patients = dict(p_splits.group_by("split").len().iter_rows())
+    n_hosp = dict(h_splits.group_by("split").len().iter_rows())
+    logger.info(f"Patients n_total={p_splits.height}")
+    logger.info(
+        "Partition: " + ", ".join(f"n_{s}={n_patients.get(s, 0)}" for s in splits)
     )
 
-    h_ids = dict()
-    for s in splits:
-        h_ids[s] = hospitalization_ids.join(p_ids[s], on="patient_id").select(
-            "hospitalization_id"
-        )
-
+    assert h_splits.get_column("hospitalization_id").is_unique().all()
     for s0, s1 in itertools.combinations(splits, 2):
-        assert h_ids[s0].join(h_ids[s1], on="hospitalization_id").n_unique() == 0
-
-    n_total = sum(list(map(lambda x: x.n_unique(), h_ids.values())))
-    assert n_total <= hospitalization_ids.n_unique()
+        assert (
+            h_splits.filter(pl.col("split") == s0)
+            .join(h_splits.filter(pl.col("split") == s1), on="patient_id")
+            .height
+            == 0
+        )
 
-    logger.info(f"Hospitalizations {n_total=}")
-    logger.info(
-        f"Partition: {h_ids['train'].n_unique()=}, "
-        f"{h_ids['val'].n_unique()=}, {h_ids['test'].n_unique()=}"
-    )
+    logger.info(f"Hospitalizations n_total={h_splits.height}")
+    logger.info("Partition: " + ", ".join(f"n_{s}={n_hosp.get(s, 0)}" for s in splits))
 
-    # generate sub-tables
-    for s in splits:
-        pl.scan_parquet(data_dir_in.joinpath("clif_patient.parquet")).join(
-            p_ids[s].lazy(), on="patient_id"
-        ).sink_parquet(dirs_out[s].joinpath("clif_patient.parquet"))
-
-        pl.scan_parquet(data_dir_in.joinpath("clif_hospitalization.parquet")).join(
-            h_ids[s].lazy(), on="hospitalization_id"
-        ).sink_parquet(dirs_out[s].joinpath("clif_hospitalization.parquet"))
-
-        for t in data_dir_in.glob("*.parquet"):
-            if t.stem.split("_", 1)[1] not in ("hospitalization", "patient"):
-                pl.scan_parquet(t).join(
-                    h_ids[s].lazy(), on="hospitalization_id"
-                ).sink_parquet(dirs_out[s].joinpath(t.name))
+    # generate sub-tables, reading each table once
+    counts = write_splits(data_dir_in, dirs_out, h_splits, batch_size=batch_size)
+    for t, n in counts.items():
+        logger.info(f"{t}: " + ", ".join(f"{s}={n[s]}" for s in splits))
 
 
 if __name__ == "__main__":
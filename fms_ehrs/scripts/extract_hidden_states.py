@@ -11,10 +11,10 @@
 import numpy as np
 import torch as t
 import torch.distributed as dist
-from datasets import load_dataset
 from tqdm import tqdm
 from transformers import AutoModelForCausalLM
 
+from fms_ehrs.framework.dataset import load_input_ids
 from fms_ehrs.framework.logger import get_logger
 from fms_ehrs.framework.storage import set_perms
 from fms_ehrs.framework.vocabulary import Vocabulary
@@ -55,17 +55,9 @@ def main(
 
     vocab = Vocabulary().load(data_dirs["train"].joinpath("vocab.gzip"))
 
-    dataset = (
-        load_dataset(
-            "parquet",
-            data_files={
-                s: str(data_dirs[s].joinpath("tokens_timelines.parquet"))
-                for s in splits
-            },
-        )
-        .map(lambda batch: {"input_ids": batch["padded"]}, batched=True)
-        .with_format("torch")
-    )
+    dataset = load_input_ids(
+        {s: data_dirs[s].joinpath("tokens_timelines.parquet") for s in splits}
+    ).with_format("torch")
 
     # load and prep model
     model = AutoModelForCausalLM.from_pretrained(
@@ -10,6 +10,7 @@
 import fire as fi
 import polars as pl
 
+from fms_ehrs.framework.compact import scan_tokens_timelines
 from fms_ehrs.framework.logger import get_logger
 from fms_ehrs.framework.vocabulary import Vocabulary
 
@@ -44,7 +45,7 @@ def main(
 
     for s in splits:
         outcomes = (
-            pl.scan_parquet(ref_dirs[s].joinpath("tokens_timelines.parquet"))
+            scan_tokens_timelines(ref_dirs[s].joinpath("tokens_timelines.parquet"))
             .with_columns(
                 length_of_stay=(
                     pl.col("times").list.get(-1) - pl.col("times").list.get(0)
@@ -66,7 +67,7 @@ def main(
             )
         )
         (
-            pl.scan_parquet(data_dirs[s].joinpath("tokens_timelines.parquet"))
+            scan_tokens_timelines(data_dirs[s].joinpath("tokens_timelines.parquet"))
             .with_columns(
                 icu_admission_24h=pl.col("tokens").list.contains(icu_token),
                 imv_event_24h=pl.col("tokens").list.contains(imv_token),
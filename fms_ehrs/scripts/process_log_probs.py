@@ -9,8 +9,8 @@
 import pathlib
 
 import numpy as np
-import polars as pl
 
+from fms_ehrs.framework.compact import load_padded, scan_tokens_timelines
 from fms_ehrs.framework.logger import get_logger, log_summary
 from fms_ehrs.framework.plotting import imshow_text, plot_histograms
 from fms_ehrs.framework.util import collate_events_info, extract_examples
@@ -91,18 +91,12 @@
 inf_sum = {v: np.nansum(infm[v], axis=1) for v in versions}
 
 tl = {
-    v: np.array(
-        pl.scan_parquet(data_dirs[v]["test"].joinpath("tokens_timelines.parquet"))
-        .select("padded")
-        .collect()
-        .to_series()
-        .to_list()
-    )
+    v: load_padded(data_dirs[v]["test"].joinpath("tokens_timelines.parquet"))
     for v in versions
 }
 
 tm = {
-    v: pl.scan_parquet(data_dirs[v]["test"].joinpath("tokens_timelines.parquet"))
+    v: scan_tokens_timelines(data_dirs[v]["test"].joinpath("tokens_timelines.parquet"))
     .select("times")
     .collect()
     .to_series()
@@ -114,7 +108,7 @@
 
 ids = {
     v: np.array(
-        pl.scan_parquet(data_dirs[v]["test"].joinpath("tokens_timelines.parquet"))
+        scan_tokens_timelines(data_dirs[v]["test"].joinpath("tokens_timelines.parquet"))
         .select("hospitalization_id")
         .collect()
         .to_series()
@@ -16,10 +16,11 @@
 import seaborn as sns
 import statsmodels.formula.api as smf
 
+from fms_ehrs.framework.compact import compact_dir, load_padded, scan_tokens_timelines
 from fms_ehrs.framework.logger import get_logger
 from fms_ehrs.framework.plotting import colors, plot_histogram
-from fms_ehrs.framework.tokenizer import token_type, token_types, type_names
-from fms_ehrs.framework.util import collate_events_info
+from fms_ehrs.framework.tokenizer import event_runs, token_type, token_types, type_names
+from fms_ehrs.framework.util import collate_events_info, ravel_events
 from fms_ehrs.framework.vocabulary import Vocabulary
 
 plt.rcParams.update(
@@ -70,10 +71,15 @@
     tt = pl.scan_parquet(f)
 elif (f := test_dir.joinpath("tokens_timelines.parquet")).exists():
     tt = pl.scan_parquet(f)
+elif compact_dir(f).exists():
+    tt = scan_tokens_timelines(f)
 else:
     raise FileNotFoundError("Check tokens_timelines* file.")
-tks_arr = tt.select("padded").collect().to_series().to_numpy()
+if "events" not in tt.collect_schema().names():
+    tt = tt.with_columns(events=event_runs())
+tks_arr = load_padded(test_dir.joinpath("tokens_timelines.parquet"))
 tms_arr = tt.select("times").collect().to_series().to_numpy()
+evs_arr = tt.select("events").collect().to_series().to_numpy()
 
 assert jumps.shape == inf_arr[:, 1:].shape
 
@@ -86,7 +92,7 @@
         {
             "jump_length": jumps.ravel(),
             "information": inf_arr[:, 1:].ravel(),
-            "token": np.row_stack(tks_arr)[:, 1:].ravel(),
+            "token": tks_arr[:, 1:].ravel(),
         }
     )
     .assign(
@@ -159,26 +165,25 @@
 
 jumps_padded = np.column_stack([np.zeros(jumps.shape[0]), jumps])
 
-info_list = list()
-path_len_list = list()
-event_len_list = list()
-
-for i in range(len(tks_arr)):
-    tks, tms = tks_arr[i], tms_arr[i]
-    tlen = min(len(tks), len(tms))
-    tks, tms = tks[:tlen], tms[:tlen]
-    inf_i = np.nan_to_num(inf_arr[i, :tlen])
-    j_i = np.nan_to_num(jumps_padded[i, :tlen])
-    event_info, idx = collate_events_info(tms, inf_i, args.aggregation)
-    path_lens = np.bincount(idx, weights=j_i.ravel(), minlength=event_info.shape[0])
-    event_lens = np.bincount(idx, minlength=event_info.shape[0])
-    if args.drop_prefix:
-        event_info = np.delete(event_info, idx[0])
-        path_lens = np.delete(path_lens, idx[0])
-        event_lens = np.delete(event_lens, idx[0])
-    info_list += event_info.tolist()
-    path_len_list += path_lens.tolist()
-    event_len_list += event_lens.tolist()
+# aggregate events over all timelines at once
+tlens = np.array([min(len(tks), len(tms)) for tks, tms in zip(tks_arr, tms_arr)])
+evs, n_evs = ravel_events(evs_arr, tlens)
+in_tl = np.arange(inf_arr.shape[1]) < tlens[:, np.newaxis]
+event_info, idx = collate_events_info(
+    None, np.nan_to_num(inf_arr[in_tl]), args.aggregation, events=evs
+)
+path_lens = np.bincount(
+    idx, weights=np.nan_to_num(jumps_padded[in_tl]), minlength=event_info.shape[0]
+)
+event_lens = np.bincount(idx, minlength=event_info.shape[0])
+if args.drop_prefix:
+    prefixes = (np.cumsum(n_evs) - n_evs)[n_evs > 0]
+    event_info = np.delete(event_info, prefixes)
+    path_lens = np.delete(path_lens, prefixes)
+    event_lens = np.delete(event_lens, prefixes)
+info_list = event_info.tolist()
+path_len_list = path_lens.tolist()
+event_len_list = event_lens.tolist()
 
 assert len(info_list) == len(path_len_list) == len(event_len_list)
 
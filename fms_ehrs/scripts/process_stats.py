@@ -13,7 +13,8 @@
 import statsmodels.formula.api as smf
 
 from fms_ehrs.framework.logger import get_logger
-from fms_ehrs.framework.util import collate_events_info, count_top_q
+from fms_ehrs.framework.tokenizer import event_runs
+from fms_ehrs.framework.util import collate_events_info, count_top_q, ravel_events
 
 logger = get_logger()
 logger.info("running {}".format(__file__))
@@ -52,16 +53,21 @@
 
 assert info.shape[0] == tto.shape[0]
 
-info_l = info.tolist()
-times_l = tto.select("times").to_series().to_list()
-info_agg_list = []
-perp_agg_list = []
+if "events" not in tto.columns:
+    tto = tto.with_columns(events=event_runs())
 
-for tms, inf in zip(times_l, info_l):
-    tlen = min(len(inf), len(tms))
-    tms, inf = np.array(tms[:tlen]), np.array(inf[:tlen])
-    info_agg_list.append(collate_events_info(tms, inf, aggregation="sum")[0])
-    perp_agg_list.append(collate_events_info(tms, inf, aggregation="perplexity")[0])
+# aggregate events over all timelines at once and split the result by timeline
+tlens = np.minimum(info.shape[1], tto.select(pl.col("times").list.len()).to_numpy())
+evs, n_evs = ravel_events(tto.select("events").to_series().to_numpy(), tlens.ravel())
+info_flat = info[np.arange(info.shape[1]) < tlens]
+info_agg_list = np.split(
+    collate_events_info(None, info_flat, aggregation="sum", events=evs)[0],
+    np.cumsum(n_evs)[:-1],
+)
+perp_agg_list = np.split(
+    collate_events_info(None, info_flat, aggregation="perplexity", events=evs)[0],
+    np.cumsum(n_evs)[:-1],
+)
 
 
 tks_q99 = np.nansum(info >= np.nanquantile(info, q=0.99), axis=1)
@@ -13,6 +13,7 @@
 import polars as pl
 
 from fms_ehrs.framework.logger import get_logger
+from fms_ehrs.framework.tokenizer import event_runs
 from fms_ehrs.framework.util import redact_tokens_times
 from fms_ehrs.framework.vocabulary import Vocabulary
 
@@ -66,6 +67,8 @@
     d_out.mkdir(exist_ok=True, parents=True)
 
     df = pl.read_parquet(dv.joinpath("tokens_timelines_outcomes.parquet"))
+    if "events" not in df.columns:
+        df = df.with_columns(events=event_runs())
     infm = np.load(dv.joinpath("log_probs-{m}.npy".format(m=model_loc.stem))) / -np.log(
         2
     )
@@ -75,6 +78,7 @@
 
     tkn_icu = df_icu.select("padded").to_series().to_numpy()
     tms_icu = df_icu.select("times").to_series().to_numpy()
+    evs_icu = df_icu.select("events").to_series().to_numpy()
     inf_icu = infm[icu_adm]
     max_pad = len(tkn_icu[0])
 
@@ -87,6 +91,7 @@
             pct=args.pct,
             method=args.method,
             aggregation=args.aggregation,
+            evs_arr=evs_icu,
         )
         df = (
             df_icu.with_columns(
@@ -98,7 +103,7 @@
                     dtype=pl.List(pl.Datetime(time_unit="ms")),
                 ),
             )
-            .with_columns(redacted_len=pl.col("padded").list.len())
+            .with_columns(redacted_len=pl.col("padded").list.len(), events=event_runs())
             .with_columns(
                 padded=pl.concat_list(
                     "padded",
@@ -17,8 +17,10 @@
 import torch as t
 import tqdm
 
+from fms_ehrs.framework.compact import compact_dir, load_padded, scan_tokens_timelines
 from fms_ehrs.framework.logger import get_logger
 from fms_ehrs.framework.plotting import colors
+from fms_ehrs.framework.tokenizer import event_runs
 from fms_ehrs.framework.util import collate_events_info
 
 plt.rcParams.update(
@@ -66,10 +68,15 @@
     tt = pl.scan_parquet(f)
 elif (f := test_dir.joinpath("tokens_timelines.parquet")).exists():
     tt = pl.scan_parquet(f)
+elif compact_dir(f).exists():
+    tt = scan_tokens_timelines(f)
 else:
     raise FileNotFoundError("Check tokens_timelines* file.")
-tks_arr = tt.select("padded").collect().to_series().to_numpy()
+if "events" not in tt.collect_schema().names():
+    tt = tt.with_columns(events=event_runs())
+tks_arr = load_padded(test_dir.joinpath("tokens_timelines.parquet"))
 tms_arr = tt.select("times").collect().to_series().to_numpy()
+evs_arr = tt.select("events").collect().to_series().to_numpy()
 ids = tt.select("hospitalization_id").collect().to_series().to_numpy()
 
 featfiles = sorted(
@@ -89,7 +96,9 @@ def process_big_batch(batch_num: int, big_batch: t.Tensor):
         )
         tks, tms = tks[:tlen], tms[:tlen]
         inf_i = np.nan_to_num(inf_arr[orig_idx, :tlen])
-        event_info, time_idx = collate_events_info(tms, inf_i, args.aggregation)
+        event_info, time_idx = collate_events_info(
+            tms, inf_i, args.aggregation, events=evs_arr[orig_idx][:tlen]
+        )
         reps_i = batch_reps[batch_idx, :tlen]
         i_jumps = []
         i_info = []
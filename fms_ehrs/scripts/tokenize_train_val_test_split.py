@@ -6,9 +6,13 @@
 
 import os
 import pathlib
+import typing
 
 import fire as fi
+import joblib as jl
+import polars as pl
 
+from fms_ehrs.framework.compact import compact_dir
 from fms_ehrs.framework.logger import get_logger
 from fms_ehrs.framework.tokenizer import ClifTokenizer, summarize
 
@@ -17,6 +21,95 @@
 logger.log_env()
 
 
+def tokenize(
+    s: str,
+    dir_in: pathlib.Path,
+    dir_out: pathlib.Path,
+    *,
+    vocab_path: pathlib.Path = None,
+    windows: dict[str, pathlib.Path] = None,
+    n_parts: int = None,
+    polars_threads: int = None,
+    storage: typing.Literal["parquet", "compact", "both"] = "parquet",
+    padded_npy: bool = True,
+    streaming: bool = False,
+    **kwargs,
+) -> None:
+    """
+    tokenize split `s` from `dir_in` and write the result to `dir_out`; cut
+    versions of the result are then written for each duration -> directory pair
+    in `windows`; if `n_parts` is provided, the split is tokenized out-of-core
+    in `n_parts` hash buckets of hospitalizations (training then learns its
+    quantiles from sketches, so `quantile_sketch_eps` is required, and summary
+    stats are not reported; otherwise, the frequency of each token is written
+    next to the timelines as `token_frequencies.parquet`); with `streaming`,
+    which requires `n_parts`, each hash bucket is instead compiled to a single
+    lazy query over the raw tables (see `ClifTokenizer.tokens_timelines_plan`)
+    once the vocabulary is frozen; when run in a worker process,
+    `polars_threads` caps the size of polars' thread pool; `storage` selects
+    whether the timelines are kept as parquet, in the format of
+    `fms_ehrs.framework.compact` (replacing the parquet file, which is then
+    only written as an intermediate), or both; unless `padded_npy` is False,
+    parquet timelines are accompanied by their padded matrix as a
+    memory-mappable `tokens_timelines-padded.npy`; with `profile=True`, a report of
+    the time and memory spent in each stage is written next to the timelines
+    as `tokenizer_report.json` (and query plans to `plans_dir`/`s`, if given)
+    """
+    if polars_threads is not None:
+        os.environ["POLARS_MAX_THREADS"] = str(polars_threads)
+    if kwargs.get("plans_dir") is not None:
+        kwargs["plans_dir"] = pathlib.Path(kwargs["plans_dir"]).joinpath(s)
+    log = get_logger()
+    tkzr = ClifTokenizer(data_dir=dir_in, vocab_path=vocab_path, **kwargs)
+    prof = tkzr.profiler
+    log.info(f"{s}...")
+    if streaming and n_parts is None:
+        raise ValueError("streaming tokenizes hash buckets and requires n_parts")
+    if n_parts is not None:
+        tkzr.write_tokens_timelines_sharded(
+            dir_out.joinpath("tokens_timelines.parquet"),
+            n_parts=n_parts,
+            lazy=streaming,
+        )
+    else:
+        tokens_timelines = tkzr.get_tokens_timelines()
+        with prof.stage("summarize"):
+            summarize(
+                tkzr,
+                tokens_timelines,
+                logger=log,
+                freq_file=dir_out.joinpath("token_frequencies.parquet"),
+            )
+        tokens_timelines = tkzr.pad_and_truncate(tokens_timelines)
+        with prof.stage("write_parquet"):
+            tokens_timelines.write_parquet(dir_out.joinpath("tokens_timelines.parquet"))
+    if windows:
+        log.info(f"{s} cut at {', '.join(windows.keys())}...")
+        with prof.stage("windows"):
+            tkzr.window_tokens_timelines(
+                dir_out.joinpath("tokens_timelines.parquet"),
+                {d: w.joinpath("tokens_timelines.parquet") for d, w in windows.items()},
+            )
+    if padded_npy and storage != "compact" and tkzr.max_padded_length is not None:
+        with prof.stage("write_padded"):
+            for d in (dir_out, *(windows or {}).values()):
+                f = d.joinpath("tokens_timelines.parquet")
+                tkzr.write_padded(pl.scan_parquet(f), f)
+    if storage in ("compact", "both"):
+        with prof.stage("write_compact"):
+            for d in (dir_out, *(windows or {}).values()):
+                f = d.joinpath("tokens_timelines.parquet")
+                tkzr.write_compact(pl.scan_parquet(f), compact_dir(f))
+                if storage == "compact":
+                    f.unlink()
+    if s == "train":
+        for d in (dir_out, *(windows or {}).values()):
+            tkzr.vocab.save(d.joinpath("vocab.gzip"))
+    if prof.enabled:
+        prof.write_report(dir_out.joinpath("tokenizer_report.json"))
+    log.info(f"---{s}")
+
+
 @logger.log_calls
 def main(
     *,
@@ -25,69 +118,74 @@ def main(
     data_version_out: str = "day_stays",
     vocab_path: os.PathLike = None,
     include_24h_cut: bool = True,
+    windows: tuple[str, ...] = (),
+    n_parts: int = None,
+    n_workers: int = 1,
+    polars_threads: int = None,
     **kwargs,
 ):
+    """
+    cut versions `{data_version_out}_first_{d}` for durations `d` in `windows`
+    (e.g. "6h", "12h", "24h", "48h"; "24h" is included if `include_24h_cut`)
+    are derived from the tokenized splits without re-tokenizing; once the
+    vocabulary is frozen, the remaining splits are independent and are
+    tokenized concurrently on `n_workers` processes, each using `polars_threads`
+    threads (by default, the available cores are divided evenly among workers);
+    passing `storage="compact"` keeps each split in the memory-mappable
+    format of `fms_ehrs.framework.compact` instead of as parquet
+    """
     data_dir = pathlib.Path(data_dir).expanduser().resolve()
     splits = ("train", "val", "test")
+    windows = (windows,) if isinstance(windows, str) else tuple(windows)
+    windows = tuple(dict.fromkeys(windows + (("24h",) if include_24h_cut else ())))
 
-    for cut_at_24h in (False, True) if include_24h_cut else (False,):
-        logger.info(f"{cut_at_24h=}...")
-        v = data_version_out + ("_first_24h" if cut_at_24h else "")
+    dirs_in = dict()
+    dirs_out = dict()
+    dirs_win = dict()
+    for s in splits:
+        dirs_in[s] = data_dir.joinpath(data_version_in, s)
+        dirs_out[s] = data_dir.joinpath(f"{data_version_out}-tokenized", s)
+        dirs_out[s].mkdir(exist_ok=True, parents=True)
+        dirs_win[s] = dict()
+        for d in windows:
+            dirs_win[s][d] = data_dir.joinpath(
+                f"{data_version_out}_first_{d}-tokenized", s
+            )
+            dirs_win[s][d].mkdir(exist_ok=True, parents=True)
 
-        dirs_in = dict()
-        dirs_out = dict()
-        for s in splits:
-            dirs_in[s] = data_dir.joinpath(data_version_in, s)
-            dirs_out[s] = data_dir.joinpath(f"{v}-tokenized", s)
-            dirs_out[s].mkdir(exist_ok=True, parents=True)
+    jobs = list(splits)
 
-        # tokenize training set
-        tkzr = ClifTokenizer(
-            data_dir=dirs_in["train"],
-            vocab_path=(
-                pathlib.Path(vocab_path).expanduser().resolve()
-                if vocab_path is not None
-                else (
-                    data_dir.joinpath(
-                        f"{data_version_out}-tokenized", "train", "vocab.gzip"
-                    )
-                    if cut_at_24h
-                    else None
-                )
-            ),
-            cut_at_24h=cut_at_24h,
+    if vocab_path is not None:
+        vocab_path = pathlib.Path(vocab_path).expanduser().resolve()
+    else:
+        # learn the tokenizer on the training set
+        tokenize(
+            "train",
+            dirs_in["train"],
+            dirs_out["train"],
+            windows=dirs_win["train"],
+            n_parts=n_parts,
             **kwargs,
         )
-        tokens_timelines = tkzr.get_tokens_timelines()
-        logger.info("train...")
-        summarize(tkzr, tokens_timelines, logger=logger)
-        tokens_timelines = tkzr.pad_and_truncate(tokens_timelines)
-        tokens_timelines.write_parquet(
-            dirs_out["train"].joinpath("tokens_timelines.parquet")
-        )
-        tkzr.vocab.save(dirs_out["train"].joinpath("vocab.gzip"))
+        jobs.remove("train")
+        vocab_path = dirs_out["train"].joinpath("vocab.gzip")
 
-        # take the learned tokenizer and tokenize the validation and test sets
-        for s in ("val", "test"):
-            tkzr = ClifTokenizer(
-                data_dir=dirs_in[s],
-                vocab_path=(
-                    pathlib.Path(vocab_path).expanduser().resolve()
-                    if vocab_path is not None
-                    else data_dir.joinpath(
-                        f"{data_version_out}-tokenized", "train", "vocab.gzip"
-                    )
-                ),
-                cut_at_24h=cut_at_24h,
-                **kwargs,
-            )
-            tokens_timelines = tkzr.get_tokens_timelines()
-            logger.info(f"{s}...")
-            summarize(tkzr, tokens_timelines, logger=logger)
-            tokens_timelines = tkzr.pad_and_truncate(tokens_timelines)
-            tokens_timelines.write_parquet(
-                dirs_out[s].joinpath("tokens_timelines.parquet")
-            )
+    # take the learned tokenizer and tokenize everything else
+    if n_workers > 1 and polars_threads is None:
+        polars_threads = max(1, len(os.sched_getaffinity(0)) // n_workers)
+    jl.Parallel(n_jobs=n_workers)(
+        jl.delayed(tokenize)(
+            s,
+            dirs_in[s],
+            dirs_out[s],
+            vocab_path=vocab_path,
+            windows=dirs_win[s],
+            n_parts=n_parts,
+            polars_threads=polars_threads if n_workers > 1 else None,
+            **kwargs,
+        )
+        for s in jobs
+    )
 
 
 if __name__ == "__main__":
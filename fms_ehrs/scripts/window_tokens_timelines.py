@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+"""
+derive versions of already-tokenized timelines cut at one or more time horizons
+(e.g. the first 6h, 12h, 24h, 48h of each hospitalization) without re-tokenizing;
+unless `max_padded_len` is given, cuts are padded to the length used for the
+source timelines (if they were padded at all), and each padded cut is
+accompanied by its padded matrix as a memory-mappable `tokens_timelines-padded.npy`
+"""
+
+import os
+import pathlib
+
+import fire as fi
+import polars as pl
+
+from fms_ehrs.framework.compact import CompactTimelines, compact_dir
+from fms_ehrs.framework.logger import get_logger
+from fms_ehrs.framework.tokenizer import ClifTokenizer
+
+logger = get_logger()
+logger.info("running {}".format(__file__))
+logger.log_env()
+
+
+@logger.log_calls
+def main(
+    *,
+    data_dir: os.PathLike = None,
+    data_version: str = "day_stays",
+    windows: tuple[str, ...] = ("24h",),
+    max_padded_len: int = None,
+    splits: tuple[str, ...] = ("train", "val", "test"),
+):
+    data_dir = pathlib.Path(data_dir).expanduser().resolve()
+    windows = (windows,) if isinstance(windows, str) else tuple(windows)
+    vocab_path = data_dir.joinpath(f"{data_version}-tokenized", "train", "vocab.gzip")
+
+    if max_padded_len is None:
+        f = data_dir.joinpath(
+            f"{data_version}-tokenized", "train", "tokens_timelines.parquet"
+        )
+        if not f.exists():  # only the compact version was kept
+            max_padded_len = CompactTimelines(compact_dir(f)).max_padded_length
+            logger.info(f"padding to the source's {max_padded_len=}")
+        elif "padded" in (src := pl.scan_parquet(f)).collect_schema().names():
+            max_padded_len = (
+                src.select(pl.col("padded").list.len().first()).collect().item()
+            )
+            logger.info(f"padding to the source's {max_padded_len=}")
+
+    tkzr = ClifTokenizer(vocab_path=vocab_path, max_padded_len=max_padded_len)
+
+    for s in splits:
+        logger.info(f"{s}...")
+        dirs_out = dict()
+        for d in windows:
+            dirs_out[d] = data_dir.joinpath(f"{data_version}_first_{d}-tokenized", s)
+            dirs_out[d].mkdir(exist_ok=True, parents=True)
+        tkzr.window_tokens_timelines(
+            data_dir.joinpath(
+                f"{data_version}-tokenized", s, "tokens_timelines.parquet"
+            ),
+            {d: dirs_out[d].joinpath("tokens_timelines.parquet") for d in windows},
+        )
+        if max_padded_len is not None:
+            for d in windows:
+                f = dirs_out[d].joinpath("tokens_timelines.parquet")
+                tkzr.write_padded(pl.scan_parquet(f), f)
+        if s == "train":
+            for d in windows:
+                tkzr.vocab.save(dirs_out[d].joinpath("vocab.gzip"))
+
+
+if __name__ == "__main__":
+    fi.Fire(main)
@@ -0,0 +1,16 @@
+#!/bin/bash
+
+#SBATCH --job-name=bench-tkzr
+#SBATCH --output=./output/%j-%x.stdout
+#SBATCH --partition=tier2q
+#SBATCH --mem=100GB
+#SBATCH --time=2:00:00
+
+source preamble.sh
+
+python3 ../fms_ehrs/scripts/benchmark_tokenizer.py \
+    --out_dir "/scratch/$(whoami)/benchmark-tokenizer" \
+    --scales "(1000,10000,100000)" \
+    --max_padded_len 1024 \
+    --day_stay_filter True \
+    --drop_nulls_nans True
@@ -0,0 +1,18 @@
+#!/bin/bash
+
+#SBATCH --job-name=append-tkzd
+#SBATCH --output=./output/%j-%x.stdout
+#SBATCH --partition=tier2q
+#SBATCH --mem=100GB
+#SBATCH --time=2:00:00
+
+source preamble.sh
+
+python3 ../fms_ehrs/scripts/append_tokens_timelines.py \
+    --delta_dir "${hm}/data-mimic/delta" \
+    --data_dir "${hm}/data-mimic" \
+    --data_version "day_stays" \
+    --split "test" \
+    --windows "('24h',)" \
+    --max_padded_len 1024 \
+    --day_stay_filter True